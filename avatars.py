@@ -0,0 +1,51 @@
+import discord
+import asyncio
+from cache import ByteCache, SingleFlight
+from config import AVATAR_CACHE_BYTES, AVATAR_DISK_CACHE_DIR, AVATAR_DISK_CACHE_BYTES
+
+
+def avatar_key(asset: discord.Asset) -> str:
+    """The asset's hash plus the requested format and size"""
+    # The url contains both, e.g. https://cdn.discordapp.com/avatars/<user id>/<hash>.png?size=1024
+    path, _, query = asset.url.partition("?")
+    return asset.key + path[path.rindex("."):] + "?" + query
+
+
+class AvatarCache:
+    """
+    Downloads avatars, keeping the bytes in memory and optionally on disk. An avatar's hash changes when it does,
+    so entries never go stale
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str = None, disk_bytes: int = 0):
+        self.cache = ByteCache(max_bytes, disk_dir, disk_bytes)
+
+        # Concurrent requests for the same avatar share one download
+        self.downloads = SingleFlight()
+
+    async def read(self, asset: discord.Asset) -> bytes:
+        key = avatar_key(asset)
+
+        data = await self.cache.get(key)
+        if data is not None:
+            return data
+
+        task = self.downloads.start(key, self.load, asset, key)
+
+        # Shield so one caller being cancelled doesn't cancel the download for everyone else
+        return await asyncio.shield(task)
+
+    async def load(self, asset: discord.Asset, key: str) -> bytes:
+        data = await asset.read()
+        await self.cache.put(key, data)
+
+        return data
+
+    def stats(self) -> dict:
+        stats = self.cache.stats()
+        stats["coalesced"] = self.downloads.coalesced
+
+        return stats
+
+
+avatars = AvatarCache(AVATAR_CACHE_BYTES, AVATAR_DISK_CACHE_DIR, AVATAR_DISK_CACHE_BYTES)
@@ -0,0 +1,73 @@
+"""
+Checks the numpy compositing engine produces identical images to the Pillow engine, and compares their speed
+
+Run from the repository root: python -m benchmarks.compositing
+"""
+from PIL import Image
+from io import BytesIO
+import argparse
+import time
+import imaging
+
+
+def sample_avatars() -> dict:
+    opaque = Image.effect_mandelbrot((256, 256), (-2, -1.5, 1, 1.5), 100).convert("RGB")
+
+    # Partial transparency is where the blending maths matters
+    translucent = opaque.convert("RGBA")
+    translucent.putalpha(Image.linear_gradient("L").resize((256, 256)))
+
+    avatars = {}
+    for name, image in (("opaque", opaque), ("translucent", translucent)):
+        output = BytesIO()
+        image.save(output, format="png")
+        avatars[name] = output.getvalue()
+
+    return avatars
+
+
+def render(pfp: bytes, kind: str) -> Image:
+    if kind == "pride":
+        return imaging.make_pride_image(BytesIO(pfp), imaging.FLAGS[0], "diagonal /", imaging.FLAGS[1], 0)
+    else:
+        return imaging.make_welcome_image(imaging.WELCOME_BG, BytesIO(pfp), "Welcome", "Golden", "Footer", (0, 0, 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    if "numpy" not in imaging.ENGINES:
+        print("numpy is not installed")
+        return
+
+    imaging.load_assets()
+    failed = False
+
+    for avatar_name, pfp in sample_avatars().items():
+        for kind in ("pride", "welcome"):
+            outputs = {}
+            timings = {}
+
+            for engine in imaging.ENGINES:
+                imaging.engine = engine
+                outputs[engine] = render(pfp, kind)
+
+                start = time.perf_counter()
+                for _ in range(args.iterations):
+                    render(pfp, kind)
+                timings[engine] = (time.perf_counter() - start) / args.iterations
+
+            identical = outputs["pil"].tobytes() == outputs["numpy"].tobytes()
+            failed = failed or not identical
+
+            print(f"{kind} ({avatar_name}): {'identical' if identical else 'DIFFERENT'} - " +
+                  ", ".join(f"{engine} {seconds * 1000:.1f}ms" for engine, seconds in timings.items()))
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Offline benchmark of the pride and welcome image pipelines, using synthetic avatars instead of Discord
+
+Run from the repository root: python -m benchmarks.images
+Use --save-baseline and --baseline to compare a change against a previous run
+"""
+from PIL import Image
+from io import BytesIO
+from itertools import product
+import argparse
+import asyncio
+import resource
+import json
+import time
+import imaging
+
+
+def synthetic_avatars() -> dict:
+    """Avatars covering the formats and modes people actually upload"""
+    base = Image.effect_mandelbrot((512, 512), (-2, -1.5, 1, 1.5), 100)
+
+    avatars = {}
+
+    output = BytesIO()
+    base.convert("RGB").save(output, format="png")
+    avatars["png"] = output.getvalue()
+
+    output = BytesIO()
+    base.convert("RGB").resize((2048, 2048)).save(output, format="jpeg", quality=90)
+    avatars["large jpeg"] = output.getvalue()
+
+    output = BytesIO()
+    base.convert("RGB").quantize(64).save(output, format="png")
+    avatars["palette"] = output.getvalue()
+
+    la = Image.merge("LA", (base, Image.linear_gradient("L").resize(base.size)))
+    output = BytesIO()
+    la.save(output, format="png")
+    avatars["la"] = output.getvalue()
+
+    return avatars
+
+
+def pride_jobs(avatars: dict, encoding: str) -> list:
+    """Every flag, seperator and blur combination. The avatar rotates, so each type is used evenly"""
+    combinations = []
+    for flag, blur in product(imaging.FLAGS, (0, 1)):
+        combinations.append((flag, None, None, blur))
+
+        for seperator, flag_2 in product(imaging.FLAG_SEPARATORS, imaging.FLAGS):
+            combinations.append((flag, seperator, flag_2, blur))
+
+    avatar_list = list(avatars.values())
+    return [
+        (imaging.render_pride, avatar_list[i % len(avatar_list)], *options, encoding)
+        for i, options in enumerate(combinations)
+    ]
+
+
+def welcome_jobs(avatars: dict, encoding: str, repeat: int) -> list:
+    jobs = []
+    for i in range(repeat):
+        for pfp in avatars.values():
+            jobs.append((imaging.render_welcome, imaging.WELCOME_BG, pfp, "Welcome", f"Member {i}",
+                         f"You are our {i}th member!", (0, 0, 0), encoding))
+            jobs.append((imaging.render_welcome, imaging.LEAVE_BG, pfp, "Goodbye", f"Member {i}",
+                         "We will miss you :(", (255, 255, 255), encoding))
+
+    return jobs
+
+
+def run_sequential(jobs: list) -> tuple:
+    """Runs each job in this process, returning (latencies, total seconds)"""
+    latencies = []
+    start = time.perf_counter()
+
+    for fn, *args in jobs:
+        job_start = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - job_start)
+
+    return latencies, time.perf_counter() - start
+
+
+async def run_pool(jobs: list, pool: imaging.RenderPool) -> tuple:
+    """Submits every job to the render pool at once, returning (latencies including queueing, total seconds)"""
+    async def timed(fn, *args):
+        job_start = time.perf_counter()
+        await pool.run(fn, *args)
+        return time.perf_counter() - job_start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(timed(*job) for job in jobs))
+
+    return list(latencies), time.perf_counter() - start
+
+
+def summarise(latencies: list, total: float) -> dict:
+    return {
+        "renders": len(latencies),
+        "throughput": len(latencies) / total,
+        "p50": imaging.percentile(latencies, 50) * 1000,
+        "p95": imaging.percentile(latencies, 95) * 1000,
+        "p99": imaging.percentile(latencies, 99) * 1000,
+    }
+
+
+def peak_rss_mb() -> dict:
+    """
+    Peak RSS of this process, and of the largest process pool worker. Workers only count once they've exited, so the
+    pool has to be shut down with wait=True first
+    """
+    # ru_maxrss is in KB on Linux
+    return {
+        "parent": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "worker": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def print_results(results: dict, baseline: dict = None):
+    for name, stats in results.items():
+        if name == "peak_rss_mb":
+            continue
+
+        line = "{:<8} {:>5} renders  {:>7.1f}/s  p50 {:>7.1f}ms  p95 {:>7.1f}ms  p99 {:>7.1f}ms".format(
+            name, stats["renders"], stats["throughput"], stats["p50"], stats["p95"], stats["p99"])
+
+        if baseline and name in baseline:
+            old = baseline[name]
+            line += "  (throughput {:+.0%}, p95 {:+.0%})".format(stats["throughput"] / old["throughput"] - 1,
+                                                               stats["p95"] / old["p95"] - 1)
+
+        print(line)
+
+    rss = results["peak_rss_mb"]
+    line = f"Peak RSS: {rss['parent']:.0f}MB"
+    if rss["worker"]:
+        line += f", largest worker {rss['worker']:.0f}MB"
+
+    # Baselines from before the worker RSS was split out have a single number, which isn't comparable
+    if baseline and isinstance(baseline.get("peak_rss_mb"), dict):
+        old = baseline["peak_rss_mb"]
+        line += f" (baseline {old['parent']:.0f}MB"
+        if old["worker"]:
+            line += f", largest worker {old['worker']:.0f}MB"
+        line += ")"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pool", choices=["process", "thread"], help="Render through a RenderPool instead of "
+                                                                       "sequentially in this process")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--engine", choices=imaging.ENGINES, default="pil")
+    parser.add_argument("--encoding", choices=imaging.ENCODINGS.keys(), default="png")
+    parser.add_argument("--welcome-repeat", type=int, default=25, help="Welcome/goodbye renders per avatar type")
+    parser.add_argument("--limit", type=int, help="Only run the first N pride combinations, for quick checks")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--save-baseline", help="Save the results to this JSON file")
+    args = parser.parse_args()
+
+    imaging.load_assets()
+    imaging.engine = args.engine
+
+    avatars = synthetic_avatars()
+    jobs = {
+        "pride": pride_jobs(avatars, args.encoding)[:args.limit],
+        "welcome": welcome_jobs(avatars, args.encoding, args.welcome_repeat),
+    }
+
+    results = {}
+    if args.pool:
+        pool = imaging.RenderPool(args.pool, args.workers, args.engine)
+        for name, job_list in jobs.items():
+            results[name] = summarise(*asyncio.run(run_pool(job_list, pool)))
+        # Wait for the workers to exit, so their RSS is counted
+        pool.shutdown(wait=True)
+    else:
+        for name, job_list in jobs.items():
+            results[name] = summarise(*run_sequential(job_list))
+
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump(results, file, indent=4)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""
+Times the database work behind the moderation commands, using the sqlite backend so no Mongo server is needed
+
+Run from the repository root: python -m benchmarks.storage
+"""
+import argparse
+import asyncio
+import datetime as dt
+import random
+import time
+import config
+
+# Has to be set before storage is imported, as that's when the backend is picked
+config.STORAGE_BACKEND = "sqlite"
+
+import storage  # noqa: E402
+
+LOG_TYPES = ["warn", "timeout", "ban", "note"]
+WORDS = ["spam", "slurs", "nsfw", "raid", "alt", "advertising", "harassment", "links", "evading", "mute"]
+PAGE_SIZE = 25
+
+
+async def populate(cases: int, users: int):
+    now = dt.datetime.utcnow()
+    for _ in range(cases):
+        await storage.storage.insert_case({
+            "case": await storage.use_counter("mod_logs_case"),
+            "user": random.randrange(users),
+            "mod": random.randrange(10),
+            "type": random.choice(LOG_TYPES),
+            "duration": None,
+            "reason": " ".join(random.choices(WORDS, k=4)),
+            "timestamp": now - dt.timedelta(days=random.uniform(0, 3 * 365)),
+        })
+
+
+async def time_operation(name: str, iterations: int, fn):
+    times = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        await fn()
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+    print("{:<20} p50 {:>7.3f}ms  p95 {:>7.3f}ms".format(
+        name, times[len(times) // 2] * 1000, times[int(len(times) * 0.95)] * 1000))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--cases", type=int, default=50000)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    db = storage.storage
+    await db.setup()
+
+    start = time.perf_counter()
+    await populate(args.cases, args.users)
+    print(f"Inserted {args.cases} cases in {time.perf_counter() - start:.2f}s\n")
+
+    cutoff = dt.datetime.utcnow() - dt.timedelta(days=90)
+
+    def user() -> int:
+        return random.randrange(args.users)
+
+    async def modlogs():
+        await db.get_summary(user(), cutoff)
+        await db.case_page(None, PAGE_SIZE + 1, user=user())
+
+    async def next_page():
+        await db.case_page(args.cases // 2, PAGE_SIZE + 1, user=user())
+
+    async def getcase():
+        await db.find_case(random.randrange(1, args.cases))
+
+    async def searchcases():
+        await db.search_cases(random.choice(WORDS), None, 11, 5000, log_type="warn")
+
+    async def export_user():
+        async for _case in db.iter_cases("case", 500, user=user()):
+            pass
+
+    await time_operation("insert_case", args.iterations, lambda: populate(1, args.users))
+    await time_operation("modlogs", args.iterations, modlogs)
+    await time_operation("modlogs next page", args.iterations, next_page)
+    await time_operation("getcase", args.iterations, getcase)
+    await time_operation("searchcases", max(args.iterations // 10, 1), searchcases)
+    await time_operation("export user", args.iterations, export_user)
+
+    start = time.perf_counter()
+    moved = await db.archive_cases(dt.datetime.utcnow() - dt.timedelta(days=365), 500)
+    print(f"\nArchived {moved} cases in {time.perf_counter() - start:.2f}s")
+
+    await time_operation("archived modlogs", args.iterations,
+                         lambda: db.case_page(None, PAGE_SIZE + 1, True, user=user()))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+"""
+Compares the per-card cost of building welcome images from scratch against copying the pre-rendered template
+
+Run from the repository root: python -m benchmarks.welcome_card
+"""
+from PIL import Image, ImageDraw
+from io import BytesIO
+import argparse
+import time
+import imaging
+
+
+def scratch_welcome_image(background: str, pfp: BytesIO, header: str, body: str, footer: str,
+                          text_colour: tuple) -> Image:
+    """How make_welcome_image worked before templates - Every invariant element is rebuilt for each card"""
+    background_img = Image.open(background)
+
+    pfp_img = Image.open(pfp)
+    pfp_img = pfp_img.convert("RGBA")
+    pfp_img = pfp_img.resize((imaging.WELCOME_PFP_SIZE, imaging.WELCOME_PFP_SIZE))
+    pfp_img = imaging.circle_crop(pfp_img)
+
+    background_img.paste(pfp_img, imaging.WELCOME_PFP_BOX, pfp_img)
+
+    canvas = ImageDraw.Draw(background_img)
+    canvas.ellipse(imaging.WELCOME_RING_BOX, outline=(255, 255, 255), width=4)
+    canvas.rectangle((0, 0, 699, 249), outline=(0, 0, 0), width=3)
+
+    header_font = imaging.get_font(imaging.FONT_BOLD, 35)
+    canvas.text((700 / 1.5, 250 / 3.5), header, text_colour, header_font, "mm")
+
+    body_font = imaging.fit_font_width(imaging.FONT_BOLD, 60, body, 400)
+    canvas.text((700 / 1.5, 250 / 2), body, text_colour, body_font, "mm")
+
+    footer_font = imaging.get_font(imaging.FONT, 25)
+    canvas.text((700 / 1.5, 250 / 1.35), footer, text_colour, footer_font, "mm")
+
+    return background_img
+
+
+def time_per_card(fn, pfp: bytes, iterations: int) -> float:
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(imaging.WELCOME_BG, BytesIO(pfp), "Welcome", "Member " + str(i % 50), "You are our 1000th member!",
+           (0, 0, 0))
+
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--avatar-size", type=int, default=128,
+                        help="Decoding large avatars dominates the cost, which both versions share")
+    args = parser.parse_args()
+
+    imaging.load_assets()
+
+    pfp = BytesIO()
+    Image.effect_mandelbrot((args.avatar_size, args.avatar_size), (-2, -1.5, 1, 1.5), 100).convert("RGB").save(pfp, format="png")
+    pfp = pfp.getvalue()
+
+    # Warm up the font and template caches, so neither side pays for the first load
+    scratch_welcome_image(imaging.WELCOME_BG, BytesIO(pfp), "Welcome", "Warmup", "", (0, 0, 0))
+    imaging.make_welcome_image(imaging.WELCOME_BG, BytesIO(pfp), "Welcome", "Warmup", "", (0, 0, 0))
+
+    scratch = time_per_card(scratch_welcome_image, pfp, args.iterations)
+    template = time_per_card(imaging.make_welcome_image, pfp, args.iterations)
+
+    print(f"From scratch: {scratch * 1000:.2f}ms per card")
+    print(f"Template:     {template * 1000:.2f}ms per card ({scratch / template:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+from collections import OrderedDict
+from hashlib import sha256
+from typing import Optional
+import threading
+import asyncio
+import time
+import os
+
+
+class LRUCache:
+    """Least recently used cache, bounded by the total size of its values rather than the number of entries"""
+
+    def __init__(self, max_bytes: int, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+
+        # key: (value, size)
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Render pools can run in threads, so guard the ordering updates
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        # Caching this would evict everything else and still not fit
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+
+            self.entries[key] = (value, size)
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return default
+
+            self.size -= entry[1]
+            return entry[0]
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.size,
+        }
+
+
+class TTLCache:
+    """
+    Entries expire after `ttl` seconds, or their own ttl if one is given. Bounded by the number of entries, dropping
+    the least recently used. Only used from the event loop, so there's no lock
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # key: (value, expiry time)
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry[1] > time.monotonic()
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] <= time.monotonic():
+            del self.entries[key]
+            self.expirations += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, ttl: float = None):
+        self.entries.pop(key, None)
+        self.entries[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "entries": len(self.entries),
+        }
+
+
+class DiskCache:
+    """
+    Stores bytes as files in a directory, bounded by their total size. The least recently used files are removed first
+    The file operations block, so run these methods in an executor from async code
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        os.makedirs(directory, exist_ok=True)
+
+        # filename: size - In order of use, so the files from previous runs start off in order of modification
+        self.files = OrderedDict()
+        for entry in sorted(os.scandir(directory), key=lambda e: e.stat().st_mtime):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                self.files[entry.name] = entry.stat().st_size
+        self.size = sum(self.files.values())
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
+
+        self.evict()
+
+    @staticmethod
+    def filename(key: str) -> str:
+        # Keys can contain anything, so hash them into something safe for a filename
+        return sha256(key.encode()).hexdigest()
+
+    def get(self, key: str):
+        name = self.filename(key)
+
+        try:
+            with open(os.path.join(self.directory, name), "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+                self.size -= self.files.pop(name, 0)
+            return None
+
+        with self.lock:
+            self.hits += 1
+            if name in self.files:
+                self.files.move_to_end(name)
+
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+
+        name = self.filename(key)
+        path = os.path.join(self.directory, name)
+
+        # Write to a temporary file first, so a crash can't leave a partially written entry
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+
+        with self.lock:
+            self.size -= self.files.pop(name, 0)
+            self.files[name] = len(data)
+            self.size += len(data)
+
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            while self.size > self.max_bytes:
+                name, size = self.files.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.files),
+            "bytes": self.size,
+        }
+
+
+class SingleFlight:
+    """
+    Runs one task per key at a time, so concurrent requests for the same thing (eg. a download) share it rather than
+    each doing it themselves
+    """
+
+    def __init__(self):
+        # key: Task
+        self.in_flight = {}
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.in_flight)
+
+    def start(self, key, fn, *args) -> asyncio.Task:
+        """Start `fn(*args)` as a task, or return the one already running for the key"""
+        task = self.in_flight.get(key)
+        if task:
+            self.coalesced += 1
+            return task
+
+        task = asyncio.create_task(fn(*args))
+        self.in_flight[key] = task
+        task.add_done_callback(lambda _: self.finished(key, task))
+
+        return task
+
+    def finished(self, key, task: asyncio.Task):
+        if self.in_flight.get(key) is task:
+            del self.in_flight[key]
+
+        # Anyone waiting still gets the error. This just stops it being logged as never retrieved when nobody is
+        if not task.cancelled():
+            task.exception()
+
+
+class ByteCache:
+    """Bytes cached in memory, with an optional larger tier on disk"""
+
+    def __init__(self, max_bytes: int, disk_dir: str = None, disk_bytes: int = 0):
+        self.memory = LRUCache(max_bytes)
+        self.disk = DiskCache(disk_dir, disk_bytes) if disk_dir else None
+
+    async def get(self, key: str) -> Optional[bytes]:
+        data = self.memory.get(key)
+
+        if data is None and self.disk:
+            data = await asyncio.get_running_loop().run_in_executor(None, self.disk.get, key)
+
+            if data is not None:
+                self.memory.put(key, data)
+
+        return data
+
+    async def put(self, key: str, data: bytes):
+        self.memory.put(key, data)
+
+        if self.disk:
+            await asyncio.get_running_loop().run_in_executor(None, self.disk.put, key, data)
+
+    def stats(self) -> dict:
+        stats = {"memory": self.memory.stats()}
+        if self.disk:
+            stats["disk"] = self.disk.stats()
+
+        return stats
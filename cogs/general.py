@@ -1,11 +1,14 @@
 import aiohttp
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import datetime as dt
 from utils import BOOL_OPTIONS, create_bar
-from config import SPOTIFY_EMOJI, BOOSTER_ROLE, GUILD_ID, PRIMARY, DEBATE_ROLE, DEBATE_BAN_ROLE
+from config import SPOTIFY_EMOJI, BOOSTER_ROLE, GUILD_ID, PRIMARY, DEBATE_ROLE, DEBATE_BAN_ROLE, SETTINGS_WARM_MINUTES
 from math import floor
-from db import db
+from settings import settings
+from pronouns_page import profiles, PronounsPageError
+from cogs.moderation import get_mod_summary
+from cogs.modlogs import summary_text, LOG_TYPE_PRETTY
 
 # Maps to minutes
 DATE_SCALE = {
@@ -21,8 +24,6 @@ BREATHE_GIFS = {
     "gauge": "https://www.duffthepsych.com/wp-content/uploads/2016/07/478Breathe500x500c129revised.gif"
 }
 
-PRONOUNS_PAGE_URL = "https://en.pronouns.page/api/profile/get/{}?version=2"
-
 PRONOUNS_PAGE_BASE_OPINIONS = {
     "yes": "❤️",
     "meh": "👍",
@@ -57,6 +58,21 @@ class General(commands.Cog):
     def __init__(self, bot: discord.Bot):
         self.bot = bot
 
+        self.warm_settings.start()
+
+    def cog_unload(self):
+        self.warm_settings.cancel()
+
+    @tasks.loop(minutes=SETTINGS_WARM_MINUTES)
+    async def warm_settings(self):
+        """Load pronouns.page usernames for people chatting, as they're who the context menu gets used on"""
+        await settings.warm("pronouns_page")
+
+    @discord.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        if message.guild and not message.author.bot:
+            settings.seen(message.author.id)
+
     @discord.slash_command(guild_ids=[GUILD_ID])
     @discord.option("unit", choices=DATE_SCALE.keys())
     async def selfmute(self, ctx: discord.ApplicationContext, time: discord.Option(int), unit: str):
@@ -172,6 +188,11 @@ class General(commands.Cog):
         roles = " ".join([role.mention for role in user.roles[:0:-1]])
         embed.add_field(name=f"Roles [{len(user.roles) - 1}]", value=roles, inline=False)
 
+        # Only mods get to see someone's modlogs
+        if ctx.user.guild_permissions.kick_members:
+            summary = await get_mod_summary(user.id)
+            embed.add_field(name="Modlogs", value=summary_text(summary, list(LOG_TYPE_PRETTY)), inline=False)
+
         embed.set_footer(text=f"User ID: {user.id}")
 
         await ctx.respond(embed=embed)
@@ -181,18 +202,16 @@ class General(commands.Cog):
     @pronouns.command()
     async def set(self, ctx: discord.ApplicationContext, username: str):
         """Set your pronouns.page username"""
-        url = f"https://en.pronouns.page/api/profile/get/{username}?version=2"
-
         await ctx.defer()
 
-        async with self.bot.session.get(url) as response:
-            status_code = response.status
-
-            if status_code != 200:
-                await ctx.respond("pronouns.page cannot be reached", ephemeral=True)
-                return
+        # Also caches the profile for the first view
+        try:
+            await profiles.get(self.bot.session, username)
+        except PronounsPageError:
+            await ctx.respond("pronouns.page cannot be reached", ephemeral=True)
+            return
 
-        await db.settings.update_one({"_id": str(ctx.user.id)}, {"$set": {"pronouns_page": username}}, upsert=True)
+        await settings.set(ctx.user.id, "pronouns_page", username)
 
         await ctx.respond("Username set", ephemeral=True)
 
@@ -213,10 +232,9 @@ class General(commands.Cog):
     async def send_pronouns_profile(self, ctx: discord.ApplicationContext, user: discord.Member, ephemeral=True):
         await ctx.defer(ephemeral=ephemeral)
 
-        entry = await db.settings.find_one({"_id": str(user.id), "pronouns_page": {"$ne": None}},
-                                           projection={"pronouns_page": True})
+        username = await settings.get(user.id, "pronouns_page")
 
-        if not entry:
+        if not username:
             if ctx.user.id == user.id:
                 embed = discord.Embed(colour=PRIMARY, description=self.set.mention)
                 await ctx.respond("You have not setup your pronouns.page profile", embed=embed)
@@ -225,16 +243,11 @@ class General(commands.Cog):
             return
 
         # At this point, the user does have a pronouns.page username set
-        username = entry["pronouns_page"]
-
-        async with self.bot.session.get(PRONOUNS_PAGE_URL.format(username)) as response:
-            status_code = response.status
-
-            if status_code != 200:
-                await ctx.respond("pronouns.page cannot be reached")
-                return
-
-            data = await response.json()
+        try:
+            data = await profiles.get(self.bot.session, username)
+        except PronounsPageError:
+            await ctx.respond("pronouns.page cannot be reached")
+            return
 
         if "en" not in data["profiles"]:
             await ctx.respond("That user does not have an english profile set up")
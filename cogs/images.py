@@ -1,89 +1,41 @@
 import discord
-from discord.ext import commands
-from os import listdir
-from PIL import Image, ImageDraw, ImageFilter, ImageFont
+from discord.ext import commands, tasks
 from io import BytesIO
+from hashlib import sha256
+from typing import Optional
+import asyncio
 from utils import BOOL_OPTIONS
-from config import WELCOME_ID, GUILD_ID
+from config import WELCOME_ID, GUILD_ID, PRIMARY, GREEN, RED, RENDER_POOL, RENDER_WORKERS, PRIDE_ENCODING, \
+    WELCOME_ENCODING, IMAGE_MAX_BYTES, PRIDE_CACHE_BYTES, PRIDE_DISK_CACHE_DIR, PRIDE_DISK_CACHE_BYTES, \
+    COMPOSITING_ENGINE, ANIMATED_AVATARS, ANIMATED_MAX_FRAMES, ANIMATED_MAX_BYTES, ANIMATED_TIME_BUDGET, RAID_WINDOW, \
+    WELCOME_HOLD
+from avatars import avatars, avatar_key
+from cache import ByteCache
+from raids import join_bursts
+from imaging import FLAGS, FLAG_SEPARATORS, WELCOME_BG, LEAVE_BG, RenderPool, render_pride, render_welcome, \
+    load_assets, image_extension, compare_encodings, ENGINES, render_animated_pride, render_animated_welcome
 
-FLAG_DIR = "images/flags/"
 
-FLAGS = []
-for file in listdir(FLAG_DIR):
-    if file.endswith(".png"):
-        FLAGS.append(file[:-4])
+EMBED_DESCRIPTION_MAX = 4096
 
-FLAG_PFP_SIZE = 1024
-FLAG_BLUR = 40
-FLAG_BORDER = 50
 
-FLAG_SEPARATORS = {
-    "vertical": ((FLAG_PFP_SIZE / 2, 0), (FLAG_PFP_SIZE, 0), (FLAG_PFP_SIZE, FLAG_PFP_SIZE), (FLAG_PFP_SIZE / 2),
-                 FLAG_PFP_SIZE),
-    "horizontal": ((0, FLAG_PFP_SIZE / 2), (FLAG_PFP_SIZE, FLAG_PFP_SIZE / 2), (FLAG_PFP_SIZE, FLAG_PFP_SIZE),
-                   (0, FLAG_PFP_SIZE)),
-    "diagonal /": ((FLAG_PFP_SIZE, 0), (FLAG_PFP_SIZE, FLAG_PFP_SIZE), (0, FLAG_PFP_SIZE)),
-    "diagonal \\": ((0, 0), (FLAG_PFP_SIZE, 0), (FLAG_PFP_SIZE, FLAG_PFP_SIZE)),
-}
+def image_to_file(image: bytes, filename: str) -> discord.File:
+    return discord.File(BytesIO(image), filename=filename)
 
-FONT = "Roboto-Regular.ttf"
-FONT_BOLD = "Roboto-Bold.ttf"
-WELCOME_BG = "images/welcomeBG.jpg"
-LEAVE_BG = "images/goodbyeBG.jpg"
 
+def cache_summary(stats: dict) -> str:
+    return "{hits} hits, {misses} misses, {evictions} evictions\n{entries} entries, {mb:.1f}MB".format(
+        mb=stats["bytes"] / 1024 / 1024, **stats)
 
-def image_to_file(image: Image, filename: str) -> discord.File:
-    output = BytesIO()
-    image.save(output, format="png")
-    output.seek(0)
 
-    return discord.File(output, filename=filename)
+def pride_key(avatar: discord.Asset, flag: str, seperator: str, flag_2: str, blur: int, encoding: str) -> str:
+    """Hash of everything that affects a pride image, so identical requests can reuse the output"""
+    # The seperator does nothing without a second flag
+    if not flag_2:
+        seperator = None
 
-
-def make_welcome_image(background: str, pfp: BytesIO, header: str, body: str, footer: str, text_colour: tuple) -> Image:
-    background_img = Image.open(background)
-
-    pfp_img = Image.open(pfp)
-    pfp_img = pfp_img.convert("RGBA")
-    pfp_img = pfp_img.resize((200, 200))
-    pfp_img = circle_crop(pfp_img)
-
-    background_img.paste(pfp_img, (25, 25, 225, 225), pfp_img)
-
-    canvas = ImageDraw.Draw(background_img)
-
-    # PFP Border
-    # Size is pfp_img's size + the width
-    canvas.ellipse((21, 21, 229, 228), outline=(255, 255, 255), width=4)
-
-    # Background border
-    # idk why the border end is -1px off the size
-    canvas.rectangle((0, 0, 699, 249), outline=(0, 0, 0), width=3)
-
-    # Draw text
-
-    header_font = ImageFont.truetype(FONT_BOLD, 35)
-    canvas.text((700 / 1.5, 250 / 3.5), header, text_colour, header_font, "mm")
-
-    body_font = fit_font_width(FONT_BOLD, 60, body, 400)
-    canvas.text((700 / 1.5, 250 / 2), body, text_colour, body_font, "mm")
-
-    footer_font = ImageFont.truetype(FONT, 25)
-    canvas.text((700 / 1.5, 250 / 1.35), footer, text_colour, footer_font, "mm")
-
-    return background_img
-
-
-def fit_font_width(font_path: str, start_size: int, text: str, width: int, step=10) -> ImageFont:
-    """Shrinks the font so the width fits in the given size"""
-    font = ImageFont.truetype(font_path, start_size)
-    size = start_size
-
-    while font.getsize(text)[0] > width:
-        size -= step
-        font = ImageFont.truetype(font_path, size)
-
-    return font
+    options = (avatar_key(avatar), flag, seperator, flag_2, bool(blur), encoding)
+    return sha256(repr(options).encode()).hexdigest()
 
 
 def num_suffix(n: int) -> str:
@@ -93,26 +45,45 @@ def num_suffix(n: int) -> str:
     return str(n) + ("th" if 4 <= n % 100 <= 20 else {1: "st", 2: "nd", 3: "rd"}.get(n % 10, "th"))
 
 
-def circle_crop(image: Image):
-    # A transparent layer to place the image onto
-    base = Image.new("RGBA", image.size, color=0)
-    # Ensure the image is also RGBA
-    image = image.convert("RGBA")
-
-    # Create B&W image to be used as the composite mask
-    mask_img = Image.new("L", image.size, color=0)
-    mask_draw = ImageDraw.Draw(mask_img)
-    # Create the circular mask in white
-    mask_draw.ellipse((0, 0, image.size[0], image.size[1]), fill=255)
-
-    # Apply the composite
-    return Image.composite(image, base, mask_img)
+def more_line(count: int) -> str:
+    return f"…and {count} more"
 
 
 class Images(commands.Cog):
     def __init__(self, bot: discord.Bot):
         self.bot = bot
 
+        # Thread workers share this process's assets, so decode the flags and masks up front. Spawned worker
+        # processes load their own copy in the pool initializer, and one here would go unused
+        if RENDER_POOL == "thread":
+            load_assets()
+
+        # Pillow work is CPU bound, so keep it off the event loop
+        self.renderer = RenderPool(RENDER_POOL, RENDER_WORKERS, COMPOSITING_ENGINE)
+
+        # Finished pride images - People often rerun the command with the same options
+        self.pride_cache = ByteCache(PRIDE_CACHE_BYTES, PRIDE_DISK_CACHE_DIR, PRIDE_DISK_CACHE_BYTES)
+
+        self.animated_renders = 0
+        self.animated_fallbacks = 0
+
+        # Members who joined or left during a raid, to be listed in one message instead of individual cards
+        self.batched_joins = []
+        self.batched_leaves = []
+
+        # member_id: task waiting to send their welcome card
+        self.held_welcomes = {}
+        self.short_stays = 0
+        self.renders_avoided = 0
+
+        self.send_batch_summary.start()
+
+    def cog_unload(self):
+        self.send_batch_summary.cancel()
+        for task in self.held_welcomes.values():
+            task.cancel()
+        self.renderer.shutdown()
+
     @discord.slash_command()
     @discord.option("flag", choices=FLAGS)
     @discord.option("seperator", description="How your two flags will be positioned",
@@ -127,73 +98,230 @@ class Images(commands.Cog):
             await ctx.respond("To use 2 flags, you must specify the `seperator`", ephemeral=True)
             return
 
-        # Load profile picture as a gif
-        pfp = await ctx.user.display_avatar.with_static_format("png").read()
-        # Load the pfp into PIL
-        pfp = Image.open(BytesIO(pfp))
-        # Resize pfp to standardised size, taking into account the border width
-        pfp = pfp.resize((FLAG_PFP_SIZE - FLAG_BORDER * 2, FLAG_PFP_SIZE - FLAG_BORDER * 2))
-        # Prevent colour mode errors
-        pfp = pfp.convert("RGBA")
-
-        # Load and resize the flags
-        background = Image.open(FLAG_DIR + flag + ".png")
-        background = background.resize((FLAG_PFP_SIZE, FLAG_PFP_SIZE))
+        # Rendering can take a while if the pool is busy
+        await ctx.defer()
 
-        if flag_2:
-            overlay_flag = Image.open(FLAG_DIR + flag_2 + ".png")
-            overlay_flag = overlay_flag.resize((FLAG_PFP_SIZE, FLAG_PFP_SIZE))
+        animated = ANIMATED_AVATARS and ctx.user.display_avatar.is_animated()
 
-            # Produce mask
-            # Create B&W image to be used as the composite mask
-            mask_img = Image.new("L", (FLAG_PFP_SIZE, FLAG_PFP_SIZE), color=0)
-            mask_draw = ImageDraw.Draw(mask_img)
+        if animated:
+            avatar = ctx.user.display_avatar.with_format("gif")
+            encoding = "animated"
+        else:
+            avatar = ctx.user.display_avatar.with_static_format("png")
+            encoding = PRIDE_ENCODING
 
-            # Draw the selected seperator in white onto the mask
-            mask_poly = FLAG_SEPARATORS[seperator]
-            mask_draw.polygon(mask_poly, fill=255)
+        key = pride_key(avatar, flag, seperator, flag_2, blur, encoding)
+        image = await self.pride_cache.get(key)
 
-            # Apply the mask
-            background = Image.composite(overlay_flag, background, mask_img)
+        if image is None:
+            pfp = await avatars.read(avatar)
 
-        # Apply blur
-        if blur:
-            background = background.filter(ImageFilter.GaussianBlur(FLAG_BLUR))
+            if animated:
+                image = await self.render_animated(render_animated_pride, pfp, flag, seperator, flag_2, blur)
 
-        # Crop profile picture to a circle
-        pfp = circle_crop(pfp)
+            # Static images use the first frame of animated avatars
+            if image is None:
+                image = await self.renderer.run(render_pride, pfp, flag, seperator, flag_2, blur, PRIDE_ENCODING,
+                                                IMAGE_MAX_BYTES)
 
-        # Combine images
-        background.paste(pfp, (FLAG_BORDER, FLAG_BORDER, FLAG_PFP_SIZE - FLAG_BORDER, FLAG_PFP_SIZE - FLAG_BORDER), pfp)
+            # A fallback is cached too, so retries don't attempt the animation again
+            await self.pride_cache.put(key, image)
 
         # Save the byte stream and send in chat
-        await ctx.respond(file=image_to_file(background, filename="pride.png"))
+        await ctx.respond(file=image_to_file(image, filename="pride." + image_extension(image)))
+
+    async def render_animated(self, fn, *args) -> Optional[bytes]:
+        """Runs an animated render, returning None if a static image should be used instead"""
+        image = await self.renderer.run(fn, *args, ANIMATED_MAX_FRAMES, ANIMATED_MAX_BYTES, ANIMATED_TIME_BUDGET)
+
+        if image is None:
+            self.animated_fallbacks += 1
+        else:
+            self.animated_renders += 1
+
+        return image
+
+    async def send_welcome_card(self, member: discord.Member, background: str, header: str, footer: str,
+                                text_colour: tuple, filename: str):
+        # Animated avatars are downloaded as gifs
+        pfp = await avatars.read(member.display_avatar)
+        args = (background, pfp, header, member.display_name, footer, text_colour)
+
+        image = None
+        if ANIMATED_AVATARS and member.display_avatar.is_animated():
+            image = await self.render_animated(render_animated_welcome, *args)
+
+        if image is None:
+            image = await self.renderer.run(render_welcome, *args, WELCOME_ENCODING, IMAGE_MAX_BYTES)
+
+        channel = self.bot.get_channel(WELCOME_ID)
+        await channel.send(file=image_to_file(image, filename + "." + image_extension(image)))
+
+    @tasks.loop(seconds=RAID_WINDOW)
+    async def send_batch_summary(self):
+        # Also lets batch mode end if joins have stopped
+        join_bursts.update()
+
+        if not self.batched_joins and not self.batched_leaves:
+            return
+
+        channel = self.bot.get_channel(WELCOME_ID)
+
+        for members, title, colour in ((self.batched_joins, "Welcome", GREEN), (self.batched_leaves, "Goodbye", RED)):
+            if not members:
+                continue
+
+            embed = discord.Embed(colour=colour, title=f"{title} to {len(members)} members", description="")
+            for index, name in enumerate(members):
+                # Leaving room to say how many didn't fit, which the previous name made sure of
+                line = name + "\n"
+                remaining = len(members) - index - 1
+                more = more_line(remaining) if remaining else ""
+                if len(embed.description) + len(line) + len(more) > EMBED_DESCRIPTION_MAX:
+                    embed.description += more_line(remaining + 1)
+                    break
+
+                embed.description += line
+
+            await channel.send(embed=embed)
+            members.clear()
+
+    @send_batch_summary.before_loop
+    async def before_batch_summary(self):
+        await self.bot.wait_until_ready()
 
     @discord.Cog.listener()
     async def on_member_join(self, member: discord.Member):
         if member.guild.id != GUILD_ID:
             return
 
-        pfp = BytesIO(await member.display_avatar.read())
+        if join_bursts.record_join(member.id):
+            # Raid - No card for each member, they'll be listed in the next summary
+            self.batched_joins.append(member.display_name)
+            return
 
-        image = make_welcome_image(WELCOME_BG, pfp, "Welcome", member.display_name,
-                                   f"You are our {num_suffix(member.guild.member_count)} member!", (0, 0, 0))
+        # Work out their number now, before anyone else joins or leaves
+        footer = f"You are our {num_suffix(member.guild.member_count)} member!"
 
-        channel = self.bot.get_channel(WELCOME_ID)
-        await channel.send(file=image_to_file(image, "welcome.png"))
+        if not WELCOME_HOLD:
+            await self.send_welcome_card(member, WELCOME_BG, "Welcome", footer, (0, 0, 0), "welcome")
+            return
+
+        # Spam accounts often leave within seconds, so hold off in case there's no need for either card
+        self.held_welcomes[member.id] = asyncio.create_task(self.hold_welcome(member, footer))
+
+    async def hold_welcome(self, member: discord.Member, footer: str):
+        try:
+            await asyncio.sleep(WELCOME_HOLD)
+        finally:
+            self.held_welcomes.pop(member.id, None)
+
+        # A raid may have started while they were held - List them in the summary like the others
+        if join_bursts.update():
+            self.batched_joins.append(member.display_name)
+            return
+
+        await self.send_welcome_card(member, WELCOME_BG, "Welcome", footer, (0, 0, 0), "welcome")
 
     @discord.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
         if member.guild.id != GUILD_ID:
             return
 
-        pfp = BytesIO(await member.display_avatar.read())
+        held = self.held_welcomes.pop(member.id, None)
+        if held is not None:
+            # Left before their welcome was sent - Skip both cards
+            held.cancel()
+            self.short_stays += 1
+            self.renders_avoided += 2
+            return
 
-        image = make_welcome_image(LEAVE_BG, pfp, "Goodbye", member.display_name, f"We will miss you :(",
-                                   (255, 255, 255))
+        if join_bursts.update():
+            self.batched_leaves.append(member.display_name)
+            return
 
-        channel = self.bot.get_channel(WELCOME_ID)
-        await channel.send(file=image_to_file(image, "goodbye.png"))
+        await self.send_welcome_card(member, LEAVE_BG, "Goodbye", f"We will miss you :(", (255, 255, 255),
+                                     "goodbye")
+
+    @commands.command()
+    @commands.is_owner()
+    async def renderstats(self, ctx: commands.Context):
+        """
+        Show how busy the image render pool is
+        """
+        embed = discord.Embed(colour=PRIMARY, title="Render Pool")
+        embed.description = f"**Mode:** {self.renderer.mode} ({self.renderer.workers} workers, " \
+                            f"{self.renderer.restarts} restarts)\n" \
+                            f"**Engine:** {self.renderer.engine}\n" \
+                            f"**Animated:** {self.animated_renders} rendered, {self.animated_fallbacks} fell back " \
+                            f"to static\n" \
+                            f"**Short stays:** {self.short_stays} ({self.renders_avoided} renders avoided, " \
+                            f"{len(self.held_welcomes)} held)\n" \
+                            f"**In flight:** {self.renderer.in_flight}\n" \
+                            f"**Queue depth:** {self.renderer.queue_depth}\n" \
+                            f"**Peak in flight:** {self.renderer.peak_in_flight}\n" \
+                            f"**Asset cache:** {self.renderer.asset_memory() / 1024 / 1024:.1f}MB " \
+                            f"(across {len(self.renderer.worker_stats)} worker processes)"
+
+        for name, stats in self.renderer.stats.items():
+            embed.add_field(name=name, value=stats.summary(), inline=False)
+
+        for name, stats in self.renderer.cache_stats().items():
+            embed.add_field(name=f"{name} cache", value=cache_summary(stats), inline=False)
+
+        pride_stats = self.pride_cache.stats()
+        embed.add_field(name="pride result cache", value=cache_summary(pride_stats["memory"]), inline=False)
+        if "disk" in pride_stats:
+            embed.add_field(name="pride result disk cache", value=cache_summary(pride_stats["disk"]), inline=False)
+
+        avatar_stats = avatars.stats()
+        embed.add_field(name="avatar cache",
+                        value=cache_summary(avatar_stats["memory"]) + f"\n{avatar_stats['coalesced']} coalesced",
+                        inline=False)
+        if "disk" in avatar_stats:
+            embed.add_field(name="avatar disk cache", value=cache_summary(avatar_stats["disk"]), inline=False)
+
+        encodings = ""
+        for name, stats in self.renderer.encode_stats().items():
+            encodings += "**{}:** {} encodes, avg {:.0f}ms, {:.0f}KB ({} shrunk to fit)\n".format(
+                name, stats["count"], stats["seconds"] / stats["count"] * 1000,
+                stats["bytes"] / stats["count"] / 1024, stats["shrunk"])
+        if encodings:
+            embed.add_field(name="Encodings", value=encodings, inline=False)
+
+        await ctx.send(embed=embed)
+
+    @commands.command()
+    @commands.is_owner()
+    async def renderengine(self, ctx: commands.Context, engine: str):
+        """
+        Switch how pfps are composited, for comparing them in ?renderstats
+        """
+        if engine not in ENGINES:
+            await ctx.send("Available engines: " + ", ".join(ENGINES))
+            return
+
+        self.renderer.engine = engine
+        await ctx.send(f"Now rendering with {engine}")
+
+    @commands.command()
+    @commands.is_owner()
+    async def encodetest(self, ctx: commands.Context):
+        """
+        Encode sample images using your pfp with every encoding, to compare their speed and size
+        """
+        pfp = await avatars.read(ctx.author.display_avatar.with_static_format("png"))
+        results = await self.renderer.run(compare_encodings, pfp)
+
+        embed = discord.Embed(colour=PRIMARY, title="Encoding Comparison")
+        for name, encodings in results.items():
+            value = ""
+            for encoding, (seconds, size) in encodings.items():
+                value += f"**{encoding}:** {seconds * 1000:.0f}ms, {size / 1024:.0f}KB\n"
+
+            embed.add_field(name=name, value=value, inline=False)
+
+        await ctx.send(embed=embed)
 
 
 def setup(bot):
@@ -1,5 +1,6 @@
 import discord
-from db import db, use_counter
+from discord.ext import tasks, commands
+from storage import storage, use_counter
 import datetime as dt
 from utils import seconds_to_pretty
 from config import GUILD_ID, BAN_APPEAL_LINK, PING_PERM_ROLE, STAFF_COMMANDS_ID
@@ -85,24 +86,67 @@ async def insert_modlog(user: discord.Member, mod: Optional[discord.Member], log
 
     data = {
         "case": case_number,
-        "user": str(user.id),
-        "mod": str(mod.id) if mod else None,
+        "user": user.id,
+        "mod": mod.id if mod else None,
         "type": log_type,
         "duration": duration,
         "reason": reason,
         "timestamp": dt.datetime.utcnow(),
     }
 
-    await db.mod_logs.insert_one(data)
+    await storage.insert_case(data)
+    await storage.add_to_summary(data, dt.datetime.utcnow() - TIER_EXPIRATION)
 
     return data
 
 
+async def remove_from_summary(case: dict):
+    await storage.remove_from_summary(case, dt.datetime.utcnow() - TIER_EXPIRATION)
+
+
+async def get_mod_summary(user_id: int) -> dict:
+    """
+    Case counts for a user. "counts" is all cases by type, "active" is unexpired cases by type
+    """
+    cutoff = dt.datetime.utcnow() - TIER_EXPIRATION
+    summary = await storage.get_summary(user_id, cutoff)
+
+    active = {}
+    for case in summary["active"]:
+        if case["timestamp"] > cutoff:
+            active[case["type"]] = active.get(case["type"], 0) + 1
+
+    return {"counts": summary["counts"], "active": active}
+
+
+async def rebuild_summaries():
+    """Recalculate every user's summary from their cases, in case they've drifted"""
+    await storage.rebuild_summaries(dt.datetime.utcnow() - TIER_EXPIRATION)
+
+
 class Moderation(discord.Cog):
     def __init__(self, bot: discord.Bot):
         self.bot = bot
         self.command_bans = []
 
+        self.build_summaries.start()
+
+    @tasks.loop(count=1)
+    async def build_summaries(self):
+        """Make the case summaries the first time the bot runs with them"""
+        if await storage.summaries_empty():
+            print("Building modlog summaries")
+            await rebuild_summaries()
+
+    @commands.command()
+    @commands.is_owner()
+    async def rebuildsummaries(self, ctx: commands.Context):
+        """
+        Recalculate every user's modlog summary from their cases
+        """
+        await rebuild_summaries()
+        await ctx.send("Summaries rebuilt")
+
     @discord.slash_command(guild_ids=[GUILD_ID])
     @discord.default_permissions(kick_members=True)
     async def warn(self, ctx: discord.ApplicationContext, user: discord.Member, reason: str):
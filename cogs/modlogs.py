@@ -1,12 +1,29 @@
 import discord
-from db import db
-from cogs.moderation import mod_case_embed, can_moderate_user, TIER_EXPIRATION
-from utils import seconds_to_pretty
+from discord.ext import tasks, commands
+from storage import storage, SearchTimeout
+from typing import Callable, Optional
+import asyncio
+import csv
+import gzip
+import io
+import json
+import tempfile
+import time
+from cogs.moderation import mod_case_embed, can_moderate_user, TIER_EXPIRATION, get_mod_summary, remove_from_summary
+from utils import seconds_to_pretty, BOOL_OPTIONS
 import datetime as dt
-from config import GUILD_ID
+from config import GUILD_ID, EXPORT_BATCH_SIZE, EXPORT_MAX_BYTES, SEARCH_MAX_TIME_MS, ARCHIVE_AFTER_DAYS, \
+    ARCHIVE_BATCH_SIZE
 
 EMBED_FIELD_LIMIT = 25
 COLOUR = 0xff0000
+PAGE_TIMEOUT = 10 * 60
+
+EXPORT_FIELDS = ["case", "user", "mod", "type", "duration", "reason", "timestamp"]
+EXPORT_PROGRESS_SECONDS = 3
+
+# Search results include who the case is for, so fewer fit in an embed
+SEARCH_PAGE_SIZE = 10
 
 
 LOG_TYPE_PRETTY = {
@@ -17,150 +34,435 @@ LOG_TYPE_PRETTY = {
 }
 
 
-class Modlogs(discord.Cog):
-    def __init__(self, bot: discord.Bot):
-        self.bot = bot
+def summary_text(summary: dict, types: list) -> str:
+    """Lists the active and total cases of each type, eg. 1 warning, 2 mutes"""
+    def counts(by_type: dict) -> str:
+        return ", ".join(f"{by_type[log_type]} {LOG_TYPE_PRETTY[log_type]}{'s' if by_type[log_type] != 1 else ''}"
+                         for log_type in types if by_type.get(log_type))
 
-    @discord.slash_command(guild_ids=[GUILD_ID])
-    @discord.default_permissions(kick_members=True)
-    async def modlogs(self, ctx: discord.ApplicationContext, user: discord.Member):
-        """Displays a user's modlogs"""
-        await ctx.defer()
+    return "**Active:** {}\n**Total:** {}".format(counts(summary["active"]) or "None",
+                                                  counts(summary["counts"]) or "None")
 
-        case_count = await db.mod_logs.count_documents({"user": str(user.id)})
-        cases = db.mod_logs.find({"user": str(user.id)}).sort("case", 1)
 
-        # Only get the last 25 entries
-        if case_count > EMBED_FIELD_LIMIT:
-            cases = cases.skip(case_count - EMBED_FIELD_LIMIT)
+def is_expired(case: dict) -> bool:
+    return dt.datetime.utcnow() - case["timestamp"] >= TIER_EXPIRATION
 
-        embed = discord.Embed(colour=COLOUR)
-        embed.title = f"Modlogs for {user.name}:"
 
-        embed.set_author(name=user.display_name, icon_url=user.display_avatar.url)
+def modlog_field(case: dict) -> tuple:
+    title = "Case #{} | {}".format(case["case"], LOG_TYPE_PRETTY[case["type"]].title())
+    description = ""
 
-        if case_count > 0:
-            async for case in cases:
-                title = "Case #{} | {}".format(case["case"], LOG_TYPE_PRETTY[case["type"]].title())
-                description = ""
+    if case["type"] != "note" and is_expired(case):
+        description += "**--EXPIRED--**\n"
 
-                if case["type"] != "note":
-                    timestamp = case["timestamp"]
-                    if dt.datetime.utcnow() - timestamp >= TIER_EXPIRATION:
-                        description += "**--EXPIRED--**\n"
+    if case["type"] == "note":
+        description += "**Note:** {}\n".format(case["reason"])
+    else:
+        description += "**Reason:** {}\n".format(case["reason"])
 
-                if case["type"] == "note":
-                    description += "**Note:** {}\n".format(case["reason"])
-                else:
-                    description += "**Reason:** {}\n".format(case["reason"])
+    if case["duration"]:
+        description += "**Length:** {}\n".format(seconds_to_pretty(case["duration"]))
 
-                if case["duration"]:
-                    description += "**Length:** {}\n".format(seconds_to_pretty(case["duration"]))
+    description += "**Date:** {}\n".format(discord.utils.format_dt(case["timestamp"], "F"))
 
-                description += "**Date:** {}\n".format(discord.utils.format_dt(case["timestamp"], "F"))
+    if case["mod"]:
+        description += "**Moderator:** <@{}>\n".format(case["mod"])
 
-                if case["mod"]:
-                    description += "**Moderator:** <@{}>\n".format(case["mod"])
+    return title, description
 
-                embed.add_field(name=title, value=description, inline=False)
 
-            if case_count > EMBED_FIELD_LIMIT:
-                # TODO - Paginate?
-                embed.set_footer(text=f"{case_count - EMBED_FIELD_LIMIT} older cases were omitted")
-        else:
-            embed.description = "This user has no associated logs"
+def note_field(case: dict) -> tuple:
+    title = "Case #" + str(case["case"])
 
-        await ctx.respond(embed=embed)
+    description = "**Note:** {}\n".format(case["reason"])
 
-    @discord.slash_command(guild_ids=[GUILD_ID])
-    @discord.default_permissions(kick_members=True)
-    async def viewnotes(self, ctx: discord.ApplicationContext, user: discord.User):
-        """View all mod notes associated with a user"""
-        await ctx.defer()
+    description += "**Date:** {}\n".format(discord.utils.format_dt(case["timestamp"], "F"))
+    description += "**Moderator:** <@{}>\n".format(case["mod"])
+
+    return title, description
+
+
+def own_modlog_field(case: dict) -> tuple:
+    """Doesn't show who the moderator was"""
+    title = "Case #{} | {}".format(case["case"], LOG_TYPE_PRETTY[case["type"]].title())
+    description = ""
+
+    if is_expired(case):
+        description += "**--EXPIRED--**\n"
+
+    description += "**Reason:** {}\n".format(case["reason"])
+
+    if case["duration"]:
+        description += "**Length:** {}\n".format(seconds_to_pretty(case["duration"]))
+
+    description += "**Date:** {}\n".format(discord.utils.format_dt(case["timestamp"], "F"))
+
+    return title, description
+
+
+async def archive_old_cases() -> int:
+    """
+    Move cases older than ARCHIVE_AFTER_DAYS into the archive. Notes don't expire, so they stay where they are. Returns
+    how many were moved
+    """
+    cutoff = dt.datetime.utcnow() - dt.timedelta(days=ARCHIVE_AFTER_DAYS)
+    return await storage.archive_cases(cutoff, ARCHIVE_BATCH_SIZE)
 
-        query = {
-            "user": str(user.id),
-            "type": "note",
-        }
 
-        case_count = await db.mod_logs.count_documents(query)
-        cases = db.mod_logs.find(query).sort("case", 1)
+def case_pages(filters: dict, archived: bool = False) -> Callable:
+    """
+    Pages through the cases matching the filters, newest first. Each page carries on from the last case seen rather
+    than skipping, so every page is a single indexed lookup no matter how long someone's history is
+    """
+    async def fetch_page(before: Optional[int]) -> tuple:
+        # One extra to tell if there's another page
+        cases = await storage.case_page(before, EMBED_FIELD_LIMIT + 1, archived, **filters)
 
-        # Only get the last 25 entries
-        if case_count > EMBED_FIELD_LIMIT:
-            cases = cases.skip(case_count - EMBED_FIELD_LIMIT)
+        next_token = None
+        if len(cases) > EMBED_FIELD_LIMIT:
+            cases = cases[:EMBED_FIELD_LIMIT]
+            next_token = cases[-1]["case"]
 
-        embed = discord.Embed(colour=COLOUR)
-        embed.title = f"Mod Notes for {user.name}:"
+        return cases, next_token
 
-        embed.set_author(name=user.display_name, icon_url=user.display_avatar.url)
+    return fetch_page
 
-        if case_count > 0:
-            async for case in cases:
-                title = "Case #" + str(case["case"])
 
-                description = "**Note:** {}\n".format(case["reason"])
+def search_pages(filters: dict, search: str) -> Callable:
+    """
+    Pages through cases whose reason matches the search, best match first. Carries on from the (score, case) of the
+    last result seen, like case_pages does with case numbers
+    """
+    async def fetch_page(after: Optional[tuple]) -> tuple:
+        cases = await storage.search_cases(search, after, SEARCH_PAGE_SIZE + 1, SEARCH_MAX_TIME_MS, **filters)
 
-                description += "**Date:** {}\n".format(discord.utils.format_dt(case["timestamp"], "F"))
-                description += "**Moderator:** <@{}>\n".format(case["mod"])
+        next_token = None
+        if len(cases) > SEARCH_PAGE_SIZE:
+            cases = cases[:SEARCH_PAGE_SIZE]
+            next_token = (cases[-1]["score"], cases[-1]["case"])
 
-                embed.add_field(name=title, value=description, inline=False)
+        return cases, next_token
 
-            if case_count > EMBED_FIELD_LIMIT:
-                # TODO - Paginate?
-                embed.set_footer(text=f"{case_count - EMBED_FIELD_LIMIT} older notes were omitted")
+    return fetch_page
+
+
+def search_field(case: dict) -> tuple:
+    title, description = modlog_field(case)
+    return title, "**User:** <@{}>\n".format(case["user"]) + description
+
+
+def date_range(start: Optional[str], end: Optional[str]) -> dict:
+    """Case filters for between two YYYY-MM-DD dates. Raises ValueError if they aren't valid dates"""
+    filters = {}
+    if start:
+        filters["start"] = dt.datetime.strptime(start, "%Y-%m-%d")
+    if end:
+        filters["end"] = dt.datetime.strptime(end, "%Y-%m-%d")
+
+    return filters
+
+
+def export_row(case: dict) -> dict:
+    row = {field: case.get(field) for field in EXPORT_FIELDS}
+    row["timestamp"] = row["timestamp"].isoformat()
+    return row
+
+
+async def export_cases(filters: dict, sort: str, file_format: str, file, progress: Callable,
+                       archived: bool = False) -> int:
+    """
+    Write every matching case to a gzipped file a batch at a time, so only one batch is ever in memory. Calls
+    progress(cases written) every few seconds. Returns the number of cases
+    """
+    with gzip.GzipFile(fileobj=file, mode="wb") as compressed, \
+            io.TextIOWrapper(compressed, encoding="utf-8", newline="") as text:
+        if file_format == "csv":
+            writer = csv.DictWriter(text, EXPORT_FIELDS)
+            writer.writeheader()
+            write = writer.writerow
         else:
-            embed.description = "This user has no associated notes"
+            def write(row: dict):
+                text.write(json.dumps(row) + "\n")
 
-        await ctx.respond(embed=embed)
+        count = 0
+        last_progress = time.monotonic()
+
+        async for case in storage.iter_cases(sort, EXPORT_BATCH_SIZE, archived, **filters):
+            write(export_row(case))
+            count += 1
+
+            if time.monotonic() - last_progress >= EXPORT_PROGRESS_SECONDS:
+                last_progress = time.monotonic()
+                await progress(count)
+
+    return count
+
+
+class CasePages(discord.ui.View):
+    def __init__(self, user: Optional[discord.abc.User], fetch_page: Callable, format_case: Callable, title: str,
+                 empty_text: str, viewer: discord.abc.User, description: str = None):
+        super().__init__(timeout=PAGE_TIMEOUT, disable_on_timeout=True)
+        self.description = description
+        self.user = user
+        self.fetch_page = fetch_page
+        self.format_case = format_case
+        self.title = title
+        self.empty_text = empty_text
+        self.viewer = viewer
+
+        # Pages already loaded, so going back doesn't need the database. Each is (cases, next_token)
+        self.pages = []
+        self.page = 0
+        self.prefetch = None
+        # Held while changing page, so quick clicks can't load the same page twice
+        self.changing_page = asyncio.Lock()
+
+    async def start(self, ctx: discord.ApplicationContext):
+        self.pages.append(await self.fetch_page(None))
+        self.prefetch_next()
+
+        await ctx.respond(embed=self.make_embed(), view=self.update_buttons())
+
+    def prefetch_next(self):
+        """Start loading the page after the current one while they're reading this one"""
+        _cases, next_token = self.pages[self.page]
+
+        if next_token is not None and self.page + 1 == len(self.pages) and self.prefetch is None:
+            self.prefetch = asyncio.create_task(self.fetch_page(next_token))
+            # Retrieve any error, so it isn't logged as never retrieved if they don't click next. It's dealt with
+            # in load_next_page() if they do
+            self.prefetch.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    async def load_next_page(self) -> tuple:
+        prefetch, self.prefetch = self.prefetch, None
+
+        if prefetch:
+            try:
+                return await prefetch
+            except Exception as error:
+                print(f"Prefetching the next modlogs page failed, trying again: {error!r}")
+
+        _cases, next_token = self.pages[-1]
+        return await self.fetch_page(next_token)
+
+    def make_embed(self) -> discord.Embed:
+        cases, next_token = self.pages[self.page]
+
+        embed = discord.Embed(colour=COLOUR, title=self.title, description=self.description)
+        if self.user:
+            embed.set_author(name=self.user.display_name, icon_url=self.user.display_avatar.url)
+
+        if not cases:
+            embed.description = self.empty_text
+            return embed
+
+        for case in cases:
+            title, description = self.format_case(case)
+            embed.add_field(name=title, value=description, inline=False)
+
+        if self.page > 0 or next_token is not None:
+            embed.set_footer(text=f"Page {self.page + 1}" + (" - Older cases on the next page" if next_token else ""))
+
+        return embed
+
+    def update_buttons(self) -> Optional["CasePages"]:
+        _cases, next_token = self.pages[self.page]
+
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = next_token is None
+
+        # No need for buttons if everything fits on one page
+        if self.previous_page.disabled and self.next_page.disabled:
+            self.stop()
+            return None
+
+        return self
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return interaction.user.id == self.viewer.id
+
+    @discord.ui.button(emoji="\u25c0\ufe0f", style=discord.ButtonStyle.grey)
+    async def previous_page(self, _button: discord.Button, interaction: discord.Interaction):
+        async with self.changing_page:
+            self.page = max(self.page - 1, 0)
+            await interaction.response.edit_message(embed=self.make_embed(), view=self.update_buttons())
+
+    @discord.ui.button(emoji="\u25b6\ufe0f", style=discord.ButtonStyle.grey)
+    async def next_page(self, _button: discord.Button, interaction: discord.Interaction):
+        async with self.changing_page:
+            _cases, next_token = self.pages[self.page]
+            if next_token is None:
+                # A second click that arrived before the first one disabled the button
+                await interaction.response.defer()
+                return
+
+            if self.page + 1 == len(self.pages):
+                # Usually already loaded by now
+                try:
+                    self.pages.append(await self.load_next_page())
+                except SearchTimeout:
+                    await interaction.response.send_message("The search took too long, try adding some filters",
+                                                            ephemeral=True)
+                    return
+
+            self.page += 1
+            self.prefetch_next()
+
+            await interaction.response.edit_message(embed=self.make_embed(), view=self.update_buttons())
+
+
+class Modlogs(discord.Cog):
+    def __init__(self, bot: discord.Bot):
+        self.bot = bot
+
+        self.archive_cases.start()
+
+    def cog_unload(self):
+        self.archive_cases.cancel()
+
+    @tasks.loop(hours=24)
+    async def archive_cases(self):
+        moved = await archive_old_cases()
+        if moved:
+            print(f"Archived {moved} old cases")
+
+    @commands.command()
+    @commands.is_owner()
+    async def archivestats(self, ctx: commands.Context):
+        """
+        Show how many cases have been archived
+        """
+        embed = discord.Embed(colour=COLOUR, title="Case Archive")
+        for name, stats in (await storage.case_stats()).items():
+            embed.add_field(name=name, value=f"{stats['count']} cases\n"
+                                             f"{stats['storage_bytes'] / 1024:.0f}KB stored\n"
+                                             f"{stats['index_bytes'] / 1024:.0f}KB of indexes")
+
+        await ctx.send(embed=embed)
+
+    @discord.slash_command(guild_ids=[GUILD_ID])
+    @discord.default_permissions(kick_members=True)
+    @discord.option("archived", description="Include old cases from the archive", choices=BOOL_OPTIONS, default=0)
+    async def modlogs(self, ctx: discord.ApplicationContext, user: discord.Member, archived: int):
+        """Displays a user's modlogs"""
+        await ctx.defer()
+
+        summary = summary_text(await get_mod_summary(user.id), list(LOG_TYPE_PRETTY))
+
+        pages = CasePages(user, case_pages({"user": user.id}, bool(archived)), modlog_field,
+                          f"Modlogs for {user.name}:", "This user has no associated logs", ctx.author, summary)
+        await pages.start(ctx)
+
+    @discord.slash_command(guild_ids=[GUILD_ID])
+    @discord.default_permissions(kick_members=True)
+    async def viewnotes(self, ctx: discord.ApplicationContext, user: discord.User):
+        """View all mod notes associated with a user"""
+        await ctx.defer()
+
+        filters = {
+            "user": user.id,
+            "log_type": "note",
+        }
+
+        pages = CasePages(user, case_pages(filters), note_field, f"Mod Notes for {user.name}:",
+                          "This user has no associated notes", ctx.author)
+        await pages.start(ctx)
 
     @discord.slash_command()
     async def mymodlogs(self, ctx: discord.ApplicationContext):
         """Display the tiers you have received"""
         await ctx.defer(ephemeral=True)
 
-        query = {
-            "user": str(ctx.author.id),
-            "type": {"$ne": "note"},
+        filters = {
+            "user": ctx.author.id,
+            "exclude_type": "note",
         }
 
-        case_count = await db.mod_logs.count_documents(query)
-        cases = db.mod_logs.find(query).sort("case", 1)
+        # Notes aren't shown to the user
+        summary = summary_text(await get_mod_summary(ctx.author.id), ["warn", "timeout", "ban"])
+
+        pages = CasePages(ctx.author, case_pages(filters), own_modlog_field, f"Modlogs for {ctx.author.name}:",
+                          "This user has no associated logs", ctx.author, summary)
+        await pages.start(ctx)
+
+    @discord.slash_command(guild_ids=[GUILD_ID])
+    @discord.default_permissions(kick_members=True)
+    @discord.option("user", description="Only export this user's cases", required=False)
+    @discord.option("start", description="Only export cases from this date (YYYY-MM-DD)", required=False)
+    @discord.option("end", description="Only export cases before this date (YYYY-MM-DD)", required=False)
+    @discord.option("file_format", choices=["jsonl", "csv"], default="jsonl")
+    @discord.option("archived", description="Include old cases from the archive", choices=BOOL_OPTIONS, default=0)
+    async def exportmodlogs(self, ctx: discord.ApplicationContext, user: discord.User, start: str, end: str,
+                            file_format: str, archived: int):
+        """Download every case for a user, or every case in a date range"""
+        if not user and not start:
+            await ctx.respond("Choose a user, or a start date to export the whole server's cases", ephemeral=True)
+            return
+
+        try:
+            filters = date_range(start, end)
+        except ValueError:
+            await ctx.respond("Dates should be written like 2023-01-31", ephemeral=True)
+            return
 
-        # Only get the last 25 entries
-        if case_count > EMBED_FIELD_LIMIT:
-            cases = cases.skip(case_count - EMBED_FIELD_LIMIT)
+        if user:
+            filters["user"] = user.id
 
-        embed = discord.Embed(colour=COLOUR)
-        embed.title = f"Modlogs for {ctx.author.name}:"
+        await ctx.defer()
 
-        embed.set_author(name=ctx.author.display_name, icon_url=ctx.author.display_avatar.url)
+        total = await storage.count_cases(bool(archived), **filters)
+        if total == 0:
+            await ctx.respond("No cases to export")
+            return
 
-        if case_count > 0:
-            async for case in cases:
-                title = "Case #{} | {}".format(case["case"], LOG_TYPE_PRETTY[case["type"]].title())
-                description = ""
+        async def progress(count: int):
+            await ctx.edit(content=f"Exporting... {count}/{total} cases")
 
-                timestamp = case["timestamp"]
-                if dt.datetime.utcnow() - timestamp >= TIER_EXPIRATION:
-                    description += "**--EXPIRED--**\n"
+        # A user's cases come from their index in case order, anything else goes by date
+        sort = "case" if user else "timestamp"
 
-                description += "**Reason:** {}\n".format(case["reason"])
+        with tempfile.TemporaryFile() as file:
+            count = await export_cases(filters, sort, file_format, file, progress, bool(archived))
 
-                if case["duration"]:
-                    description += "**Length:** {}\n".format(seconds_to_pretty(case["duration"]))
+            if file.tell() > EXPORT_MAX_BYTES:
+                await ctx.edit(content=f"The export is too large to upload ({file.tell() / 1024 / 1024:.1f}MB), "
+                                       f"try a smaller date range")
+                return
 
-                description += "**Date:** {}\n".format(discord.utils.format_dt(timestamp, "F"))
+            file.seek(0)
+            filename = f"modlogs-{user.id if user else 'server'}.{file_format}.gz"
+            await ctx.edit(content=f"Exported {count} cases", file=discord.File(file, filename=filename))
 
-                embed.add_field(name=title, value=description, inline=False)
+    @discord.slash_command(guild_ids=[GUILD_ID])
+    @discord.default_permissions(kick_members=True)
+    @discord.option("search", description="Words to look for in the case reasons")
+    @discord.option("log_type", choices=[discord.OptionChoice(name.title(), value)
+                                         for value, name in LOG_TYPE_PRETTY.items()], required=False)
+    @discord.option("moderator", required=False)
+    @discord.option("start", description="Only search cases from this date (YYYY-MM-DD)", required=False)
+    @discord.option("end", description="Only search cases before this date (YYYY-MM-DD)", required=False)
+    async def searchcases(self, ctx: discord.ApplicationContext, search: str, log_type: str,
+                          moderator: discord.Member, start: str, end: str):
+        """Search every case's reason"""
+        try:
+            filters = date_range(start, end)
+        except ValueError:
+            await ctx.respond("Dates should be written like 2023-01-31", ephemeral=True)
+            return
 
-            if case_count > EMBED_FIELD_LIMIT:
-                # TODO - Paginate?
-                embed.set_footer(text=f"{case_count - EMBED_FIELD_LIMIT} older cases were omitted")
-        else:
-            embed.description = "This user has no associated logs"
+        if log_type:
+            filters["log_type"] = log_type
+        if moderator:
+            filters["mod"] = moderator.id
 
-        await ctx.respond(embed=embed)
+        await ctx.defer()
+
+        pages = CasePages(None, search_pages(filters, search), search_field, f"Cases matching \"{search}\"",
+                          "No cases found", ctx.author)
+        try:
+            await pages.start(ctx)
+        except SearchTimeout:
+            await ctx.respond("The search took too long, try adding some filters")
 
     @discord.slash_command(guild_ids=[GUILD_ID])
     @discord.default_permissions(kick_members=True)
@@ -169,7 +471,7 @@ class Modlogs(discord.Cog):
         Displays the modlog entry with the corresponding number
         """
         await ctx.defer()
-        case = await db.mod_logs.find_one({"case": case_number})
+        case = await storage.find_case(case_number)
 
         if not case:
             await ctx.respond("Case not found", ephemeral=True)
@@ -184,19 +486,19 @@ class Modlogs(discord.Cog):
         """Remove a modlog by its case number"""
         await ctx.defer()
 
-        case = await db.mod_logs.find_one({"case": case_number})
+        case = await storage.find_case(case_number)
 
         if not case:
             await ctx.respond("Case not found", ephemeral=True)
             return
 
-        member = ctx.guild.get_member(case["user"])
+        member = ctx.guild.get_member(int(case["user"]))
         if member and not can_moderate_user(ctx, member):
             await ctx.respond("You cannot moderate that user", ephemeral=True)
             return
 
-        # Could use the case no. here by this is what _ids are for lol
-        await db.mod_logs.delete_one({"_id": case["_id"]})
+        await storage.delete_case(case_number)
+        await remove_from_summary(case)
 
         embed = mod_case_embed(ctx.guild, case)
         await ctx.respond(embed=embed)
@@ -1,7 +1,7 @@
 import discord
 from discord.ext import tasks
 from config import GUILD_ID, MODMAIL_GUILD_ID, MODMAIL_CATEGORY_ID, RED, YELLOW, GREEN, PRIMARY
-from db import db, use_counter
+from storage import storage, use_counter
 from typing import Optional
 
 MODMAIL_SENT_EMOJI = "📨"
@@ -46,8 +46,7 @@ class ModMail(discord.Cog):
 
     @tasks.loop(count=1)
     async def load_active_modmails(self):
-        cursor = db.modmails.find()
-        async for modmail in cursor:
+        for modmail in await storage.all_modmails():
             self.mail_cache.update({
                 int(modmail["channel"]): int(modmail["user"]),
             })
@@ -150,7 +149,7 @@ class ModMail(discord.Cog):
 
         # Clear records
         del self.mail_cache[ctx.channel_id]
-        await db.modmails.delete_one({"channel": str(ctx.channel_id), "user": str(user_id)})
+        await storage.delete_modmail(ctx.channel_id, user_id)
 
         # Inform mods
         mod_embed = discord.Embed(colour=RED, title="Mod Mail Closed")
@@ -168,7 +167,7 @@ class ModMailButton(discord.ui.View):
     @discord.ui.button(emoji="💬", label="Create Mod Mail", custom_id="start_modmail", style=discord.ButtonStyle.blurple)
     async def start_mail(self, _button: discord.Button, interaction: discord.Interaction):
         # Ensure no mod mails currently exist
-        existing_modmail = await db.modmails.find_one({"user": str(interaction.user.id)})
+        existing_modmail = await storage.find_modmail(interaction.user.id)
         if existing_modmail:
             embed = discord.Embed(colour=YELLOW, title="You already have a mod mail open",
                                   description="If you wish to create a new one, ask the mods to close the old mod mail")
@@ -211,10 +210,7 @@ class PromptModal(discord.ui.Modal):
                            allowed_mentions=discord.AllowedMentions(everyone=True))
 
         # Create records
-        await db.modmails.insert_one({
-            "channel": str(channel.id),
-            "user": str(interaction.user.id),
-        })
+        await storage.add_modmail(channel.id, interaction.user.id)
         self.cog.mail_cache.update({channel.id: interaction.user.id})
 
         # Respond to user
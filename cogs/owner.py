@@ -1,6 +1,12 @@
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 import ast
+import time
+from storage import storage, compat_reads
+from settings import settings
+from pronouns_page import profiles
+from cogs.moderation import rebuild_summaries
+from monitoring import database_monitor, stats_summary
 
 # These imports are just for the run command, for convenience
 import datetime as dt
@@ -29,6 +35,21 @@ class Owner(discord.Cog):
     def __init__(self, bot: discord.Bot):
         self.bot = bot
 
+        self.print_db_stats.start()
+
+    def cog_unload(self):
+        self.print_db_stats.cancel()
+
+    @tasks.loop(minutes=config.DB_STATS_MINUTES)
+    async def print_db_stats(self):
+        """Print how the database has been doing, so slowdowns get noticed"""
+        stats = database_monitor.reset_recent()
+
+        # The first run is straight after startup
+        if stats.latency:
+            print(f"Database stats for the last {config.DB_STATS_MINUTES} minutes:")
+            print(stats_summary(stats))
+
     @commands.command()
     @commands.is_owner()
     async def run(self, ctx, *, code: str):
@@ -80,6 +101,123 @@ class Owner(discord.Cog):
             await ctx.send(f"```py\n>>> {code}\n\n\n{e}```")
             raise e
 
+    @commands.command()
+    @commands.is_owner()
+    async def explain(self, ctx: commands.Context):
+        """
+        Check which indexes each database query uses, flagging any that scan the whole collection
+        """
+        results = await storage.explain_queries()
+
+        embed = discord.Embed(colour=config.PRIMARY, title="Query Plans")
+        embed.description = ""
+        for name, stages, collection_scan in results:
+            flag = "\u26a0\ufe0f " if collection_scan else ""
+            embed.description += f"{flag}**{name}:** {' > '.join(stages)}\n"
+
+        scans = sum(collection_scan for _, _, collection_scan in results)
+        embed.set_footer(text=f"{scans} collection scans" if scans else "All queries use an index")
+
+        await ctx.send(embed=embed)
+
+    @commands.command()
+    @commands.is_owner()
+    async def dbstats(self, ctx: commands.Context):
+        """
+        Show how long database queries have been taking since startup
+        """
+        stats = database_monitor.total
+        with database_monitor.lock:
+            summary = stats_summary(stats)
+
+        embed = discord.Embed(colour=config.PRIMARY, title="Database Stats")
+        embed.description = f"```{summary or 'No queries yet'}```"
+
+        slow = ""
+        for timestamp, collection, operation, shape, ms in reversed(database_monitor.slow_queries):
+            line = f"<t:{int(timestamp)}:R> **{collection}.{operation}** {ms:.0f}ms `{shape}`\n"
+            if len(slow) + len(line) > 1024:
+                break
+            slow += line
+
+        if slow:
+            embed.add_field(name=f"Slow Queries (>{database_monitor.slow_query_ms}ms)", value=slow, inline=False)
+
+        cache = settings.stats()
+        embed.add_field(name="Settings Cache", inline=False, value=(
+            "{hits} hits ({missing_hits} for missing settings), {misses} misses\n"
+            "{entries} entries, {expirations} expired, {evictions} evicted\n"
+            "{warmed} warmed for {active} active users"
+        ).format(**cache))
+
+        embed.add_field(name="pronouns.page Cache", inline=False, value=(
+            "{hits} hits, {stale_hits} stale (refreshed in the background), {misses} misses\n"
+            "{not_modified} not modified, {coalesced} coalesced, {fallbacks} fell back to the cache, {errors} errors\n"
+            "{entries} entries"
+        ).format(**profiles.stats()))
+
+        embed.set_footer(text="Since")
+        embed.timestamp = dt.datetime.fromtimestamp(stats.since, dt.timezone.utc)
+
+        await ctx.send(embed=embed)
+
+    @commands.command()
+    @commands.is_owner()
+    async def migrateids(self, ctx: commands.Context):
+        """
+        Convert Discord IDs stored as strings to ints, comparing index sizes and lookup times before and after
+        """
+        sizes_before = await storage.index_sizes()
+        lookups_before = await time_lookups()
+
+        message = await ctx.send("Migrating IDs...")
+        last_edit = 0
+
+        async def progress(collection: str, converted: int):
+            nonlocal last_edit
+            # Not every batch, to stay under the rate limit
+            if time.monotonic() - last_edit > 5:
+                last_edit = time.monotonic()
+                await message.edit(content=f"Migrating IDs... {converted} in {collection}")
+
+        converted = await storage.migrate_ids(config.MIGRATION_BATCH_SIZE, progress)
+        await rebuild_summaries()
+
+        sizes_after = await storage.index_sizes()
+        # The IDs are all ints now, so time it without also matching strings, like it'll be once that's turned off
+        with compat_reads(False):
+            lookups_after = await time_lookups()
+
+        embed = discord.Embed(colour=config.PRIMARY, title="ID Migration")
+        embed.description = "\n".join(f"**{collection}:** {count} converted" for collection, count in converted.items())
+        embed.description = embed.description or "Nothing to convert"
+
+        if sizes_before:
+            embed.add_field(name="Index Sizes", value="\n".join(
+                f"{collection}: {sizes_before[collection] / 1024:.0f}KB > {sizes_after[collection] / 1024:.0f}KB"
+                for collection in sizes_before
+            ), inline=False)
+
+        embed.add_field(name="Modlog Lookups (p50)", value=f"{lookups_before:.1f}ms > {lookups_after:.1f}ms",
+                        inline=False)
+        if config.ID_COMPAT_READS:
+            embed.set_footer(text="ID_COMPAT_READS can be turned off now")
+
+        await message.edit(content=None, embed=embed)
+
+
+async def time_lookups(samples: int = 50) -> float:
+    """Median time to load the first modlogs page for some recently logged users, in ms"""
+    cases = await storage.case_page(None, samples)
+    times = []
+    for user_id in {int(case["user"]) for case in cases}:
+        start = time.perf_counter()
+        await storage.case_page(None, 26, user=user_id)
+        times.append((time.perf_counter() - start) * 1000)
+
+    times.sort()
+    return times[len(times) // 2] if times else 0
+
 
 def setup(bot):
     bot.add_cog(Owner(bot))
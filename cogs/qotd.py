@@ -1,6 +1,6 @@
 import discord
 from discord.ext import tasks
-from db import db
+from storage import storage
 import datetime as dt
 from config import QOTD_ID, GUILD_ID, QOTD_ROLE
 
@@ -31,10 +31,7 @@ class QOTD(discord.Cog):
 
         await ctx.defer()
 
-        await db.qotds.insert_one({
-            "question": qotd,
-            "credit": str(credit.id),
-        })
+        await storage.add_qotd(qotd, credit.id)
 
         embed = discord.Embed(colour=COLOUR, title="QOTD Added", description=qotd)
         embed.timestamp = discord.utils.utcnow()
@@ -47,12 +44,12 @@ class QOTD(discord.Cog):
         """Shows the queue of QOTDs"""
         await ctx.defer()
 
-        cursor = db.qotds.find()
+        qotds = await storage.all_qotds()
 
         embed = discord.Embed(colour=COLOUR, title="QOTD Queue:", description="")
 
         i = 1
-        async for qotd in cursor:
+        for qotd in qotds:
             question = qotd["question"]
             line = f"**{i}.** {question}\n\n"
             if len(embed.description) + len(line) <= EMBED_DESCRIPTION_MAX:
@@ -68,8 +65,8 @@ class QOTD(discord.Cog):
     async def sender(self):
         channel = self.bot.get_channel(QOTD_ID)
 
-        qotd = await db.qotds.find_one_and_delete({})
-        remaining = await db.qotds.count_documents({})
+        qotd = await storage.pop_qotd()
+        remaining = await storage.count_qotds()
 
         if not qotd:
             embed = discord.Embed(colour=COLOUR, title="There are no new questions in the queue",
@@ -1,9 +1,11 @@
 import discord
-from discord.ext import tasks
-from config import UNVERIFIED_ROLE, BOARD_UNVERIFIED_ROLE, NEW_MEMBER_ROLE, MEMBER_ROLE, GUILD_ID, BUDDY_ROLE, MAIN_ID, SPECIAL_LOG_ID, GREEN
+from discord.ext import tasks, commands
+from config import UNVERIFIED_ROLE, BOARD_UNVERIFIED_ROLE, NEW_MEMBER_ROLE, MEMBER_ROLE, GUILD_ID, BUDDY_ROLE, MAIN_ID, SPECIAL_LOG_ID, GREEN, \
+    PRIMARY
 from utils import seconds_to_pretty
+from raids import join_bursts
 import asyncio
-from db import db
+from storage import storage
 import datetime as dt
 
 MEMBER_TIMEOUT = 24 * 60 * 60  # 24h
@@ -37,8 +39,21 @@ class Verification(discord.Cog):
         # invite_id: #uses
         self.invite_cache = {}
 
+        # Members who joined during a raid, waiting for their role
+        self.role_queue = asyncio.Queue()
+        self.role_errors = 0
+
+        # Joins during a raid aren't checked against the invites, so the cached uses are out of date until refreshed
+        self.invites_stale = False
+
         # Run once on startup. Loops are the best option at the moment
         self.member_role_restore.start()
+        self.assign_queued_roles.start()
+        self.refresh_invites_after_raid.start()
+
+    def cog_unload(self):
+        self.assign_queued_roles.cancel()
+        self.refresh_invites_after_raid.cancel()
 
     async def send_welcome(self, member: discord.Member):
         channel = self.bot.get_channel(MAIN_ID)
@@ -49,13 +64,82 @@ class Verification(discord.Cog):
         if member.guild.id != GUILD_ID:
             return
 
-        if await self.is_board_joiner():
+        if join_bursts.record_join(member.id):
+            # Raid - Checking invites for every join is too many requests, so they're queued up instead
+            self.invites_stale = True
+            await self.role_queue.put(member)
+            return
+
+        if self.invites_stale:
+            # Just after a raid, before the invites have been refreshed. Which one they used can't be worked out, so
+            # they're treated like the raid joins
+            role = member.guild.get_role(BOARD_UNVERIFIED_ROLE)
+            await self.refresh_invites()
+        elif await self.is_board_joiner():
             role = member.guild.get_role(BOARD_UNVERIFIED_ROLE)
         else:
             role = member.guild.get_role(NEW_MEMBER_ROLE)
 
         await member.add_roles(role)
 
+    @tasks.loop(count=1)
+    async def assign_queued_roles(self):
+        """Gives members who joined during a raid their role, one at a time"""
+        await self.bot.wait_until_ready()
+
+        while True:
+            member = await self.role_queue.get()
+
+            # The invite used can't be worked out during a raid, so everyone is treated as a board joiner and needs
+            # approving by the mods
+            role = member.guild.get_role(BOARD_UNVERIFIED_ROLE)
+
+            # One failure can't be allowed to stop the loop, or everyone after it would be left without a role
+            try:
+                # They may have already left or been banned
+                if member.guild.get_member(member.id):
+                    await member.add_roles(role)
+            except Exception as error:
+                self.role_errors += 1
+                print(f"Failed to give {member} ({member.id}) the board unverified role: {error!r}")
+
+    @tasks.loop(seconds=5)
+    async def refresh_invites_after_raid(self):
+        """Once a raid is over, start tracking invite uses from scratch"""
+        # Batch mode ends with time as well as with joins, so this can't wait for the next join
+        if self.invites_stale and not join_bursts.update():
+            await self.refresh_invites()
+
+    async def refresh_invites(self):
+        try:
+            self.invite_cache = await self.get_invite_dict()
+            self.invites_stale = False
+        except discord.HTTPException as error:
+            # Tried again on the next loop
+            print(f"Failed to refresh the invite cache: {error!r}")
+
+    @commands.command()
+    @commands.is_owner()
+    async def raidstats(self, ctx: commands.Context):
+        """
+        Show how often join raid batching has been triggered
+        """
+        batch_mode = join_bursts.update()
+
+        embed = discord.Embed(colour=PRIMARY, title="Join Raids")
+        embed.description = f"**Batch mode:** {'Active' if batch_mode else 'Inactive'}\n" \
+                            f"**Threshold:** {join_bursts.threshold} joins in {join_bursts.window}s\n" \
+                            f"**Recent joins:** {len(join_bursts.joins)}\n" \
+                            f"**Times triggered:** {join_bursts.triggered}\n" \
+                            f"**Batched joins:** {join_bursts.batched_joins}\n" \
+                            f"**Time in batch mode:** {seconds_to_pretty(join_bursts.batch_seconds) or 'None'}\n" \
+                            f"**Queued roles:** {self.role_queue.qsize()}\n" \
+                            f"**Role worker:** {'Running' if self.assign_queued_roles.is_running() else 'Stopped'} " \
+                            f"({self.role_errors} errors)\n" \
+                            f"**Invite cache:** {'Stale' if self.invites_stale else 'Up to date'}"
+
+        await ctx.send(embed=embed)
+
     @discord.Cog.listener()
     async def on_member_update(self, old_member: discord.Member, new_member: discord.Member):
         # If user has passed membership screening
@@ -119,17 +203,16 @@ class Verification(discord.Cog):
 
     async def safe_schedule_member_timeout(self, member: discord.Member):
         # Log to database to ensure role is added if bot shuts down
-        result = await db.pending.insert_one({
+        pending_entry_id = await storage.add_pending({
             "type": PENDING_TYPE,
-            "user": str(member.id),
+            "user": member.id,
             "timestamp": discord.utils.utcnow() + dt.timedelta(seconds=MEMBER_TIMEOUT)
         })
-        pending_entry_id = result.inserted_id
 
         await self.member_role_timeout(member, MEMBER_TIMEOUT)
 
         # Clear the pending entry as roles have been modified
-        await db.pending.delete_one({"_id": pending_entry_id})
+        await storage.delete_pending(pending_entry_id)
 
     async def member_role_timeout(self, member: discord.Member, timeout: int):
         await asyncio.sleep(timeout)
@@ -140,23 +223,21 @@ class Verification(discord.Cog):
     @tasks.loop(count=1)
     async def member_role_restore(self):
         """Load all pending member role assignments and process them"""
-        cursor = db.pending.find({
-            "type": PENDING_TYPE,
-        })
+        entries = await storage.pending_of_type(PENDING_TYPE)
 
         await self.bot.wait_until_ready()
 
         guild = self.bot.get_guild(GUILD_ID)
 
-        async for entry in cursor:
+        for entry in entries:
             member = guild.get_member(int(entry["user"]))
 
             if not member:  # User has likely left the guild, so remove entry and move on
-                await db.pending.delete_one({"_id": entry["_id"]})
+                await storage.delete_pending(entry["_id"])
 
             elif entry["timestamp"] <= dt.datetime.utcnow():  # Timestamp is in the past
                 await assign_member_role(member)
-                await db.pending.delete_one({"_id": entry["_id"]})
+                await storage.delete_pending(entry["_id"])
 
             else:  # Timestamp is in the future
                 # Schedule
@@ -168,7 +249,7 @@ class Verification(discord.Cog):
         timeout = entry["timestamp"] - dt.datetime.utcnow()
         await self.member_role_timeout(member, timeout.total_seconds())
 
-        await db.pending.delete_one({"_id": entry["_id"]})
+        await storage.delete_pending(entry["_id"])
 
     async def get_invite_dict(self) -> dict:
         guild = self.bot.get_guild(GUILD_ID)
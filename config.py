@@ -7,6 +7,8 @@ YELLOW = 0xFFF275
 RED = 0xFF3C38
 
 DATABASE = "2magers"
+STORAGE_BACKEND = "mongo"  # "mongo", or "sqlite" to run without a database server
+SQLITE_PATH = ":memory:"  # A file to keep the sqlite data between runs
 
 BAN_APPEAL_LINK = "https://forms.gle/4Q96FfLWt1SXatSCA"
 
@@ -38,3 +40,73 @@ STAFF_LIST_MESSAGE = [585994345086451723, 1050272929067323432, 10502999991976018
 LIKE_EMOJI = "<:teamupvote:715178741168472117>"
 DISLIKE_EMOJI = "<:teamdownvote:715178752937820221>"
 SPOTIFY_EMOJI = "<:spotify:993755572761530368>"
+
+# Image rendering
+RENDER_POOL = "process"  # "process" or "thread"
+RENDER_WORKERS = 2
+BACKGROUND_CACHE_BYTES = 64 * 1024 * 1024  # Per worker. A 1024x1024 RGBA background is 4MB
+
+AVATAR_CACHE_BYTES = 32 * 1024 * 1024
+AVATAR_DISK_CACHE_DIR = None  # Set to a directory to also keep avatars on disk
+AVATAR_DISK_CACHE_BYTES = 256 * 1024 * 1024
+
+# See imaging.ENCODINGS for the options
+PRIDE_ENCODING = "png"
+WELCOME_ENCODING = "png"
+IMAGE_MAX_BYTES = 8 * 1024 * 1024  # Discord's upload limit
+
+PRIDE_CACHE_BYTES = 32 * 1024 * 1024
+PRIDE_DISK_CACHE_DIR = None  # Set to a directory to also keep pride images on disk
+PRIDE_DISK_CACHE_BYTES = 256 * 1024 * 1024
+COMPOSITING_ENGINE = "pil"  # "pil" or "numpy" (needs numpy installed). Can be switched with ?renderengine
+
+ANIMATED_AVATARS = True  # Render animated avatars as GIFs, falling back to static images if over the limits below
+ANIMATED_PRIDE_SIZE = 512
+ANIMATED_MAX_FRAMES = 100
+ANIMATED_MAX_BYTES = IMAGE_MAX_BYTES
+ANIMATED_TIME_BUDGET = 10  # Seconds
+
+# Join raids - Above this many joins in RAID_WINDOW seconds, welcomes and roles are handled in batches
+RAID_JOIN_THRESHOLD = 10
+RAID_WINDOW = 60
+
+# Seconds to wait before sending a welcome card. If they leave in that time, neither welcome or goodbye is sent
+WELCOME_HOLD = 10
+
+# counter_id: how many numbers to reserve at once. Makes mass bans etc. quicker, but numbers are skipped on restart.
+# Counters not listed here (eg. modmail channel numbers) stay strictly in order
+COUNTER_BLOCKS = {
+    "mod_logs_case": 10,
+}
+
+# Database monitoring
+SLOW_QUERY_MS = 100  # Queries slower than this are logged
+DB_STATS_MINUTES = 60  # How often to print a summary of query times
+
+# Modlog exports
+EXPORT_BATCH_SIZE = 500  # Cases fetched from the database at a time
+EXPORT_MAX_BYTES = 8 * 1024 * 1024  # Discord's upload limit
+
+SEARCH_MAX_TIME_MS = 5000  # /searchcases gives up after this long
+
+# Old cases are moved out of mod_logs into mod_logs_archive, keeping the main collection small
+ARCHIVE_AFTER_DAYS = 365
+ARCHIVE_COMPRESS = True  # zlib the archived cases, except for the fields needed to look them up
+ARCHIVE_BATCH_SIZE = 500
+
+# Discord IDs used to be stored as strings. Until ?migrateids has been run, look them up both ways
+ID_COMPAT_READS = True
+MIGRATION_BATCH_SIZE = 500
+
+# User settings, eg. pronouns.page usernames, are cached for this many seconds
+SETTINGS_CACHE_TTL = 30 * 60
+SETTINGS_CACHE_MISSING_TTL = 10 * 60  # For users without the setting, which is most of them
+SETTINGS_CACHE_ENTRIES = 20000
+SETTINGS_WARM_USERS = 500  # How many recent chatters to keep cached
+SETTINGS_WARM_MINUTES = 5
+
+# pronouns.page profiles newer than this (in seconds) are used without asking pronouns.page again
+PRONOUNS_PAGE_FRESH = 10 * 60
+PRONOUNS_PAGE_MAX_STALE = 24 * 60 * 60  # Older ones up to this age are used while being refreshed in the background
+PRONOUNS_PAGE_TIMEOUT = 3  # Seconds to wait for pronouns.page before using the cached profile, however old
+PRONOUNS_PAGE_CACHE_ENTRIES = 5000
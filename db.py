@@ -1,12 +1,106 @@
 from motor import motor_asyncio
+from pymongo import IndexModel, ASCENDING, DESCENDING, TEXT
+from pymongo.errors import OperationFailure
 from dotenv import dotenv_values
 from config import DATABASE
+from monitoring import database_monitor
 
 MONGO_URI = dotenv_values()["MONGO_URI"]
-_client = motor_asyncio.AsyncIOMotorClient(MONGO_URI)
+_client = motor_asyncio.AsyncIOMotorClient(MONGO_URI, event_listeners=[database_monitor])
 db = _client[DATABASE]
 
+# collection: indexes. Created at startup if they don't exist yet. counters, settings and mod_log_summaries are only
+# looked up by _id, which is always indexed
+INDEXES = {
+    "mod_logs": [
+        IndexModel([("case", ASCENDING)], name="case", unique=True),
+        IndexModel([("user", ASCENDING), ("case", DESCENDING)], name="user_case"),
+        IndexModel([("user", ASCENDING), ("type", ASCENDING), ("case", DESCENDING)], name="user_type_case"),
+        IndexModel([("timestamp", ASCENDING)], name="timestamp"),
+        IndexModel([("reason", TEXT)], name="reason_text"),
+    ],
+    "mod_logs_archive": [
+        IndexModel([("case", ASCENDING)], name="case", unique=True),
+        IndexModel([("user", ASCENDING), ("case", DESCENDING)], name="user_case"),
+        IndexModel([("timestamp", ASCENDING)], name="timestamp"),
+    ],
+    "modmails": [
+        IndexModel([("user", ASCENDING)], name="user"),
+        IndexModel([("channel", ASCENDING)], name="channel"),
+    ],
+    "pending": [
+        IndexModel([("type", ASCENDING)], name="type"),
+    ],
+}
 
-async def use_counter(counter_id: str) -> int:
-    counter = await db.counters.find_one_and_update({"_id": counter_id}, {"$inc": {"value": 1}})
-    return counter["value"]
+# Every query the cogs make, with placeholder values: (name, collection, filter, sort)
+QUERY_SHAPES = [
+    ("modlogs", "mod_logs", {"user": 0}, [("case", DESCENDING)]),
+    ("modlogs next page", "mod_logs", {"user": 0, "case": {"$lt": 0}}, [("case", DESCENDING)]),
+    ("viewnotes", "mod_logs", {"user": 0, "type": "note"}, [("case", DESCENDING)]),
+    ("mymodlogs", "mod_logs", {"user": 0, "type": {"$ne": "note"}}, [("case", DESCENDING)]),
+    ("export user", "mod_logs", {"user": 0}, [("case", ASCENDING)]),
+    ("export dates", "mod_logs", {"timestamp": {"$gte": 0, "$lt": 0}}, [("timestamp", ASCENDING)]),
+    ("searchcases", "mod_logs", {"$text": {"$search": "?"}, "type": "warn"}, None),
+    ("getcase", "mod_logs", {"case": 0}, None),
+    ("archive old cases", "mod_logs", {"timestamp": {"$lt": 0}, "type": {"$ne": "note"}}, [("timestamp", ASCENDING)]),
+    ("archived modlogs", "mod_logs_archive", {"user": 0, "case": {"$lt": 0}}, [("case", DESCENDING)]),
+    ("archived getcase", "mod_logs_archive", {"case": 0}, None),
+    ("modmail by user", "modmails", {"user": 0}, None),
+    ("modmail close", "modmails", {"channel": 0, "user": 0}, None),
+    ("pending roles", "pending", {"type": "member_role"}, None),
+    ("counter", "counters", {"_id": "modlog"}, None),
+    ("modlog summary", "mod_log_summaries", {"_id": 0}, None),
+    ("pronouns.page", "settings", {"_id": 0, "pronouns_page": {"$ne": None}}, None),
+]
+
+
+async def ensure_indexes():
+    """Create any missing indexes. Existing ones are left alone, so this is safe to run every startup"""
+    for collection, indexes in INDEXES.items():
+        # One at a time, as a failed index in a create_indexes() call stops the rest of the collection's being built
+        for index in indexes:
+            try:
+                await db[collection].create_indexes([index])
+            except OperationFailure as e:
+                # Eg. duplicate cases stopping the unique index - Don't stop the bot starting over it
+                print(f"Failed to create index {index.document['name']} on {collection}: {e}")
+
+
+def plan_stages(plan: dict) -> list:
+    """Flatten a query plan into its stage names, from the first stage run to the last"""
+    stages = []
+
+    # Newer servers wrap the plan when using the slot based engine
+    plan = plan.get("queryPlan", plan)
+
+    children = plan.get("inputStages", [])
+    if "inputStage" in plan:
+        children = [plan["inputStage"]]
+
+    for child in children:
+        stages += plan_stages(child)
+
+    stage = plan["stage"]
+    if stage == "IXSCAN":
+        stage += f" ({plan['indexName']})"
+    stages.append(stage)
+
+    return stages
+
+
+async def explain_queries() -> list:
+    """Explain every query in QUERY_SHAPES, returning (name, stages, is collection scan)"""
+    results = []
+
+    for name, collection, query, sort in QUERY_SHAPES:
+        cursor = db[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort)
+
+        explain = await cursor.explain()
+        stages = plan_stages(explain["queryPlanner"]["winningPlan"])
+
+        results.append((name, stages, any(stage == "COLLSCAN" for stage in stages)))
+
+    return results
@@ -0,0 +1,649 @@
+from PIL import Image, ImageDraw, ImageFilter, ImageFont, GifImagePlugin
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, BrokenExecutor
+from collections import deque
+from functools import lru_cache
+from io import BytesIO
+from os import listdir, getpid
+from cache import LRUCache
+from config import BACKGROUND_CACHE_BYTES, ANIMATED_PRIDE_SIZE
+from typing import Optional
+import multiprocessing
+import threading
+import asyncio
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+FLAG_DIR = "images/flags/"
+
+FLAGS = []
+for file in listdir(FLAG_DIR):
+    if file.endswith(".png"):
+        FLAGS.append(file[:-4])
+
+FLAG_PFP_SIZE = 1024
+FLAG_BLUR = 40
+FLAG_BORDER = 50
+
+FLAG_SEPARATORS = {
+    "vertical": ((FLAG_PFP_SIZE / 2, 0), (FLAG_PFP_SIZE, 0), (FLAG_PFP_SIZE, FLAG_PFP_SIZE), (FLAG_PFP_SIZE / 2),
+                 FLAG_PFP_SIZE),
+    "horizontal": ((0, FLAG_PFP_SIZE / 2), (FLAG_PFP_SIZE, FLAG_PFP_SIZE / 2), (FLAG_PFP_SIZE, FLAG_PFP_SIZE),
+                   (0, FLAG_PFP_SIZE)),
+    "diagonal /": ((FLAG_PFP_SIZE, 0), (FLAG_PFP_SIZE, FLAG_PFP_SIZE), (0, FLAG_PFP_SIZE)),
+    "diagonal \\": ((0, 0), (FLAG_PFP_SIZE, 0), (FLAG_PFP_SIZE, FLAG_PFP_SIZE)),
+}
+
+FONT = "Roboto-Regular.ttf"
+FONT_BOLD = "Roboto-Bold.ttf"
+WELCOME_BG = "images/welcomeBG.jpg"
+LEAVE_BG = "images/goodbyeBG.jpg"
+
+# Number of recent renders used to calculate the percentiles in the stats
+STATS_WINDOW = 200
+
+# How the pfp is cropped and pasted onto the background. Both produce identical images
+ENGINES = ["pil", "numpy"] if np else ["pil"]
+# Set by the render pool for each render, so it can be switched at runtime
+engine = "pil"
+
+PRIDE_PFP_SIZE = FLAG_PFP_SIZE - FLAG_BORDER * 2
+WELCOME_PFP_SIZE = 200
+
+# Animated pride images are rendered smaller, as every frame has to fit in the upload limit
+ANIMATED_PRIDE_BORDER = FLAG_BORDER * ANIMATED_PRIDE_SIZE // FLAG_PFP_SIZE
+ANIMATED_PRIDE_PFP_SIZE = ANIMATED_PRIDE_SIZE - ANIMATED_PRIDE_BORDER * 2
+
+
+class Assets:
+    """Decoded and pre-processed images, so renders don't touch the disk"""
+
+    def __init__(self):
+        # flag name: flag resized to FLAG_PFP_SIZE
+        self.flags = {}
+        # seperator name: "L" mask of the seperator polygon
+        self.separators = {}
+        # size: "L" mask of a circle filling a size x size square
+        self.circles = {}
+        # size: the circle mask as a boolean array, for the numpy engine
+        self.circle_arrays = {}
+
+    def load(self):
+        for flag in FLAGS:
+            image = Image.open(FLAG_DIR + flag + ".png").convert("RGBA")
+            self.flags[flag] = image.resize((FLAG_PFP_SIZE, FLAG_PFP_SIZE))
+
+        for name, polygon in FLAG_SEPARATORS.items():
+            # Create B&W image to be used as the composite mask
+            mask_img = Image.new("L", (FLAG_PFP_SIZE, FLAG_PFP_SIZE), color=0)
+            # Draw the seperator in white onto the mask
+            ImageDraw.Draw(mask_img).polygon(polygon, fill=255)
+            self.separators[name] = mask_img
+
+        for size in (PRIDE_PFP_SIZE, WELCOME_PFP_SIZE, ANIMATED_PRIDE_PFP_SIZE):
+            self.circles[size] = make_circle_mask((size, size))
+
+    def circle_mask(self, size: tuple) -> Image:
+        if size[0] == size[1] and size[0] in self.circles:
+            return self.circles[size[0]]
+
+        return make_circle_mask(size)
+
+    def circle_array(self, size: tuple):
+        if size not in self.circle_arrays:
+            self.circle_arrays[size] = np.asarray(self.circle_mask(size)) > 0
+
+        return self.circle_arrays[size]
+
+    def memory_usage(self) -> int:
+        """Approximate size of the decoded image data in bytes"""
+        images = [*self.flags.values(), *self.separators.values(), *self.circles.values()]
+        return sum(image_size(image) for image in images) + sum(a.nbytes for a in self.circle_arrays.values())
+
+
+assets = Assets()
+
+
+def load_assets():
+    """Populate the asset cache. Also used as the render pool initializer, so each worker process has a copy"""
+    if not assets.flags:
+        assets.load()
+
+
+def image_size(image: Image) -> int:
+    return image.width * image.height * len(image.getbands())
+
+
+# Finished pride backgrounds, keyed by (flag, seperator, flag_2, blur, size)
+background_cache = LRUCache(BACKGROUND_CACHE_BYTES, sizeof=image_size)
+
+# name: cache - Their stats are sent back to the bot after each render
+CACHES = {
+    "backgrounds": background_cache,
+}
+
+
+# name: (Pillow format, whether to reduce to a 256 colour palette first, save options)
+ENCODINGS = {
+    "png": ("png", False, {"compress_level": 6}),
+    "png_fast": ("png", False, {"compress_level": 1}),
+    "png_quantized": ("png", True, {"compress_level": 6}),
+    "webp_lossless": ("webp", False, {"lossless": True, "quality": 50, "method": 4}),
+}
+
+# "<encoding> <width>x<height>": {count, seconds, bytes, shrunk}
+ENCODE_STATS = {}
+# Thread pool workers all update the same stats
+ENCODE_STATS_LOCK = threading.Lock()
+
+
+def worker_stats() -> dict:
+    # Copied under the lock, so the thread pool's other workers can't change the stats while they're being read
+    with ENCODE_STATS_LOCK:
+        encodings = {key: dict(stats) for key, stats in ENCODE_STATS.items()}
+
+    return {
+        "caches": {name: cache.stats() for name, cache in CACHES.items()},
+        "encodings": encodings,
+        "assets": assets.memory_usage(),
+    }
+
+
+def _encode(image: Image, encoding: str, quantize: bool = False) -> bytes:
+    image_format, encoding_quantize, options = ENCODINGS[encoding]
+
+    if quantize or encoding_quantize:
+        image = image.quantize(256, method=Image.Quantize.FASTOCTREE)
+
+    output = BytesIO()
+    image.save(output, format=image_format, **options)
+
+    return output.getvalue()
+
+
+def encode_image(image: Image, encoding: str = "png", max_bytes: int = None) -> bytes:
+    """
+    Encode the image in the given format. If the output is larger than max_bytes, the image is reduced to a palette
+    and then scaled down until it fits
+    """
+    stats_key = f"{encoding} {image.width}x{image.height}"
+    shrunk = False
+    start = time.perf_counter()
+
+    data = _encode(image, encoding)
+
+    if max_bytes and len(data) > max_bytes:
+        shrunk = True
+        data = _encode(image, encoding, quantize=True)
+
+        while len(data) > max_bytes and image.width > 64:
+            image = image.resize((image.width * 3 // 4, image.height * 3 // 4))
+            data = _encode(image, encoding, quantize=True)
+
+    seconds = time.perf_counter() - start
+    with ENCODE_STATS_LOCK:
+        stats = ENCODE_STATS.setdefault(stats_key, {"count": 0, "seconds": 0, "bytes": 0, "shrunk": 0})
+        stats["count"] += 1
+        stats["shrunk"] += shrunk
+        stats["seconds"] += seconds
+        stats["bytes"] += len(data)
+
+    return data
+
+
+def image_extension(data: bytes) -> str:
+    """The file extension for encoded image data. Only reads the header"""
+    return Image.open(BytesIO(data)).format.lower()
+
+
+def encode_animation(frames, max_bytes: int, deadline: float) -> Optional[bytes]:
+    """
+    Encodes (frame, duration) pairs into a GIF as they are generated, so only one decoded frame is held at a time.
+    Returns None if the output grows past max_bytes or encoding passes the deadline (from time.monotonic())
+    """
+    output = BytesIO()
+
+    for index, (frame, duration) in enumerate(frames):
+        # Every frame gets its own palette, as the avatar's colours can change between frames
+        frame = frame.convert("RGB").quantize(256, method=Image.Quantize.FASTOCTREE)
+
+        if index == 0:
+            header, _ = GifImagePlugin.getheader(frame, info={"loop": 0})
+            output.writelines(header)
+
+        output.writelines(GifImagePlugin.getdata(frame, duration=duration, include_color_table=True))
+
+        if output.tell() > max_bytes or time.monotonic() > deadline:
+            return None
+
+    # GIF trailer
+    output.write(b";")
+
+    return output.getvalue()
+
+
+def iter_avatar_frames(pfp: Image, size: int):
+    """Yields each frame of an animated avatar as (RGBA frame resized to size x size, duration in ms)"""
+    for index in range(pfp.n_frames):
+        pfp.seek(index)
+        yield pfp.convert("RGBA").resize((size, size)), pfp.info.get("duration", 100)
+
+
+def open_animated(pfp: bytes, max_frames: int) -> Optional[Image.Image]:
+    """Opens an avatar if it is animated and short enough to render every frame"""
+    image = Image.open(BytesIO(pfp))
+
+    if not 1 < getattr(image, "n_frames", 1) <= max_frames:
+        return None
+
+    return image
+
+
+WELCOME_SIZE = (700, 250)
+# Where the pfp is pasted. The ring around it is drawn 4px outside of this
+WELCOME_PFP_BOX = (25, 25, 225, 225)
+WELCOME_RING_BOX = (21, 21, 229, 228)
+
+
+@lru_cache(maxsize=None)
+def get_welcome_template(background: str, header: str, text_colour: tuple) -> Image:
+    """
+    The parts of a welcome image that are the same for every member. The returned image is shared, so must be copied
+    """
+    background_img = Image.open(background)
+    background_img.load()
+
+    canvas = ImageDraw.Draw(background_img)
+
+    # Background border
+    # idk why the border end is -1px off the size
+    canvas.rectangle((0, 0, WELCOME_SIZE[0] - 1, WELCOME_SIZE[1] - 1), outline=(0, 0, 0), width=3)
+
+    header_font = get_font(FONT_BOLD, 35)
+    canvas.text((WELCOME_SIZE[0] / 1.5, WELCOME_SIZE[1] / 3.5), header, text_colour, header_font, "mm")
+
+    return background_img
+
+
+def make_welcome_image(background: str, pfp: BytesIO, header: str, body: str, footer: str, text_colour: tuple) -> Image:
+    pfp_img = Image.open(pfp)
+    pfp_img = pfp_img.convert("RGBA")
+    pfp_img = pfp_img.resize((WELCOME_PFP_SIZE, WELCOME_PFP_SIZE))
+
+    background_img = composite_pfp(get_welcome_template(background, header, text_colour), pfp_img,
+                                   WELCOME_PFP_BOX[:2])
+
+    draw_pfp_ring(background_img)
+    draw_welcome_text(background_img, body, footer, text_colour)
+
+    return background_img
+
+
+def draw_pfp_ring(image: Image):
+    # PFP Border
+    # Size is pfp_img's size + the width. This overlaps the pfp, so can't be part of the template,
+    # but drawing it is cheaper than pasting a pre-drawn layer
+    ImageDraw.Draw(image).ellipse(WELCOME_RING_BOX, outline=(255, 255, 255), width=4)
+
+
+def draw_welcome_text(image: Image, body: str, footer: str, text_colour: tuple):
+    canvas = ImageDraw.Draw(image)
+
+    body_font = fit_font_width(FONT_BOLD, 60, body, 400)
+    canvas.text((WELCOME_SIZE[0] / 1.5, WELCOME_SIZE[1] / 2), body, text_colour, body_font, "mm")
+
+    footer_font = get_font(FONT, 25)
+    canvas.text((WELCOME_SIZE[0] / 1.5, WELCOME_SIZE[1] / 1.35), footer, text_colour, footer_font, "mm")
+
+
+@lru_cache(maxsize=None)
+def get_font(font_path: str, size: int) -> ImageFont.FreeTypeFont:
+    """Loading the TTF is slow, so keep every font that has been used. Only a handful of sizes are ever used"""
+    return ImageFont.truetype(font_path, size)
+
+
+@lru_cache(maxsize=1024)
+def fit_font_size(font_path: str, start_size: int, text: str, width: int) -> int:
+    """Binary search for the largest size, up to start_size, where the text fits in the given width"""
+    low, high = 1, start_size
+
+    while low < high:
+        size = (low + high + 1) // 2
+
+        if get_font(font_path, size).getlength(text) <= width:
+            low = size
+        else:
+            high = size - 1
+
+    return low
+
+
+def fit_font_width(font_path: str, start_size: int, text: str, width: int) -> ImageFont.FreeTypeFont:
+    """Shrinks the font so the width fits in the given size"""
+    return get_font(font_path, fit_font_size(font_path, start_size, text, width))
+
+
+def make_circle_mask(size: tuple) -> Image:
+    # Create B&W image to be used as the composite mask
+    mask_img = Image.new("L", size, color=0)
+    mask_draw = ImageDraw.Draw(mask_img)
+    # Create the circular mask in white
+    mask_draw.ellipse((0, 0, size[0], size[1]), fill=255)
+
+    return mask_img
+
+
+def circle_crop(image: Image):
+    # A transparent layer to place the image onto
+    base = Image.new("RGBA", image.size, color=0)
+    # Ensure the image is also RGBA
+    image = image.convert("RGBA")
+
+    # Apply the composite
+    return Image.composite(image, base, assets.circle_mask(image.size))
+
+
+def composite_pfp(background: Image, pfp: Image, position: tuple) -> Image:
+    """Returns a copy of the background, with the RGBA pfp cropped to a circle and pasted at position"""
+    if engine == "numpy":
+        return composite_pfp_numpy(background, pfp, position)
+
+    background = background.copy()
+
+    pfp = circle_crop(pfp)
+    background.paste(pfp, position, pfp)
+
+    return background
+
+
+def composite_pfp_numpy(background: Image, pfp: Image, position: tuple) -> Image:
+    """
+    Same as composite_pfp, as a single vectorised blend on the cached mask. Follows Pillow's paste maths exactly
+    (including blending the alpha channel) so the output is identical
+    """
+    output = np.array(background)
+    channels = output.shape[2]
+
+    pixels = np.asarray(pfp)
+    mask = assets.circle_array(pfp.size)
+
+    x, y = position
+    region = output[y:y + pfp.height, x:x + pfp.width]
+
+    # circle_crop makes everything outside the circle fully transparent, which leaves the background unchanged
+    alpha = np.where(mask, pixels[..., 3], 0)[..., None]
+    source = pixels[..., :channels]
+
+    if ((alpha > 0) & (alpha < 255)).any():
+        # The largest intermediate value is 255 * 255 + 128 + 254, so uint16 is enough
+        alpha = alpha.astype(np.uint16)
+
+        # Pillow's BLEND + DIV255, in2 * mask + in1 * (255 - mask) divided by 255 with rounding
+        blended = source * alpha + region * (255 - alpha) + 128
+        region[:] = ((blended >> 8) + blended) >> 8
+    else:
+        # Without any translucent pixels, the blend is just a copy of the opaque ones
+        np.copyto(region, source, where=alpha == 255)
+
+    return Image.fromarray(output)
+
+
+def make_pride_image(pfp: BytesIO, flag: str, seperator: str, flag_2: str, blur: int) -> Image:
+    # Load the pfp into PIL
+    pfp = Image.open(pfp)
+    # Resize pfp to standardised size, taking into account the border width
+    pfp = pfp.resize((PRIDE_PFP_SIZE, PRIDE_PFP_SIZE))
+    # Prevent colour mode errors
+    pfp = pfp.convert("RGBA")
+
+    background = get_pride_background(flag, seperator, flag_2, blur)
+
+    # Crop profile picture to a circle and combine the images
+    return composite_pfp(background, pfp, (FLAG_BORDER, FLAG_BORDER))
+
+
+def get_pride_background(flag: str, seperator: str, flag_2: str, blur: int, size: int = FLAG_PFP_SIZE) -> Image:
+    """Gets the flag layer of a pride image. The returned image is shared, so must not be modified"""
+    # A single flag is already sized in the asset cache
+    if not flag_2 and not blur and size == FLAG_PFP_SIZE:
+        return assets.flags[flag]
+
+    key = (flag, seperator if flag_2 else None, flag_2, bool(blur), size)
+    background = background_cache.get(key)
+    if background is not None:
+        return background
+
+    if size != FLAG_PFP_SIZE:
+        # Scale the full size version, so the blur looks the same
+        background = get_pride_background(flag, seperator, flag_2, blur).resize((size, size))
+        background_cache.put(key, background)
+        return background
+
+    background = assets.flags[flag]
+
+    if flag_2:
+        # Apply the seperator mask
+        background = Image.composite(assets.flags[flag_2], background, assets.separators[seperator])
+
+    # Apply blur
+    if blur:
+        background = background.filter(ImageFilter.GaussianBlur(FLAG_BLUR))
+
+    background_cache.put(key, background)
+    return background
+
+
+# Render entry points - These run inside the render pool, so only take and return plain (picklable) data
+
+def render_pride(pfp: bytes, flag: str, seperator: str, flag_2: str, blur: int, encoding: str = "png",
+                 max_bytes: int = None) -> bytes:
+    image = make_pride_image(BytesIO(pfp), flag, seperator, flag_2, blur)
+    return encode_image(image, encoding, max_bytes)
+
+
+def render_welcome(background: str, pfp: bytes, header: str, body: str, footer: str, text_colour: tuple,
+                   encoding: str = "png", max_bytes: int = None) -> bytes:
+    image = make_welcome_image(background, BytesIO(pfp), header, body, footer, text_colour)
+    return encode_image(image, encoding, max_bytes)
+
+
+def render_animated_pride(pfp: bytes, flag: str, seperator: str, flag_2: str, blur: int, max_frames: int,
+                          max_bytes: int, time_budget: float) -> Optional[bytes]:
+    """
+    Renders an animated avatar into an animated GIF. Returns None if the avatar isn't animated, or the render would go
+    over max_frames, max_bytes or time_budget seconds, in which case a static image should be rendered instead
+    """
+    deadline = time.monotonic() + time_budget
+
+    pfp = open_animated(pfp, max_frames)
+    if not pfp:
+        return None
+
+    background = get_pride_background(flag, seperator, flag_2, blur, ANIMATED_PRIDE_SIZE)
+    position = (ANIMATED_PRIDE_BORDER, ANIMATED_PRIDE_BORDER)
+
+    frames = (
+        (composite_pfp(background, frame, position), duration)
+        for frame, duration in iter_avatar_frames(pfp, ANIMATED_PRIDE_PFP_SIZE)
+    )
+    return encode_animation(frames, max_bytes, deadline)
+
+
+def render_animated_welcome(background: str, pfp: bytes, header: str, body: str, footer: str, text_colour: tuple,
+                            max_frames: int, max_bytes: int, time_budget: float) -> Optional[bytes]:
+    """The welcome image equivalent of render_animated_pride"""
+    deadline = time.monotonic() + time_budget
+
+    pfp = open_animated(pfp, max_frames)
+    if not pfp:
+        return None
+
+    # The text doesn't overlap the pfp, so can be drawn once for every frame
+    card = get_welcome_template(background, header, text_colour).copy()
+    draw_welcome_text(card, body, footer, text_colour)
+
+    def frames():
+        for frame, duration in iter_avatar_frames(pfp, WELCOME_PFP_SIZE):
+            image = composite_pfp(card, frame, WELCOME_PFP_BOX[:2])
+            draw_pfp_ring(image)
+            yield image, duration
+
+    return encode_animation(frames(), max_bytes, deadline)
+
+
+def compare_encodings(pfp: bytes) -> dict:
+    """
+    Encode a sample pride and welcome image with every encoding, for choosing the defaults
+    Returns {image name: {encoding: (seconds, bytes)}}
+    """
+    images = {
+        "pride": make_pride_image(BytesIO(pfp), FLAGS[0], None, None, 0),
+        "pride (blurred)": make_pride_image(BytesIO(pfp), FLAGS[0], None, None, 1),
+        "welcome": make_welcome_image(WELCOME_BG, BytesIO(pfp), "Welcome", "Sample", "Sample footer", (0, 0, 0)),
+    }
+
+    results = {}
+    for name, image in images.items():
+        results[name] = {}
+        for encoding in ENCODINGS:
+            start = time.perf_counter()
+            data = _encode(image, encoding)
+            results[name][encoding] = (time.perf_counter() - start, len(data))
+
+    return results
+
+
+def _timed(render_engine: str, fn, *args):
+    """
+    Wrapper run in the worker, so the time spent waiting in the queue isn't counted as render time.
+    Also sends back the worker's cache and encoding stats, as those can't be read from the bot's process
+    """
+    global engine
+    engine = render_engine
+
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start, getpid(), worker_stats()
+
+
+def percentile(values, percent: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class RenderStats:
+    def __init__(self):
+        self.count = 0
+        self.queued = 0  # Renders which had to wait for a free worker
+        self.render_times = deque(maxlen=STATS_WINDOW)
+        self.wait_times = deque(maxlen=STATS_WINDOW)
+
+    def summary(self) -> str:
+        return "{} renders ({} queued)\nRender p50/p95: {:.0f}/{:.0f}ms\nWait p50/p95: {:.0f}/{:.0f}ms".format(
+            self.count, self.queued,
+            percentile(self.render_times, 50) * 1000, percentile(self.render_times, 95) * 1000,
+            percentile(self.wait_times, 50) * 1000, percentile(self.wait_times, 95) * 1000,
+        )
+
+
+class RenderPool:
+    """Runs the Pillow rendering outside the event loop, keeping track of how saturated the workers are"""
+
+    def __init__(self, mode: str = "process", workers: int = 2, engine: str = "pil"):
+        if mode not in ("process", "thread"):
+            raise ValueError(f"Unknown render pool mode: {mode}")
+
+        self.mode = mode
+        self.workers = workers
+        self.engine = engine
+        self.executor = self.make_executor()
+        # Times the workers crashed and the pool had to be replaced
+        self.restarts = 0
+
+        # Renders submitted that haven't completed yet
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+        # function name: RenderStats
+        self.stats = {}
+        # worker pid: latest worker_stats() from that worker
+        self.worker_stats = {}
+
+    def make_executor(self):
+        if self.mode == "thread":
+            return ThreadPoolExecutor(self.workers, thread_name_prefix="render", initializer=load_assets)
+
+        # Not fork - by the time the first render starts the workers, the database and aiohttp threads are running,
+        # and forking can copy a lock one of them holds. Spawned workers import main.py as __mp_main__, which doesn't
+        # start a bot
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=load_assets)
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    async def run(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        stats = self.stats.setdefault(fn.__name__, RenderStats())
+
+        if self.in_flight >= self.workers:
+            stats.queued += 1
+
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+        start = time.perf_counter()
+        try:
+            executor = self.executor
+            try:
+                result, render_time, pid, worker = await loop.run_in_executor(executor, _timed, self.engine, fn, *args)
+            except BrokenExecutor:
+                # A worker died (eg. killed for using too much memory), which breaks the whole pool. Everything
+                # running at the time gets this, but only the first needs to replace it
+                if self.executor is executor:
+                    print("Render pool broke, restarting it")
+                    self.executor = self.make_executor()
+                    self.restarts += 1
+                    executor.shutdown(wait=False)
+
+                result, render_time, pid, worker = await loop.run_in_executor(self.executor, _timed, self.engine, fn,
+                                                                              *args)
+        finally:
+            self.in_flight -= 1
+
+        stats.count += 1
+        stats.render_times.append(render_time)
+        stats.wait_times.append(time.perf_counter() - start - render_time)
+        self.worker_stats[pid] = worker
+
+        return result
+
+    def summed_stats(self, category: str) -> dict:
+        """Sums a category of worker_stats() across all the workers"""
+        totals = {}
+        for worker in self.worker_stats.values():
+            for name, stats in worker[category].items():
+                total = totals.setdefault(name, dict.fromkeys(stats, 0))
+                for key, value in stats.items():
+                    total[key] += value
+
+        return totals
+
+    def cache_stats(self) -> dict:
+        return self.summed_stats("caches")
+
+    def encode_stats(self) -> dict:
+        return self.summed_stats("encodings")
+
+    def asset_memory(self) -> int:
+        """Decoded asset bytes across the worker processes. Threads share one pid, so their copy is counted once"""
+        return sum(worker["assets"] for worker in self.worker_stats.values())
+
+    def shutdown(self, wait: bool = False):
+        self.executor.shutdown(wait=wait)
@@ -3,6 +3,7 @@ from discord.ext import commands
 from dotenv import dotenv_values
 from os import listdir
 import aiohttp
+from storage import storage
 
 
 class Bot(commands.Bot):
@@ -11,6 +12,8 @@ class Bot(commands.Bot):
 
     # Override start() to create an aiohttp session
     async def start(self, token: str, *, reconnect: bool = True):
+        await storage.setup()
+
         async with aiohttp.ClientSession(loop=self.loop) as self.session:
             await super().start(token, reconnect=reconnect)
 
@@ -21,12 +24,6 @@ allowed_mentions = discord.AllowedMentions(everyone=False)
 bot = Bot(command_prefix=("/", "?"), case_insensitive=True, owner_id=349070664684142592, intents=intents,
           allowed_mentions=allowed_mentions)
 
-for cog in listdir("cogs/"):
-    if cog.endswith(".py"):
-        cog = cog[:-3]
-        print(f"Loading extension: {cog}")
-        bot.load_extension(f"cogs.{cog}")
-
 
 @bot.event
 async def on_ready():
@@ -35,5 +32,13 @@ async def on_ready():
     print("-" * len(status))
 
 
-TOKEN = dotenv_values()["BOT_TOKEN"]
-bot.run(TOKEN)
+# Render pool workers import this file too, and shouldn't start their own bot
+if __name__ == "__main__":
+    for cog in listdir("cogs/"):
+        if cog.endswith(".py"):
+            cog = cog[:-3]
+            print(f"Loading extension: {cog}")
+            bot.load_extension(f"cogs.{cog}")
+
+    TOKEN = dotenv_values()["BOT_TOKEN"]
+    bot.run(TOKEN)
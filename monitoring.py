@@ -0,0 +1,205 @@
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from pymongo import monitoring
+from config import SLOW_QUERY_MS
+
+# Upper bounds of each latency bucket, in ms. Anything slower goes in the last bucket
+BUCKETS = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+
+# Commands that aren't queries on a collection
+IGNORED_COMMANDS = {"hello", "ismaster", "isMaster", "ping", "buildInfo", "endSessions", "saslStart", "saslContinue"}
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ms: float):
+        self.buckets[bisect_left(BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, percent: float) -> float:
+        """Upper bound of the bucket the percentile falls in"""
+        target = self.count * percent / 100
+        seen = 0
+        for bound, count in zip(BUCKETS + [self.max], self.buckets):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+
+        return self.max
+
+    def summary(self) -> str:
+        return "{} ops, avg {:.1f}ms, p50/p95 <{:.0f}/{:.0f}ms, max {:.0f}ms".format(
+            self.count, self.total / self.count, self.percentile(50), self.percentile(95), self.max)
+
+
+def query_shape(value):
+    """Replace the values in a filter with ?, so it can be logged without anyone's details"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [query_shape(item) for item in value[:1]]
+    else:
+        return "?"
+
+
+def command_filter(command: dict):
+    """Find the filter (or pipeline) in a command"""
+    for key in ("filter", "query", "pipeline"):
+        if key in command:
+            return command[key]
+
+    # Deletes and updates are sent in batches
+    for key in ("deletes", "updates"):
+        if command.get(key):
+            return command[key][0].get("q")
+
+    return None
+
+
+class QueryStats:
+    def __init__(self):
+        # (collection, operation): Histogram
+        self.latency = {}
+        self.checkout_wait = Histogram()
+        self.failures = 0
+        self.since = time.time()
+
+
+class DatabaseMonitor(monitoring.CommandListener, monitoring.ConnectionPoolListener):
+    """
+    Times every Mongo command and connection checkout. Motor runs these from its worker threads, so everything is
+    behind a lock
+    """
+
+    def __init__(self, slow_query_ms: float = SLOW_QUERY_MS):
+        self.slow_query_ms = slow_query_ms
+        self.lock = threading.Lock()
+
+        # Since startup, and since the last periodic summary
+        self.total = QueryStats()
+        self.recent = QueryStats()
+
+        self.slow_queries = deque(maxlen=20)
+
+        # (connection, request id): (collection, operation, command) for commands in progress
+        self.started_commands = {}
+        # When the current thread started waiting for a connection
+        self.checkout = threading.local()
+
+    def reset_recent(self) -> QueryStats:
+        """Start a new summary period, returning the stats for the last one"""
+        with self.lock:
+            recent, self.recent = self.recent, QueryStats()
+
+        return recent
+
+    # Commands
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            # Eg. getMore, which only has a cursor id
+            collection = event.command.get("collection", "-")
+
+        with self.lock:
+            self.started_commands[(event.connection_id, event.request_id)] = \
+                (collection, event.command_name, command_filter(event.command))
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self.finished(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self.finished(event, failed=True)
+
+    def finished(self, event, failed: bool = False):
+        with self.lock:
+            command = self.started_commands.pop((event.connection_id, event.request_id), None)
+            if command is None:
+                return
+
+            collection, operation, query = command
+            ms = event.duration_micros / 1000
+
+            for stats in (self.total, self.recent):
+                stats.latency.setdefault((collection, operation), Histogram()).add(ms)
+                stats.failures += failed
+
+        if ms >= self.slow_query_ms:
+            shape = query_shape(query) if query is not None else None
+            self.slow_queries.append((time.time(), collection, operation, shape, ms))
+            print(f"Slow query ({ms:.0f}ms): {collection}.{operation} {shape}")
+
+    # Connection pool
+
+    def connection_check_out_started(self, event):
+        self.checkout.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        started = getattr(self.checkout, "started", None)
+        if started is None:
+            return
+
+        ms = (time.perf_counter() - started) * 1000
+        self.checkout.started = None
+
+        with self.lock:
+            self.total.checkout_wait.add(ms)
+            self.recent.checkout_wait.add(ms)
+
+    def connection_check_out_failed(self, event):
+        self.checkout.started = None
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+
+def stats_summary(stats: QueryStats, limit: int = 15) -> str:
+    """The slowest collections/operations first"""
+    lines = []
+    ordered = sorted(stats.latency.items(), key=lambda item: item[1].total, reverse=True)
+    for (collection, operation), histogram in ordered[:limit]:
+        lines.append(f"{collection}.{operation}: {histogram.summary()}")
+
+    if stats.checkout_wait.count:
+        lines.append(f"Pool checkout: {stats.checkout_wait.summary()}")
+
+    if stats.failures:
+        lines.append(f"{stats.failures} failed")
+
+    return "\n".join(lines)
+
+
+database_monitor = DatabaseMonitor()
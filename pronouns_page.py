@@ -0,0 +1,130 @@
+import asyncio
+import time
+import aiohttp
+from cache import LRUCache, SingleFlight
+from config import PRONOUNS_PAGE_FRESH, PRONOUNS_PAGE_MAX_STALE, PRONOUNS_PAGE_TIMEOUT, PRONOUNS_PAGE_CACHE_ENTRIES
+
+PRONOUNS_PAGE_URL = "https://en.pronouns.page/api/profile/get/{}?version=2"
+
+# Refreshes carry on in the background after PRONOUNS_PAGE_TIMEOUT, but not forever
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30)
+
+
+class PronounsPageError(Exception):
+    """pronouns.page couldn't be reached, and there was no cached copy to use instead"""
+
+
+class CachedProfile:
+    def __init__(self, data: dict, etag: str, last_modified: str):
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.fetched
+
+
+class ProfileCache:
+    """
+    pronouns.page API responses by username. Fresh ones are used as they are, stale ones are used while they're
+    refreshed in the background, and refreshes send the ETag/Last-Modified so unchanged profiles come back as a 304.
+    If pronouns.page is slow or down, the cached copy is used no matter how old it is
+    """
+
+    def __init__(self, max_entries: int, fresh: float, max_stale: float, timeout: float, url: str = PRONOUNS_PAGE_URL):
+        self.fresh = fresh
+        self.max_stale = max_stale
+        self.timeout = timeout
+        self.url = url
+
+        # username: CachedProfile - Each entry counts as 1, so it's bounded by the number of them
+        self.cache = LRUCache(max_entries, sizeof=lambda _: 1)
+
+        # Concurrent lookups for the same username share one request
+        self.requests = SingleFlight()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.fallbacks = 0
+        self.errors = 0
+
+    async def get(self, session: aiohttp.ClientSession, username: str) -> dict:
+        entry = self.cache.get(username)
+        if entry and entry.age() < self.fresh:
+            self.hits += 1
+            return entry.data
+
+        task = self.requests.start(username, self.load, session, username)
+
+        if entry and entry.age() < self.max_stale:
+            self.stale_hits += 1
+            return entry.data
+
+        self.misses += 1
+        try:
+            # Shield so the request still finishes and gets cached after the timeout
+            return await asyncio.wait_for(asyncio.shield(task), self.timeout)
+        except (asyncio.TimeoutError, PronounsPageError) as error:
+            if entry:
+                self.fallbacks += 1
+                return entry.data
+
+            if isinstance(error, asyncio.TimeoutError):
+                raise PronounsPageError(f"No response in {self.timeout}s") from error
+            raise
+
+    async def load(self, session: aiohttp.ClientSession, username: str) -> dict:
+        try:
+            return await self.fetch(session, username)
+        except PronounsPageError as error:
+            # Background refreshes have nobody waiting on them, so this is the only place their errors show up
+            self.errors += 1
+            print(f"pronouns.page request failed: {error}")
+            raise
+
+    async def fetch(self, session: aiohttp.ClientSession, username: str) -> dict:
+        entry = self.cache.get(username)
+
+        headers = {}
+        if entry and entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry and entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+
+        try:
+            async with session.get(self.url.format(username), headers=headers, timeout=REQUEST_TIMEOUT) as response:
+                if response.status == 304 and entry:
+                    self.not_modified += 1
+                    entry.fetched = time.monotonic()
+                    return entry.data
+
+                if response.status != 200:
+                    raise PronounsPageError(f"Status {response.status} for {username}")
+
+                data = await response.json()
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            raise PronounsPageError(f"{type(error).__name__} for {username}: {error}") from error
+
+        self.cache.put(username, CachedProfile(data, etag, last_modified))
+        return data
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "coalesced": self.requests.coalesced,
+            "fallbacks": self.fallbacks,
+            "errors": self.errors,
+            "entries": len(self.cache),
+        }
+
+
+profiles = ProfileCache(PRONOUNS_PAGE_CACHE_ENTRIES, PRONOUNS_PAGE_FRESH, PRONOUNS_PAGE_MAX_STALE,
+                        PRONOUNS_PAGE_TIMEOUT)
@@ -0,0 +1,63 @@
+from collections import OrderedDict
+from config import RAID_JOIN_THRESHOLD, RAID_WINDOW
+import time
+
+
+class JoinBurstDetector:
+    """
+    Detects join raids from the number of joins in a sliding window. While above the threshold, joins should be handled
+    in batches rather than one at a time. Several cogs listen for joins, so recording the same member twice is ignored
+    """
+
+    def __init__(self, threshold: int, window: float):
+        self.threshold = threshold
+        self.window = window
+
+        # member ID: time joined - Oldest first
+        self.joins = OrderedDict()
+
+        self.batch_mode = False
+        self.batch_started = 0
+
+        # Stats
+        self.triggered = 0
+        self.batched_joins = 0
+        self.batch_seconds = 0
+
+    def record_join(self, member_id: int) -> bool:
+        """Record a join, returning whether it should be handled in batch mode"""
+        now = time.monotonic()
+
+        new = member_id not in self.joins
+        if new:
+            self.joins[member_id] = now
+
+        batch_mode = self.update(now)
+        if batch_mode and new:
+            self.batched_joins += 1
+
+        return batch_mode
+
+    def update(self, now: float = None) -> bool:
+        """Drop joins outside the window and switch modes if needed. Returns whether batch mode is active"""
+        if now is None:
+            now = time.monotonic()
+
+        while self.joins and next(iter(self.joins.values())) < now - self.window:
+            self.joins.popitem(last=False)
+
+        if not self.batch_mode and len(self.joins) >= self.threshold:
+            self.batch_mode = True
+            self.batch_started = now
+            self.triggered += 1
+            print(f"Join burst detected ({len(self.joins)} joins in {self.window}s), switching to batch mode")
+
+        elif self.batch_mode and len(self.joins) < self.threshold:
+            self.batch_mode = False
+            self.batch_seconds += now - self.batch_started
+            print("Join rate has dropped, leaving batch mode")
+
+        return self.batch_mode
+
+
+join_bursts = JoinBurstDetector(RAID_JOIN_THRESHOLD, RAID_WINDOW)
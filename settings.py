@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from cache import TTLCache
+from storage import storage
+from config import SETTINGS_CACHE_TTL, SETTINGS_CACHE_MISSING_TTL, SETTINGS_CACHE_ENTRIES, SETTINGS_WARM_USERS
+
+# Cached settings can be None, so this marks there being nothing cached
+NOT_CACHED = object()
+
+
+class SettingsCache:
+    """
+    User settings from storage, cached for a while. Users without the setting are cached too (for a shorter time), as
+    that's most people. Settings changed through here are dropped from the cache straight away
+    """
+
+    def __init__(self, max_entries: int, ttl: float, missing_ttl: float, active_users: int):
+        # (user_id, key): value
+        self.cache = TTLCache(max_entries, ttl)
+        self.missing_ttl = missing_ttl
+        self.missing_hits = 0
+
+        # user_id: None - Most recently active last, for warming the cache
+        self.active = OrderedDict()
+        self.active_users = active_users
+        self.warmed = 0
+
+    async def get(self, user_id: int, key: str):
+        value = self.cache.get((user_id, key), NOT_CACHED)
+        if value is not NOT_CACHED:
+            self.missing_hits += value is None
+            return value
+
+        value = await storage.get_setting(user_id, key)
+        self.put(user_id, key, value)
+
+        return value
+
+    async def set(self, user_id: int, key: str, value):
+        await storage.set_setting(user_id, key, value)
+        self.cache.pop((user_id, key))
+
+    def put(self, user_id: int, key: str, value):
+        self.cache.put((user_id, key), value, self.missing_ttl if value is None else None)
+
+    def seen(self, user_id: int):
+        """Note a user as active, so their settings are loaded in the next warm()"""
+        self.active.pop(user_id, None)
+        self.active[user_id] = None
+
+        if len(self.active) > self.active_users:
+            self.active.popitem(last=False)
+
+    async def warm(self, key: str) -> int:
+        """Load the setting for recently active users that don't have it cached, in one query. Returns how many"""
+        user_ids = [user_id for user_id in self.active if (user_id, key) not in self.cache]
+        if not user_ids:
+            return 0
+
+        values = await storage.get_settings(user_ids, key)
+        for user_id in user_ids:
+            self.put(user_id, key, values.get(user_id))
+
+        self.warmed += len(user_ids)
+        return len(user_ids)
+
+    def stats(self) -> dict:
+        stats = self.cache.stats()
+        stats["missing_hits"] = self.missing_hits
+        stats["warmed"] = self.warmed
+        stats["active"] = len(self.active)
+
+        return stats
+
+
+settings = SettingsCache(SETTINGS_CACHE_ENTRIES, SETTINGS_CACHE_TTL, SETTINGS_CACHE_MISSING_TTL, SETTINGS_WARM_USERS)
@@ -0,0 +1,1039 @@
+import asyncio
+import datetime as dt
+import json
+import sqlite3
+import time
+import zlib
+import heapq
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import AsyncIterator, Optional
+import bson
+from pymongo import ReturnDocument, ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, ExecutionTimeout
+from config import STORAGE_BACKEND, SQLITE_PATH, COUNTER_BLOCKS, ARCHIVE_COMPRESS, ID_COMPAT_READS
+
+# Kept uncompressed in archived cases so they can still be queried
+ARCHIVE_FIELDS = ["case", "user", "type", "timestamp"]
+DUPLICATE_KEY = 11000
+
+CASE_FIELDS = ["case", "user", "mod", "type", "duration", "reason", "timestamp"]
+
+# collection: fields holding Discord IDs, which used to be stored as strings
+ID_FIELDS = {
+    "mod_logs": ["user", "mod"],
+    "mod_logs_archive": ["user", "mod"],
+    "modmails": ["channel", "user"],
+    "pending": ["user"],
+    "qotds": ["credit"],
+}
+
+
+class SearchTimeout(Exception):
+    """A case search took longer than it was allowed"""
+
+
+class Storage(ABC):
+    """
+    Everything the cogs store. Case filters are passed as keyword arguments, any of:
+    user, log_type, exclude_type, mod, start, end (timestamps, end is exclusive)
+    """
+
+    async def setup(self):
+        """Get ready to be used, eg. creating indexes or tables"""
+
+    # Counters
+
+    @abstractmethod
+    async def reserve_numbers(self, counter_id: str, amount: int) -> int:
+        """Reserve the next `amount` numbers from a counter, returning the first. Missing counters start at 1"""
+
+    # Mod logs
+
+    @abstractmethod
+    async def insert_case(self, case: dict):
+        ...
+
+    @abstractmethod
+    async def find_case(self, case_number: int) -> Optional[dict]:
+        """Look up a case, checking the archive if it's not a recent one"""
+
+    @abstractmethod
+    async def delete_case(self, case_number: int):
+        ...
+
+    @abstractmethod
+    async def case_page(self, before: Optional[int], limit: int, archived: bool = False, **filters) -> list:
+        """Cases newest first, starting after the `before` case number"""
+
+    @abstractmethod
+    async def search_cases(self, search: str, after: Optional[tuple], limit: int, timeout_ms: int, **filters) -> list:
+        """
+        Cases whose reason matches the search, best match first. Each has a "score", and `after` is the (score, case)
+        of the last result seen. Raises SearchTimeout if it takes longer than timeout_ms
+        """
+
+    @abstractmethod
+    async def count_cases(self, archived: bool = False, **filters) -> int:
+        ...
+
+    @abstractmethod
+    def iter_cases(self, sort: str, batch_size: int, archived: bool = False, **filters) -> AsyncIterator[dict]:
+        """Every matching case sorted by `sort`, fetched batch_size at a time. Archived cases are merged in by `sort`"""
+
+    @abstractmethod
+    async def archive_cases(self, cutoff: dt.datetime, batch_size: int) -> int:
+        """Move cases (other than notes) from before the cutoff into the archive, returning how many were moved"""
+
+    @abstractmethod
+    async def case_stats(self) -> dict:
+        """name: {"count", "storage_bytes", "index_bytes"} for the live and archived cases"""
+
+    # Mod log summaries
+
+    @abstractmethod
+    async def add_to_summary(self, case: dict, cutoff: dt.datetime):
+        ...
+
+    @abstractmethod
+    async def remove_from_summary(self, case: dict, cutoff: dt.datetime):
+        ...
+
+    @abstractmethod
+    async def get_summary(self, user_id: int, cutoff: dt.datetime) -> dict:
+        """
+        {"counts": {type: count}, "active": [cases since the cutoff]}. Stays right even if a case was written without
+        its summary update
+        """
+
+    @abstractmethod
+    async def rebuild_summaries(self, cutoff: dt.datetime):
+        """Remake every summary from the cases, removing those of users who don't have any cases anymore"""
+
+    @abstractmethod
+    async def summaries_empty(self) -> bool:
+        ...
+
+    # Mod mails
+
+    @abstractmethod
+    async def all_modmails(self) -> list:
+        ...
+
+    @abstractmethod
+    async def find_modmail(self, user_id: int) -> Optional[dict]:
+        ...
+
+    @abstractmethod
+    async def add_modmail(self, channel_id: int, user_id: int):
+        ...
+
+    @abstractmethod
+    async def delete_modmail(self, channel_id: int, user_id: int):
+        ...
+
+    # Pending actions
+
+    @abstractmethod
+    async def add_pending(self, entry: dict):
+        """Returns an id for delete_pending"""
+
+    @abstractmethod
+    async def delete_pending(self, entry_id):
+        ...
+
+    @abstractmethod
+    async def pending_of_type(self, entry_type: str) -> list:
+        ...
+
+    # QOTDs
+
+    @abstractmethod
+    async def add_qotd(self, question: str, credit: int):
+        ...
+
+    @abstractmethod
+    async def all_qotds(self) -> list:
+        ...
+
+    @abstractmethod
+    async def pop_qotd(self) -> Optional[dict]:
+        """Remove and return the oldest QOTD"""
+
+    @abstractmethod
+    async def count_qotds(self) -> int:
+        ...
+
+    # Settings
+
+    @abstractmethod
+    async def get_setting(self, user_id: int, key: str):
+        ...
+
+    @abstractmethod
+    async def get_settings(self, user_ids: list, key: str) -> dict:
+        """user_id: value, for the users who have the setting"""
+
+    @abstractmethod
+    async def set_setting(self, user_id: int, key: str, value):
+        ...
+
+    # Diagnostics
+
+    @abstractmethod
+    async def migrate_ids(self, batch_size: int, progress=None) -> dict:
+        """
+        Convert any IDs still stored as strings to ints, batch_size documents at a time. Safe to stop and run again.
+        Calls `await progress(collection, converted so far)` after each batch. Returns collection: documents converted
+        """
+
+    @abstractmethod
+    async def index_sizes(self) -> dict:
+        """collection: bytes used by its indexes"""
+
+    @abstractmethod
+    async def explain_queries(self) -> list:
+        """(name, stages, is a full scan) for each query the cogs make"""
+
+
+@contextmanager
+def compat_reads(enabled: bool):
+    """Temporarily change ID_COMPAT_READS, eg. to time lookups like they'll be once it's turned off"""
+    global ID_COMPAT_READS
+    previous, ID_COMPAT_READS = ID_COMPAT_READS, enabled
+    try:
+        yield
+    finally:
+        ID_COMPAT_READS = previous
+
+
+def id_match(value: int):
+    """While IDs are being migrated, they could be stored either way"""
+    if ID_COMPAT_READS:
+        return {"$in": [value, str(value)]}
+
+    return value
+
+
+def case_query(user: int = None, log_type: str = None, exclude_type: str = None, mod: int = None,
+               start: dt.datetime = None, end: dt.datetime = None, before: int = None) -> dict:
+    query = {}
+
+    if user:
+        query["user"] = id_match(user)
+    if log_type:
+        query["type"] = log_type
+    elif exclude_type:
+        query["type"] = {"$ne": exclude_type}
+    if mod:
+        query["mod"] = id_match(mod)
+    if start or end:
+        query["timestamp"] = {}
+        if start:
+            query["timestamp"]["$gte"] = start
+        if end:
+            query["timestamp"]["$lt"] = end
+    if before is not None:
+        query["case"] = {"$lt": before}
+
+    return query
+
+
+def archive_case(case: dict) -> dict:
+    if not ARCHIVE_COMPRESS:
+        return case
+
+    archived = {field: case[field] for field in ARCHIVE_FIELDS}
+    archived["_id"] = case["_id"]
+    archived["compressed"] = bson.Binary(zlib.compress(bson.encode(case)))
+    return archived
+
+
+def unarchive_case(case: dict) -> dict:
+    """Undo archive_case(). Fine to use on cases that were never archived"""
+    if "compressed" in case:
+        # The uncompressed fields may have been updated since, eg. by migrate_ids()
+        unarchived = bson.decode(zlib.decompress(case["compressed"]))
+        unarchived.update({field: case[field] for field in ARCHIVE_FIELDS})
+
+        # Compressed before the IDs were migrated, and migrate_ids() can't reach inside
+        if isinstance(unarchived.get("mod"), str):
+            unarchived["mod"] = int(unarchived["mod"])
+
+        return unarchived
+
+    return case
+
+
+async def merge_sorted(sort: str, *streams: AsyncIterator[dict]) -> AsyncIterator[dict]:
+    """Like heapq.merge(), for streams of cases that are each already sorted by `sort`"""
+    async def push(index: int):
+        try:
+            case = await streams[index].__anext__()
+        except StopAsyncIteration:
+            return
+
+        # The index breaks ties, so cases themselves are never compared
+        heapq.heappush(heap, (case[sort], index, case))
+
+    heap = []
+    for index in range(len(streams)):
+        await push(index)
+
+    while heap:
+        _, index, case = heapq.heappop(heap)
+        yield case
+        await push(index)
+
+
+def active_cases(active, cutoff: dt.datetime) -> dict:
+    """Filter out expired cases from a summary's active cases"""
+    return {"$filter": {"input": {"$ifNull": [active, []]}, "cond": {"$gt": ["$$this.timestamp", cutoff]}}}
+
+
+def summary_add_update(case: dict, cutoff: dt.datetime) -> list:
+    """Update pipeline adding a case to its user's summary, dropping expired active cases while it's there"""
+    active = active_cases("$active", cutoff)
+    if case["type"] != "note":
+        active = {"$concatArrays": [active, [{"case": case["case"], "type": case["type"],
+                                              "timestamp": case["timestamp"]}]]}
+
+    return [{"$set": {
+        f"counts.{case['type']}": {"$add": [{"$ifNull": [f"$counts.{case['type']}", 0]}, 1]},
+        "active": active,
+        "pending": decrement("$pending"),
+    }}]
+
+
+def summary_remove_update(case: dict, cutoff: dt.datetime) -> list:
+    """Update pipeline taking a deleted case out of its user's summary"""
+    active = {"$filter": {"input": active_cases("$active", cutoff), "cond": {"$ne": ["$$this.case", case["case"]]}}}
+
+    return [{"$set": {
+        f"counts.{case['type']}": decrement(f"$counts.{case['type']}"),
+        "active": active,
+        "pending": decrement("$pending"),
+    }}]
+
+
+def decrement(field: str) -> dict:
+    """Take one off a field, stopping at 0"""
+    return {"$max": [{"$subtract": [{"$ifNull": [field, 0]}, 1]}, 0]}
+
+
+def summary_pipeline(cutoff: dt.datetime, match: dict = None, rebuilt: bson.ObjectId = None) -> list:
+    """Aggregation making the summaries of everyone with cases matching `match`, written into mod_log_summaries"""
+    match_stages = [{"$match": match}] if match else []
+    fields = {"$project": {"user": True, "type": True, "case": True, "timestamp": True}}
+
+    return [
+        *match_stages,
+        fields,
+        # Archived cases still count towards the totals
+        {"$unionWith": {"coll": "mod_logs_archive", "pipeline": [*match_stages, fields]}},
+        {"$group": {
+            # Always keyed by the int ID, even for cases with an old string one
+            "_id": {"user": {"$toLong": "$user"}, "type": "$type"},
+            "count": {"$sum": 1},
+            "cases": {"$push": {"case": "$case", "type": "$type", "timestamp": "$timestamp"}},
+        }},
+        {"$group": {
+            "_id": "$_id.user",
+            "counts": {"$push": {"k": "$_id.type", "v": "$count"}},
+            "cases": {"$push": "$cases"},
+        }},
+        {"$project": {
+            "counts": {"$arrayToObject": "$counts"},
+            "active": {"$filter": {
+                "input": {"$reduce": {"input": "$cases", "initialValue": [],
+                                       "in": {"$concatArrays": ["$$value", "$$this"]}}},
+                "cond": {"$and": [{"$ne": ["$$this.type", "note"]}, {"$gt": ["$$this.timestamp", cutoff]}]},
+            }},
+            # Which rebuild made it, so ones it didn't (users with no cases anymore) can be removed
+            "rebuilt": {"$literal": rebuilt},
+        }},
+        {"$merge": {"into": "mod_log_summaries", "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+
+
+class MongoStorage(Storage):
+    def __init__(self, db):
+        self.db = db
+
+    async def setup(self):
+        from db import ensure_indexes
+        await ensure_indexes()
+
+    async def reserve_numbers(self, counter_id: str, amount: int) -> int:
+        counter = await self.db.counters.find_one_and_update(
+            {"_id": counter_id},
+            [{"$set": {"value": {"$add": [{"$ifNull": ["$value", 1]}, amount]}}}],
+            upsert=True, return_document=ReturnDocument.AFTER)
+
+        return counter["value"] - amount
+
+    async def insert_case(self, case: dict):
+        await self.mark_summary(case["user"])
+        await self.db.mod_logs.insert_one(case)
+
+    async def find_case(self, case_number: int) -> Optional[dict]:
+        case = await self.db.mod_logs.find_one({"case": case_number})
+        if case:
+            return case
+
+        case = await self.db.mod_logs_archive.find_one({"case": case_number})
+        if case:
+            return unarchive_case(case)
+
+        return None
+
+    async def delete_case(self, case_number: int):
+        case = await self.find_case(case_number)
+        if not case:
+            return
+
+        await self.mark_summary(case["user"])
+        result = await self.db.mod_logs.delete_one({"case": case_number})
+        if not result.deleted_count:
+            await self.db.mod_logs_archive.delete_one({"case": case_number})
+
+    async def case_page(self, before: Optional[int], limit: int, archived: bool = False, **filters) -> list:
+        query = case_query(before=before, **filters)
+        collections = [self.db.mod_logs, self.db.mod_logs_archive] if archived else [self.db.mod_logs]
+
+        cases = []
+        for collection in collections:
+            cases += await collection.find(query).sort("case", DESCENDING).limit(limit).to_list(limit)
+
+        if archived:
+            cases = sorted(map(unarchive_case, cases), key=lambda case: case["case"], reverse=True)[:limit]
+
+        return cases
+
+    async def search_cases(self, search: str, after: Optional[tuple], limit: int, timeout_ms: int, **filters) -> list:
+        pipeline = [
+            {"$match": {"$text": {"$search": search}, **case_query(**filters)}},
+            {"$addFields": {"score": {"$meta": "textScore"}}},
+        ]
+
+        if after is not None:
+            score, case = after
+            pipeline.append({"$match": {"$or": [
+                {"score": {"$lt": score}},
+                {"score": score, "case": {"$lt": case}},
+            ]}})
+
+        pipeline += [
+            {"$sort": {"score": DESCENDING, "case": DESCENDING}},
+            {"$limit": limit},
+        ]
+
+        try:
+            return await self.db.mod_logs.aggregate(pipeline, maxTimeMS=timeout_ms).to_list(limit)
+        except ExecutionTimeout:
+            raise SearchTimeout()
+
+    async def count_cases(self, archived: bool = False, **filters) -> int:
+        query = case_query(**filters)
+
+        count = await self.db.mod_logs.count_documents(query)
+        if archived:
+            count += await self.db.mod_logs_archive.count_documents(query)
+
+        return count
+
+    async def iter_cases(self, sort: str, batch_size: int, archived: bool = False, **filters) -> AsyncIterator[dict]:
+        query = case_query(**filters)
+        collections = [self.db.mod_logs_archive, self.db.mod_logs] if archived else [self.db.mod_logs]
+
+        # Notes are never archived, so the live cases can't just follow the archived ones
+        streams = [self.iter_collection(collection, query, sort, batch_size) for collection in collections]
+        async for case in merge_sorted(sort, *streams):
+            yield case
+
+    @staticmethod
+    async def iter_collection(collection, query: dict, sort: str, batch_size: int) -> AsyncIterator[dict]:
+        async for case in collection.find(query).sort(sort, ASCENDING).batch_size(batch_size):
+            yield unarchive_case(case)
+
+    async def archive_cases(self, cutoff: dt.datetime, batch_size: int) -> int:
+        query = {"timestamp": {"$lt": cutoff}, "type": {"$ne": "note"}}
+
+        moved = 0
+        while True:
+            cases = await self.db.mod_logs.find(query).sort("timestamp", ASCENDING).limit(batch_size) \
+                .to_list(batch_size)
+            if not cases:
+                return moved
+
+            try:
+                await self.db.mod_logs_archive.insert_many([archive_case(case) for case in cases], ordered=False)
+            except BulkWriteError as e:
+                # Already archived by a previous run that stopped before deleting them
+                if any(error["code"] != DUPLICATE_KEY for error in e.details["writeErrors"]):
+                    raise
+
+            await self.db.mod_logs.delete_many({"_id": {"$in": [case["_id"] for case in cases]}})
+            moved += len(cases)
+
+    async def case_stats(self) -> dict:
+        stats = {}
+        for name in ("mod_logs", "mod_logs_archive"):
+            collection_stats = await self.db.command("collStats", name)
+            stats[name] = {
+                "count": collection_stats.get("count", 0),
+                "storage_bytes": collection_stats.get("storageSize", 0),
+                "index_bytes": collection_stats.get("totalIndexSize", 0),
+            }
+
+        return stats
+
+    async def mark_summary(self, user_id: int):
+        """
+        Mark the summary as waiting on a case change. The case and the summary are written separately, so one can fail
+        without the other. add_to_summary() and remove_from_summary() clear the mark, and one left behind means the
+        summary is remade when it's next read
+        """
+        await self.db.mod_log_summaries.update_one({"_id": int(user_id)}, {"$inc": {"pending": 1}}, upsert=True)
+
+    async def add_to_summary(self, case: dict, cutoff: dt.datetime):
+        # One pipeline update so it's atomic
+        await self.db.mod_log_summaries.update_one({"_id": int(case["user"])}, summary_add_update(case, cutoff),
+                                                   upsert=True)
+
+    async def remove_from_summary(self, case: dict, cutoff: dt.datetime):
+        # Not id_match() - There could be one for each type of ID, and decrementing the wrong one would leave both
+        # wrong. Having both gets the summary remade when it's read
+        await self.db.mod_log_summaries.update_one({"_id": int(case["user"])}, summary_remove_update(case, cutoff))
+
+    async def get_summary(self, user_id: int, cutoff: dt.datetime) -> dict:
+        # There can be one for the old string ID and one for the int until the IDs are migrated
+        summaries = await self.db.mod_log_summaries.find({"_id": id_match(user_id)}).to_list(None)
+
+        # A case change that didn't make it into the summary, or summaries for both types of ID to merge
+        if len(summaries) > 1 or any(summary.get("pending") for summary in summaries):
+            return await self.rebuild_summary(user_id, cutoff)
+
+        summary = summaries[0] if summaries else {}
+        return {"counts": summary.get("counts", {}), "active": summary.get("active", [])}
+
+    async def rebuild_summary(self, user_id: int, cutoff: dt.datetime) -> dict:
+        """Remake one user's summary from their cases, returning it"""
+        # Nothing to merge if they have no cases left, so clear it out first
+        await self.db.mod_log_summaries.delete_many({"_id": id_match(user_id)})
+        await self.db.mod_logs.aggregate(summary_pipeline(cutoff, {"user": id_match(user_id)})).to_list(None)
+
+        summary = await self.db.mod_log_summaries.find_one({"_id": user_id}) or {}
+        return {"counts": summary.get("counts", {}), "active": summary.get("active", [])}
+
+    async def rebuild_summaries(self, cutoff: dt.datetime):
+        rebuilt = bson.ObjectId()
+        await self.db.mod_logs.aggregate(summary_pipeline(cutoff, rebuilt=rebuilt)).to_list(None)
+
+        # Users without any cases anymore aren't in the results, and $merge only adds and replaces. If a summary was
+        # added while this ran, it's remade the next time it's read
+        await self.db.mod_log_summaries.delete_many({"rebuilt": {"$ne": rebuilt}})
+
+    async def summaries_empty(self) -> bool:
+        return await self.db.mod_log_summaries.estimated_document_count() == 0
+
+    async def all_modmails(self) -> list:
+        return await self.db.modmails.find().to_list(None)
+
+    async def find_modmail(self, user_id: int) -> Optional[dict]:
+        return await self.db.modmails.find_one({"user": id_match(user_id)})
+
+    async def add_modmail(self, channel_id: int, user_id: int):
+        await self.db.modmails.insert_one({
+            "channel": channel_id,
+            "user": user_id,
+        })
+
+    async def delete_modmail(self, channel_id: int, user_id: int):
+        await self.db.modmails.delete_one({"channel": id_match(channel_id), "user": id_match(user_id)})
+
+    async def add_pending(self, entry: dict):
+        result = await self.db.pending.insert_one(entry)
+        return result.inserted_id
+
+    async def delete_pending(self, entry_id):
+        await self.db.pending.delete_one({"_id": entry_id})
+
+    async def pending_of_type(self, entry_type: str) -> list:
+        return await self.db.pending.find({"type": entry_type}).to_list(None)
+
+    async def add_qotd(self, question: str, credit: int):
+        await self.db.qotds.insert_one({
+            "question": question,
+            "credit": credit,
+        })
+
+    async def all_qotds(self) -> list:
+        return await self.db.qotds.find().to_list(None)
+
+    async def pop_qotd(self) -> Optional[dict]:
+        return await self.db.qotds.find_one_and_delete({})
+
+    async def count_qotds(self) -> int:
+        return await self.db.qotds.count_documents({})
+
+    async def get_setting(self, user_id: int, key: str):
+        entries = await self.db.settings.find({"_id": id_match(user_id), key: {"$ne": None}}, projection={key: True}) \
+            .to_list(None)
+
+        # Anything set since the IDs changed to ints is more recent
+        entries.sort(key=lambda entry: isinstance(entry["_id"], int), reverse=True)
+        return entries[0][key] if entries else None
+
+    async def get_settings(self, user_ids: list, key: str) -> dict:
+        ids = [*user_ids, *map(str, user_ids)] if ID_COMPAT_READS else list(user_ids)
+
+        settings = {}
+        async for entry in self.db.settings.find({"_id": {"$in": ids}, key: {"$ne": None}}, projection={key: True}):
+            # Anything set since the IDs changed to ints is more recent
+            if isinstance(entry["_id"], int) or int(entry["_id"]) not in settings:
+                settings[int(entry["_id"])] = entry[key]
+
+        return settings
+
+    async def set_setting(self, user_id: int, key: str, value):
+        await self.db.settings.update_one({"_id": user_id}, {"$set": {key: value}}, upsert=True)
+
+    async def migrate_ids(self, batch_size: int, progress=None) -> dict:
+        converted = {}
+
+        for name, fields in ID_FIELDS.items():
+            converted[name] = 0
+
+            for field in fields:
+                while True:
+                    entries = await self.db[name].find({field: {"$type": "string"}}, projection={field: True}) \
+                        .limit(batch_size).to_list(batch_size)
+                    if not entries:
+                        break
+
+                    # Matching the old value too, so anything changed in the meantime is left alone
+                    await self.db[name].bulk_write([
+                        UpdateOne({"_id": entry["_id"], field: entry[field]}, {"$set": {field: int(entry[field])}})
+                        for entry in entries
+                    ], ordered=False)
+
+                    converted[name] += len(entries)
+                    if progress:
+                        await progress(name, converted[name])
+
+        # _id can't be changed, so copy each entry to its int ID, without overwriting anything set there since
+        converted["settings"] = 0
+        while True:
+            entries = await self.db.settings.find({"_id": {"$type": "string"}}).limit(batch_size).to_list(batch_size)
+            if not entries:
+                break
+
+            for entry in entries:
+                fields = {key: value for key, value in entry.items() if key != "_id"}
+                await self.db.settings.update_one({"_id": int(entry["_id"])}, [
+                    {"$replaceWith": {"$mergeObjects": [{"$literal": fields}, "$$ROOT"]}},
+                ], upsert=True)
+                await self.db.settings.delete_one({"_id": entry["_id"]})
+
+            converted["settings"] += len(entries)
+            if progress:
+                await progress("settings", converted["settings"])
+
+        # Summaries with string IDs are out of date now, and need rebuilding from the cases
+        result = await self.db.mod_log_summaries.delete_many({"_id": {"$type": "string"}})
+        converted["mod_log_summaries"] = result.deleted_count
+
+        return converted
+
+    async def index_sizes(self) -> dict:
+        sizes = {}
+        for name in [*ID_FIELDS, "settings", "mod_log_summaries"]:
+            stats = await self.db.command("collStats", name)
+            sizes[name] = stats.get("totalIndexSize", 0)
+
+        return sizes
+
+    async def explain_queries(self) -> list:
+        from db import explain_queries
+        return await explain_queries()
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS counters (id TEXT PRIMARY KEY, value INTEGER NOT NULL);
+
+CREATE TABLE IF NOT EXISTS mod_logs (
+    "case" INTEGER PRIMARY KEY, user INTEGER NOT NULL, mod INTEGER, type TEXT NOT NULL, duration REAL, reason TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mod_logs_user_case ON mod_logs (user, "case");
+CREATE INDEX IF NOT EXISTS mod_logs_timestamp ON mod_logs (timestamp);
+
+CREATE TABLE IF NOT EXISTS mod_logs_archive (
+    "case" INTEGER PRIMARY KEY, user INTEGER NOT NULL, mod INTEGER, type TEXT NOT NULL, duration REAL, reason TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mod_logs_archive_user_case ON mod_logs_archive (user, "case");
+
+CREATE TABLE IF NOT EXISTS modmails (channel INTEGER NOT NULL, user INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS modmails_user ON modmails (user);
+
+CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY, type TEXT NOT NULL, user INTEGER, timestamp TEXT);
+CREATE INDEX IF NOT EXISTS pending_type ON pending (type);
+
+CREATE TABLE IF NOT EXISTS qotds (id INTEGER PRIMARY KEY, question TEXT NOT NULL, credit INTEGER);
+
+CREATE TABLE IF NOT EXISTS settings (
+    user INTEGER NOT NULL, key TEXT NOT NULL, value TEXT, PRIMARY KEY (user, key)
+);
+"""
+
+# The same queries as db.QUERY_SHAPES, for explain_queries()
+SQLITE_QUERY_SHAPES = [
+    ("modlogs", 'SELECT * FROM mod_logs WHERE user = ? AND "case" < ? ORDER BY "case" DESC LIMIT 25', (0, 0)),
+    ("export dates", "SELECT * FROM mod_logs WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp", ("0", "0")),
+    ("getcase", 'SELECT * FROM mod_logs WHERE "case" = ?', (0,)),
+    ("modmail by user", "SELECT * FROM modmails WHERE user = ?", (0,)),
+    ("pending roles", "SELECT * FROM pending WHERE type = ?", ("member_role",)),
+    ("counter", "SELECT * FROM counters WHERE id = ?", ("modlog",)),
+    ("settings", "SELECT * FROM settings WHERE user = ? AND key = ?", (0, "pronouns_page")),
+]
+
+
+def to_utc(timestamp: dt.datetime) -> dt.datetime:
+    """Mongo hands back naive UTC datetimes, so do the same here"""
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def case_where(user: int = None, log_type: str = None, exclude_type: str = None, mod: int = None,
+               start: dt.datetime = None, end: dt.datetime = None, before: int = None) -> tuple:
+    """The SQL version of case_query(), as (where clause, params)"""
+    clauses = []
+    params = []
+
+    if user:
+        clauses.append("user = ?")
+        params.append(user)
+    if log_type:
+        clauses.append("type = ?")
+        params.append(log_type)
+    elif exclude_type:
+        clauses.append("type != ?")
+        params.append(exclude_type)
+    if mod:
+        clauses.append("mod = ?")
+        params.append(mod)
+    if start:
+        clauses.append("timestamp >= ?")
+        params.append(to_utc(start).isoformat())
+    if end:
+        clauses.append("timestamp < ?")
+        params.append(to_utc(end).isoformat())
+    if before is not None:
+        clauses.append('"case" < ?')
+        params.append(before)
+
+    return " AND ".join(clauses) or "1", params
+
+
+def escape_like(text: str) -> str:
+    """Make LIKE match % and _ literally, instead of as wildcards"""
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def row_to_case(row: sqlite3.Row) -> dict:
+    case = {field: row[field] for field in CASE_FIELDS}
+    case["timestamp"] = dt.datetime.fromisoformat(case["timestamp"])
+    case["_id"] = case["case"]
+    if "score" in row.keys():
+        case["score"] = row["score"]
+
+    return case
+
+
+class SQLiteStorage(Storage):
+    """
+    Keeps everything in SQLite, in memory by default. Doesn't need a database server, so is handy for benchmarks and
+    trying things out. Queries are quick enough to run straight on the event loop
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(SQLITE_SCHEMA)
+
+    def execute(self, query: str, params=()) -> list:
+        with self.connection:
+            # Fetched inside the transaction, as it can't be committed with RETURNING rows left unread
+            return self.connection.execute(query, params).fetchall()
+
+    def fetch_one(self, query: str, params=()) -> Optional[sqlite3.Row]:
+        rows = self.execute(query, params)
+        return rows[0] if rows else None
+
+    async def reserve_numbers(self, counter_id: str, amount: int) -> int:
+        row = self.fetch_one("INSERT INTO counters VALUES (?, 1 + ?) "
+                           "ON CONFLICT (id) DO UPDATE SET value = value + excluded.value - 1 RETURNING value",
+                           (counter_id, amount))
+        return row["value"] - amount
+
+    async def insert_case(self, case: dict):
+        self.execute("INSERT INTO mod_logs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (case["case"], case["user"], case["mod"], case["type"], case["duration"], case["reason"],
+                      to_utc(case["timestamp"]).isoformat()))
+
+    async def find_case(self, case_number: int) -> Optional[dict]:
+        for table in ("mod_logs", "mod_logs_archive"):
+            row = self.fetch_one(f'SELECT * FROM {table} WHERE "case" = ?', (case_number,))
+            if row:
+                return row_to_case(row)
+
+        return None
+
+    async def delete_case(self, case_number: int):
+        for table in ("mod_logs", "mod_logs_archive"):
+            self.execute(f'DELETE FROM {table} WHERE "case" = ?', (case_number,))
+
+    async def case_page(self, before: Optional[int], limit: int, archived: bool = False, **filters) -> list:
+        where, params = case_where(before=before, **filters)
+        query = f"SELECT * FROM mod_logs WHERE {where}"
+        if archived:
+            query += f" UNION ALL SELECT * FROM mod_logs_archive WHERE {where}"
+            params += params
+
+        rows = self.execute(query + ' ORDER BY "case" DESC LIMIT ?', (*params, limit))
+        return [row_to_case(row) for row in rows]
+
+    async def search_cases(self, search: str, after: Optional[tuple], limit: int, timeout_ms: int, **filters) -> list:
+        # No text index, so score by how many of the words are in the reason
+        words = search.split()
+        if not words:
+            return []
+
+        where, params = case_where(**filters)
+        score = " + ".join(["(reason LIKE ? ESCAPE '\\')"] * len(words))
+        query = f"SELECT * FROM (SELECT *, {score} AS score FROM mod_logs WHERE {where}) WHERE score > 0"
+        params = [f"%{escape_like(word)}%" for word in words] + params
+
+        if after is not None:
+            query += ' AND (score < ? OR (score = ? AND "case" < ?))'
+            params += [after[0], after[0], after[1]]
+
+        # Abort the query once it runs over the time limit, like maxTimeMS
+        deadline = time.monotonic() + timeout_ms / 1000
+        self.connection.set_progress_handler(lambda: time.monotonic() > deadline, 1000)
+        try:
+            rows = self.execute(query + ' ORDER BY score DESC, "case" DESC LIMIT ?', (*params, limit))
+        except sqlite3.OperationalError as e:
+            if str(e) == "interrupted":
+                raise SearchTimeout()
+            raise
+        finally:
+            self.connection.set_progress_handler(None, 0)
+
+        return [row_to_case(row) for row in rows]
+
+    async def count_cases(self, archived: bool = False, **filters) -> int:
+        where, params = case_where(**filters)
+
+        count = self.fetch_one(f"SELECT COUNT(*) FROM mod_logs WHERE {where}", params)[0]
+        if archived:
+            count += self.fetch_one(f"SELECT COUNT(*) FROM mod_logs_archive WHERE {where}", params)[0]
+
+        return count
+
+    async def iter_cases(self, sort: str, batch_size: int, archived: bool = False, **filters) -> AsyncIterator[dict]:
+        where, params = case_where(**filters)
+        tables = ["mod_logs_archive", "mod_logs"] if archived else ["mod_logs"]
+
+        # Notes are never archived, so the live cases can't just follow the archived ones
+        streams = [self.iter_table(table, where, params, sort, batch_size) for table in tables]
+        async for case in merge_sorted(sort, *streams):
+            yield case
+
+    async def iter_table(self, table: str, where: str, params: list, sort: str, batch_size: int) \
+            -> AsyncIterator[dict]:
+        cursor = self.connection.execute(f'SELECT * FROM {table} WHERE {where} ORDER BY "{sort}"', params)
+        while rows := cursor.fetchmany(batch_size):
+            for row in rows:
+                yield row_to_case(row)
+
+            # Let everything else have a go between batches
+            await asyncio.sleep(0)
+
+    async def archive_cases(self, cutoff: dt.datetime, batch_size: int) -> int:
+        moved = 0
+        while True:
+            # A transaction per batch, so the database isn't locked for the whole run
+            with self.connection:
+                rows = self.connection.execute("SELECT \"case\" FROM mod_logs WHERE timestamp < ? AND type != 'note' "
+                                               "ORDER BY timestamp LIMIT ?",
+                                               (to_utc(cutoff).isoformat(), batch_size)).fetchall()
+                if not rows:
+                    return moved
+
+                cases = [row[0] for row in rows]
+                in_batch = f'"case" IN ({", ".join("?" * len(cases))})'
+
+                # Ignoring ones already archived, like the Mongo version
+                self.connection.execute(
+                    f"INSERT OR IGNORE INTO mod_logs_archive SELECT * FROM mod_logs WHERE {in_batch}", cases)
+                self.connection.execute(f"DELETE FROM mod_logs WHERE {in_batch}", cases)
+
+            moved += len(cases)
+
+            # Let everything else have a go between batches
+            await asyncio.sleep(0)
+
+    async def case_stats(self) -> dict:
+        stats = {}
+        for name in ("mod_logs", "mod_logs_archive"):
+            stats[name] = {
+                "count": self.fetch_one(f"SELECT COUNT(*) FROM {name}")[0],
+                # Page sizes aren't tracked per table without the dbstat extension
+                "storage_bytes": 0,
+                "index_bytes": 0,
+            }
+
+        return stats
+
+    # Summaries are quick to work out from the cases with the indexes here, so they aren't stored
+
+    async def add_to_summary(self, case: dict, cutoff: dt.datetime):
+        pass
+
+    async def remove_from_summary(self, case: dict, cutoff: dt.datetime):
+        pass
+
+    async def get_summary(self, user_id: int, cutoff: dt.datetime) -> dict:
+        union = "SELECT * FROM mod_logs WHERE user = ? UNION ALL SELECT * FROM mod_logs_archive WHERE user = ?"
+
+        counts = {}
+        for row in self.execute(f"SELECT type, COUNT(*) FROM ({union}) GROUP BY type", (user_id, user_id)):
+            counts[row[0]] = row[1]
+
+        rows = self.execute("SELECT * FROM mod_logs WHERE user = ? AND type != 'note' AND timestamp > ?",
+                            (user_id, to_utc(cutoff).isoformat()))
+        return {"counts": counts, "active": [row_to_case(row) for row in rows]}
+
+    async def rebuild_summaries(self, cutoff: dt.datetime):
+        pass
+
+    async def summaries_empty(self) -> bool:
+        return False
+
+    async def all_modmails(self) -> list:
+        return [dict(row) for row in self.execute("SELECT * FROM modmails")]
+
+    async def find_modmail(self, user_id: int) -> Optional[dict]:
+        row = self.fetch_one("SELECT * FROM modmails WHERE user = ?", (user_id,))
+        return dict(row) if row else None
+
+    async def add_modmail(self, channel_id: int, user_id: int):
+        self.execute("INSERT INTO modmails VALUES (?, ?)", (channel_id, user_id))
+
+    async def delete_modmail(self, channel_id: int, user_id: int):
+        self.execute("DELETE FROM modmails WHERE channel = ? AND user = ?", (channel_id, user_id))
+
+    async def add_pending(self, entry: dict):
+        row = self.fetch_one("INSERT INTO pending (type, user, timestamp) VALUES (?, ?, ?) RETURNING id",
+                             (entry["type"], entry["user"], to_utc(entry["timestamp"]).isoformat()))
+        return row["id"]
+
+    async def delete_pending(self, entry_id):
+        self.execute("DELETE FROM pending WHERE id = ?", (entry_id,))
+
+    async def pending_of_type(self, entry_type: str) -> list:
+        entries = []
+        for row in self.execute("SELECT * FROM pending WHERE type = ?", (entry_type,)):
+            entries.append({"_id": row["id"], "type": row["type"], "user": row["user"],
+                            "timestamp": dt.datetime.fromisoformat(row["timestamp"])})
+
+        return entries
+
+    async def add_qotd(self, question: str, credit: int):
+        self.execute("INSERT INTO qotds (question, credit) VALUES (?, ?)", (question, credit))
+
+    async def all_qotds(self) -> list:
+        return [dict(row) for row in self.execute("SELECT * FROM qotds ORDER BY id")]
+
+    async def pop_qotd(self) -> Optional[dict]:
+        row = self.fetch_one("DELETE FROM qotds WHERE id = (SELECT MIN(id) FROM qotds) RETURNING *")
+        return dict(row) if row else None
+
+    async def count_qotds(self) -> int:
+        return self.fetch_one("SELECT COUNT(*) FROM qotds")[0]
+
+    async def get_setting(self, user_id: int, key: str):
+        row = self.fetch_one("SELECT value FROM settings WHERE user = ? AND key = ?", (user_id, key))
+        return json.loads(row["value"]) if row else None
+
+    async def get_settings(self, user_ids: list, key: str) -> dict:
+        placeholders = ", ".join("?" * len(user_ids))
+        rows = self.execute(f"SELECT user, value FROM settings WHERE key = ? AND user IN ({placeholders})",
+                            (key, *user_ids))
+
+        settings = {row["user"]: json.loads(row["value"]) for row in rows}
+        return {user_id: value for user_id, value in settings.items() if value is not None}
+
+    async def set_setting(self, user_id: int, key: str, value):
+        self.execute("INSERT INTO settings VALUES (?, ?, ?) "
+                     "ON CONFLICT (user, key) DO UPDATE SET value = excluded.value", (user_id, key, json.dumps(value)))
+
+    async def migrate_ids(self, batch_size: int, progress=None) -> dict:
+        # The ID columns have INTEGER affinity, so they've never been stored as text
+        return {}
+
+    async def index_sizes(self) -> dict:
+        # Needs the dbstat extension, which isn't always compiled in
+        return {}
+
+    async def explain_queries(self) -> list:
+        results = []
+        for name, query, params in SQLITE_QUERY_SHAPES:
+            stages = [row["detail"] for row in self.execute("EXPLAIN QUERY PLAN " + query, params)]
+            # "SCAN table" without an index is the equivalent of a COLLSCAN
+            results.append((name, stages, any(stage.startswith("SCAN") and "INDEX" not in stage for stage in stages)))
+
+        return results
+
+
+def make_storage(backend: str) -> Storage:
+    if backend == "mongo":
+        # Only connect to Mongo when it's being used
+        from db import db
+        return MongoStorage(db)
+    elif backend == "sqlite":
+        return SQLiteStorage(SQLITE_PATH)
+    else:
+        raise ValueError(f"Unknown storage backend: {backend}")
+
+
+storage = make_storage(STORAGE_BACKEND)
+
+# counter_id: [next number, end of block]. Numbers reserved from the database but not handed out yet
+_counter_blocks = {}
+_counter_locks = defaultdict(asyncio.Lock)
+
+
+async def use_counter(counter_id: str) -> int:
+    block_size = COUNTER_BLOCKS.get(counter_id)
+    if not block_size:
+        return await storage.reserve_numbers(counter_id, 1)
+
+    # Hand out numbers from a reserved block, only going to the database once it's used up. Any left over when the bot
+    # stops are skipped
+    async with _counter_locks[counter_id]:
+        block = _counter_blocks.get(counter_id)
+
+        if block is None or block[0] == block[1]:
+            start = await storage.reserve_numbers(counter_id, block_size)
+            block = _counter_blocks[counter_id] = [start, start + block_size]
+
+        number = block[0]
+        block[0] += 1
+
+    return number
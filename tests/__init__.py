@@ -0,0 +1,4 @@
+import config
+
+# The tests don't need a Mongo server. Has to be set before storage is imported, as that's when the backend is picked
+config.STORAGE_BACKEND = "sqlite"
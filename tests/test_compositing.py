@@ -0,0 +1,57 @@
+"""
+Renders pride and welcome images with each compositing engine and compares them to reference images made by the
+original Pillow code, from before there was a choice of engine. Regenerate the references if the output is meant to
+change
+
+Run from the repository root: python -m unittest
+"""
+from io import BytesIO
+from PIL import Image, ImageChops
+import os
+import unittest
+import imaging
+from benchmarks.compositing import sample_avatars
+
+REFERENCE_DIR = os.path.join(os.path.dirname(__file__), "reference")
+
+# Text is drawn by FreeType, which can differ slightly between versions
+MAX_DIFFERENT_PIXELS = 0.001
+
+
+def render(kind: str, pfp: bytes) -> Image:
+    if kind == "pride":
+        return imaging.make_pride_image(BytesIO(pfp), "Aromantic", "diagonal /", "Asexual", 0)
+    elif kind == "pride_blur":
+        return imaging.make_pride_image(BytesIO(pfp), "Aromantic", None, None, 1)
+    else:
+        return imaging.make_welcome_image(imaging.WELCOME_BG, BytesIO(pfp), "Welcome", "Golden", "Footer", (0, 0, 0))
+
+
+class CompositingTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        imaging.load_assets()
+
+    def tearDown(self):
+        imaging.engine = "pil"
+
+    def test_matches_reference(self):
+        for engine in imaging.ENGINES:
+            for avatar_name, pfp in sample_avatars().items():
+                for kind in ("pride", "pride_blur", "welcome"):
+                    with self.subTest(engine=engine, avatar=avatar_name, kind=kind):
+                        imaging.engine = engine
+                        image = render(kind, pfp)
+
+                        with Image.open(os.path.join(REFERENCE_DIR, f"{kind}_{avatar_name}.png")) as reference:
+                            reference.load()
+
+                        self.assertEqual((image.mode, image.size), (reference.mode, reference.size))
+
+                        difference = ImageChops.difference(image, reference).convert("L")
+                        different = sum(difference.histogram()[1:])
+                        self.assertLessEqual(different / (image.width * image.height), MAX_DIFFERENT_PIXELS)
+
+
+if __name__ == "__main__":
+    unittest.main()
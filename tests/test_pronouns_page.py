@@ -0,0 +1,153 @@
+"""
+Runs the pronouns.page cache against a local stand-in for the API
+"""
+from aiohttp import web
+import aiohttp
+import asyncio
+import time
+import unittest
+from pronouns_page import ProfileCache, PronounsPageError
+
+TIMEOUT = 0.2
+
+
+class StandIn:
+    """Serves a profile for any username, with an ETag. How long it takes and the status can be changed"""
+
+    def __init__(self):
+        self.delay = 0
+        self.status = 200
+        self.version = 1
+        # The If-None-Match header of each request
+        self.requests = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests.append(request.headers.get("If-None-Match"))
+        await asyncio.sleep(self.delay)
+
+        if self.status != 200:
+            return web.Response(status=self.status)
+
+        etag = f'"v{self.version}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304)
+
+        profile = {"username": request.match_info["username"], "version": self.version, "profiles": {"en": {}}}
+        return web.json_response(profile, headers={"ETag": etag})
+
+
+class ProfileCacheTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.server = StandIn()
+
+        app = web.Application()
+        app.router.add_get("/api/profile/get/{username}", self.server.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+
+        self.session = aiohttp.ClientSession()
+        self.profiles = ProfileCache(100, 60, 600, TIMEOUT, f"http://127.0.0.1:{port}/api/profile/get/{{}}?version=2")
+
+    async def asyncTearDown(self):
+        # Let requests left running after a timeout finish first
+        await asyncio.gather(*self.profiles.requests.in_flight.values(), return_exceptions=True)
+        await self.session.close()
+        await self.runner.cleanup()
+
+    async def get(self, username: str) -> dict:
+        return await self.profiles.get(self.session, username)
+
+    def age(self, username: str, seconds: float):
+        self.profiles.cache.get(username).fetched -= seconds
+
+    async def test_fresh_entries_are_reused(self):
+        first = await self.get("alex")
+        second = await self.get("alex")
+
+        self.assertEqual(first["username"], "alex")
+        self.assertIs(second, first)
+        self.assertEqual(len(self.server.requests), 1)
+
+    async def test_concurrent_misses_share_a_request(self):
+        self.server.delay = 0.05
+        results = await asyncio.gather(*(self.get("sam") for _ in range(100)))
+
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertTrue(all(result["username"] == "sam" for result in results))
+        self.assertEqual(self.profiles.stats()["coalesced"], 99)
+
+    async def test_stale_entry_is_revalidated(self):
+        first = await self.get("alex")
+        self.age("alex", 120)
+
+        # Used straight away, while a conditional request goes out in the background
+        self.assertIs(await self.get("alex"), first)
+        await asyncio.gather(*self.profiles.requests.in_flight.values())
+
+        self.assertEqual(self.server.requests, [None, '"v1"'])
+        self.assertEqual(self.profiles.not_modified, 1)
+
+        # The 304 renewed it, so it's fresh again
+        self.assertIs(await self.get("alex"), first)
+        self.assertEqual(len(self.server.requests), 2)
+
+    async def test_changed_profile_replaces_stale_entry(self):
+        await self.get("alex")
+        self.age("alex", 120)
+        self.server.version = 2
+
+        await self.get("alex")
+        await asyncio.gather(*self.profiles.requests.in_flight.values())
+
+        self.assertEqual((await self.get("alex"))["version"], 2)
+
+    async def test_timeout_falls_back_to_cache(self):
+        first = await self.get("alex")
+        # Too old to be used without asking first
+        self.age("alex", 6000)
+        self.server.delay = TIMEOUT * 3
+
+        start = time.monotonic()
+        self.assertIs(await self.get("alex"), first)
+        self.assertLess(time.monotonic() - start, TIMEOUT * 2)
+        self.assertEqual(self.profiles.fallbacks, 1)
+
+    async def test_timeout_without_cache_raises(self):
+        self.server.delay = TIMEOUT * 3
+
+        with self.assertRaises(PronounsPageError):
+            await self.get("alex")
+
+    async def test_server_error_falls_back_to_cache(self):
+        first = await self.get("alex")
+        self.age("alex", 6000)
+        self.server.status = 503
+
+        self.assertIs(await self.get("alex"), first)
+        self.assertEqual(self.profiles.fallbacks, 1)
+
+    async def test_server_error_without_cache_raises(self):
+        self.server.status = 503
+
+        with self.assertRaises(PronounsPageError):
+            await self.get("alex")
+        self.assertEqual(self.profiles.errors, 1)
+
+    async def test_least_recently_used_is_evicted(self):
+        self.profiles = ProfileCache(2, 60, 600, TIMEOUT, self.profiles.url)
+
+        await self.get("alex")
+        await self.get("sam")
+        await self.get("alex")
+        await self.get("jo")
+
+        self.assertEqual(self.profiles.stats()["entries"], 2)
+        self.assertIsNone(self.profiles.cache.get("sam"))
+        self.assertIsNotNone(self.profiles.cache.get("alex"))
+
+
+if __name__ == "__main__":
+    unittest.main()
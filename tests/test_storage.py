@@ -0,0 +1,185 @@
+"""
+Runs the Storage interface against the SQLite backend. Mongo needs a server, so isn't covered here
+"""
+import asyncio
+import datetime as dt
+import unittest
+from collections import defaultdict
+from unittest import mock
+import storage
+from storage import SQLiteStorage, use_counter
+
+NOW = dt.datetime(2024, 6, 1)
+
+
+def make_case(number: int, user: int, log_type: str = "warn", reason: str = "spam", days_ago: float = 0,
+              mod: int = 1) -> dict:
+    return {
+        "case": number,
+        "user": user,
+        "mod": mod,
+        "type": log_type,
+        "duration": None,
+        "reason": reason,
+        "timestamp": NOW - dt.timedelta(days=days_ago),
+    }
+
+
+class StorageTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.storage = SQLiteStorage()
+        await self.storage.setup()
+
+    async def insert(self, *cases: dict):
+        for case in cases:
+            await self.storage.insert_case(case)
+            await self.storage.add_to_summary(case, NOW - dt.timedelta(days=90))
+
+    async def test_counters(self):
+        self.assertEqual(await self.storage.reserve_numbers("mod_logs_case", 1), 1)
+        self.assertEqual(await self.storage.reserve_numbers("mod_logs_case", 10), 2)
+        self.assertEqual(await self.storage.reserve_numbers("mod_logs_case", 1), 12)
+        # Each counter is separate
+        self.assertEqual(await self.storage.reserve_numbers("modmail", 1), 1)
+
+    async def test_counter_blocks(self):
+        with mock.patch.object(storage, "storage", self.storage), \
+                mock.patch.object(storage, "COUNTER_BLOCKS", {"mod_logs_case": 10}), \
+                mock.patch.object(storage, "_counter_blocks", {}), \
+                mock.patch.object(storage, "_counter_locks", defaultdict(asyncio.Lock)):
+            # Past the end of the first block and partway into the third, all at once
+            numbers = await asyncio.gather(*(use_counter("mod_logs_case") for _ in range(25)))
+            self.assertEqual(numbers, list(range(1, 26)))
+            # Three blocks were taken from the database, not a number at a time
+            self.assertEqual(await self.storage.reserve_numbers("mod_logs_case", 1), 31)
+
+            # Counters without a block size still go to the database for each number
+            self.assertEqual([await use_counter("modmail") for _ in range(3)], [1, 2, 3])
+            self.assertEqual(await self.storage.reserve_numbers("modmail", 1), 4)
+
+    async def test_case_page(self):
+        await self.insert(*(make_case(number, 1 if number % 3 else 2) for number in range(1, 101)))
+
+        seen = []
+        before = None
+        while True:
+            page = await self.storage.case_page(before, 25, user=1)
+            if not page:
+                break
+
+            numbers = [case["case"] for case in page]
+            self.assertEqual(numbers, sorted(numbers, reverse=True))
+            seen += numbers
+            before = numbers[-1]
+
+        self.assertEqual(seen, [number for number in range(100, 0, -1) if number % 3])
+
+    async def test_case_filters(self):
+        await self.insert(make_case(1, 1, "warn"), make_case(2, 1, "note"), make_case(3, 1, "ban", mod=2),
+                          make_case(4, 2, "warn", days_ago=10))
+
+        async def numbers(**filters) -> list:
+            return [case["case"] for case in await self.storage.case_page(None, 25, **filters)]
+
+        self.assertEqual(await numbers(user=1, log_type="note"), [2])
+        self.assertEqual(await numbers(user=1, exclude_type="note"), [3, 1])
+        self.assertEqual(await numbers(mod=2), [3])
+        self.assertEqual(await numbers(start=NOW - dt.timedelta(days=11), end=NOW - dt.timedelta(days=1)), [4])
+        self.assertEqual(await self.storage.count_cases(user=1), 3)
+
+    async def test_search_pages(self):
+        await self.insert(*(make_case(number, 1, reason="spam links" if number % 2 else "spam") for number in
+                            range(1, 31)))
+
+        seen = []
+        after = None
+        while True:
+            page = await self.storage.search_cases("spam links", after, 7, 5000)
+            if not page:
+                break
+
+            seen += [case["case"] for case in page]
+            after = (page[-1]["score"], page[-1]["case"])
+
+        # Both words before one word, newest first within each
+        both = [number for number in range(30, 0, -1) if number % 2]
+        one = [number for number in range(30, 0, -1) if not number % 2]
+        self.assertEqual(seen, both + one)
+
+    async def test_search_wildcards(self):
+        await self.insert(make_case(1, 1, reason="100% spam"), make_case(2, 1, reason="1000 spam"),
+                          make_case(3, 1, reason="bad_name"), make_case(4, 1, reason="bad name"),
+                          make_case(5, 1, reason="C:\\spam"), make_case(6, 1, reason="C:spam"))
+
+        # Matched literally, not as LIKE wildcards or escapes
+        for search, expected in (("100%", [1]), ("bad_name", [3]), ("%", [1]), ("_", [3]), ("C:\\", [5])):
+            page = await self.storage.search_cases(search, None, 25, 5000)
+            self.assertEqual([case["case"] for case in page], expected, search)
+
+    async def test_archive(self):
+        await self.insert(*(make_case(number, 1, days_ago=400 - number) for number in range(1, 21)),
+                          make_case(21, 1, "note", days_ago=500))
+
+        moved = await self.storage.archive_cases(NOW - dt.timedelta(days=385), 4)
+
+        # Cases 1-14 are over 385 days old. Notes are never archived
+        self.assertEqual(moved, 14)
+        self.assertEqual(await self.storage.count_cases(), 7)
+        self.assertEqual(await self.storage.count_cases(archived=True), 21)
+
+        archived = await self.storage.find_case(3)
+        self.assertEqual((archived["case"], archived["user"], archived["reason"]), (3, 1, "spam"))
+        self.assertEqual(archived["timestamp"], NOW - dt.timedelta(days=397))
+
+        page = await self.storage.case_page(None, 25, archived=True, user=1)
+        self.assertEqual([case["case"] for case in page], list(range(21, 0, -1)))
+
+        # The note stays live but is the oldest case, so the export can't just put live cases after archived ones
+        exported = [case async for case in self.storage.iter_cases("timestamp", 4, archived=True)]
+        self.assertEqual([case["case"] for case in exported], [21, *range(1, 21)])
+        exported = [case async for case in self.storage.iter_cases("case", 4, archived=True)]
+        self.assertEqual([case["case"] for case in exported], list(range(1, 22)))
+
+        # Nothing left to move
+        self.assertEqual(await self.storage.archive_cases(NOW - dt.timedelta(days=385), 4), 0)
+
+        await self.storage.delete_case(3)
+        self.assertIsNone(await self.storage.find_case(3))
+
+    async def test_summaries(self):
+        cutoff = NOW - dt.timedelta(days=90)
+        await self.insert(make_case(1, 1, "warn"), make_case(2, 1, "warn", days_ago=100), make_case(3, 1, "note"),
+                          make_case(4, 2, "ban"))
+
+        summary = await self.storage.get_summary(1, cutoff)
+        self.assertEqual(summary["counts"], {"warn": 2, "note": 1})
+        # Notes and expired cases aren't active
+        self.assertEqual([case["case"] for case in summary["active"]], [1])
+
+        case = await self.storage.find_case(1)
+        await self.storage.delete_case(1)
+        await self.storage.remove_from_summary(case, cutoff)
+
+        summary = await self.storage.get_summary(1, cutoff)
+        self.assertEqual(summary["counts"], {"warn": 1, "note": 1})
+        self.assertEqual(summary["active"], [])
+
+        await self.storage.rebuild_summaries(cutoff)
+        self.assertEqual((await self.storage.get_summary(2, cutoff))["counts"], {"ban": 1})
+        self.assertEqual((await self.storage.get_summary(3, cutoff))["counts"], {})
+
+    async def test_settings(self):
+        self.assertIsNone(await self.storage.get_setting(1, "pronouns_page"))
+
+        await self.storage.set_setting(1, "pronouns_page", "someone")
+        await self.storage.set_setting(1, "pronouns_page", "someone else")
+        await self.storage.set_setting(2, "pronouns_page", "another")
+        await self.storage.set_setting(3, "other", "value")
+
+        self.assertEqual(await self.storage.get_setting(1, "pronouns_page"), "someone else")
+        self.assertEqual(await self.storage.get_settings([1, 2, 3, 4], "pronouns_page"),
+                         {1: "someone else", 2: "another"})
+
+
+if __name__ == "__main__":
+    unittest.main()
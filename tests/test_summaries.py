@@ -0,0 +1,334 @@
+"""
+Runs the Mongo summary pipelines through a small Python version of the operators they use, as there's no Mongo server
+for the tests. Only covers what the pipelines need
+"""
+import datetime as dt
+import unittest
+from types import SimpleNamespace
+import bson
+from storage import MongoStorage, summary_add_update, summary_remove_update, summary_pipeline
+from tests.test_storage import NOW, make_case
+
+CUTOFF = NOW - dt.timedelta(days=90)
+
+
+def get_path(doc, path: str):
+    for key in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+
+    return doc
+
+
+def evaluate(expression, doc: dict, variables: dict = None):
+    variables = variables or {}
+
+    if isinstance(expression, str) and expression.startswith("$$"):
+        name, _, path = expression[2:].partition(".")
+        return get_path(variables[name], path) if path else variables[name]
+    if isinstance(expression, str) and expression.startswith("$"):
+        return get_path(doc, expression[1:])
+    if isinstance(expression, list):
+        return [evaluate(item, doc, variables) for item in expression]
+    if not isinstance(expression, dict):
+        return expression
+
+    operator, args = next(iter(expression.items()))
+    if not operator.startswith("$"):
+        return {key: evaluate(value, doc, variables) for key, value in expression.items()}
+    if operator == "$literal":
+        return args
+    if operator in ("$filter", "$reduce"):
+        items = evaluate(args["input"], doc, variables)
+        if operator == "$filter":
+            return [item for item in items if evaluate(args["cond"], doc, {**variables, "this": item})]
+
+        value = evaluate(args["initialValue"], doc, variables)
+        for item in items:
+            value = evaluate(args["in"], doc, {**variables, "value": value, "this": item})
+        return value
+
+    values = evaluate(args, doc, variables)
+    operators = {
+        "$add": lambda a, b: a + b,
+        "$subtract": lambda a, b: a - b,
+        "$max": max,
+        "$ifNull": lambda value, default: default if value is None else value,
+        "$concatArrays": lambda *arrays: sum(arrays, []),
+        "$gt": lambda a, b: a is not None and a > b,
+        "$ne": lambda a, b: a != b,
+        "$and": lambda *conditions: all(conditions),
+        "$toLong": int,
+        "$arrayToObject": lambda pairs: {pair["k"]: pair["v"] for pair in pairs},
+    }
+    # A list is the operator's arguments, anything else is its one argument
+    return operators[operator](*values) if isinstance(args, list) else operators[operator](values)
+
+
+def matches(doc: dict, query: dict) -> bool:
+    for field, condition in query.items():
+        value = get_path(doc, field)
+        if isinstance(condition, dict) and "$in" in condition:
+            if value not in condition["$in"]:
+                return False
+        elif isinstance(condition, dict) and "$ne" in condition:
+            if value == condition["$ne"]:
+                return False
+        elif value != condition:
+            return False
+
+    return True
+
+
+def set_path(doc: dict, path: str, value):
+    *parents, last = path.split(".")
+    for key in parents:
+        doc = doc.setdefault(key, {})
+    doc[last] = value
+
+
+def apply_update(doc: dict, update) -> dict:
+    doc = dict(doc)
+
+    if isinstance(update, dict):
+        for field, amount in update["$inc"].items():
+            doc[field] = doc.get(field, 0) + amount
+        return doc
+
+    for stage in update:
+        values = {field: evaluate(expression, doc) for field, expression in stage["$set"].items()}
+        for field, value in values.items():
+            set_path(doc, field, value)
+
+    return doc
+
+
+class Results:
+    def __init__(self, docs: list):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs
+
+
+class Collection:
+    def __init__(self, db, name: str):
+        self.db = db
+        self.name = name
+        self.docs = []
+        self.aggregations = 0
+
+    def find(self, query: dict) -> Results:
+        return Results([doc for doc in self.docs if matches(doc, query)])
+
+    async def find_one(self, query: dict):
+        return next(iter(self.find(query).docs), None)
+
+    async def insert_one(self, doc: dict):
+        doc.setdefault("_id", bson.ObjectId())
+        self.docs.append(doc)
+
+    async def update_one(self, query: dict, update, upsert: bool = False):
+        for index, doc in enumerate(self.docs):
+            if matches(doc, query):
+                self.docs[index] = apply_update(doc, update)
+                return
+
+        if upsert:
+            self.docs.append(apply_update(dict(query), update))
+
+    async def delete_one(self, query: dict):
+        doc = await self.find_one(query)
+        if doc:
+            self.docs.remove(doc)
+
+        return SimpleNamespace(deleted_count=int(doc is not None))
+
+    async def delete_many(self, query: dict):
+        self.docs = [doc for doc in self.docs if not matches(doc, query)]
+
+    def aggregate(self, pipeline: list) -> Results:
+        self.aggregations += 1
+        docs = [dict(doc) for doc in self.docs]
+
+        for stage in pipeline:
+            operator, args = next(iter(stage.items()))
+            if operator == "$match":
+                docs = [doc for doc in docs if matches(doc, args)]
+            elif operator == "$project":
+                docs = [{"_id": doc["_id"], **{field: doc.get(field) if value is True else evaluate(value, doc)
+                                               for field, value in args.items()}} for doc in docs]
+            elif operator == "$unionWith":
+                docs += self.db[args["coll"]].aggregate(args["pipeline"]).docs
+            elif operator == "$group":
+                groups = {}
+                for doc in docs:
+                    key = evaluate(args["_id"], doc)
+                    group = groups.setdefault(repr(key), {"_id": key})
+                    for field, accumulator in args.items():
+                        if field == "_id":
+                            continue
+                        if "$sum" in accumulator:
+                            group[field] = group.get(field, 0) + accumulator["$sum"]
+                        else:
+                            group.setdefault(field, []).append(evaluate(accumulator["$push"], doc))
+                docs = list(groups.values())
+            elif operator == "$merge":
+                into = self.db[args["into"]]
+                for doc in docs:
+                    into.docs = [existing for existing in into.docs if existing["_id"] != doc["_id"]] + [doc]
+                docs = []
+
+        return Results(docs)
+
+
+class Database(dict):
+    def __missing__(self, name: str) -> Collection:
+        self[name] = Collection(self, name)
+        return self[name]
+
+    def __getattr__(self, name: str) -> Collection:
+        return self[name]
+
+
+class SummaryUpdateTest(unittest.TestCase):
+    def test_add(self):
+        summary = {"_id": 1, "counts": {"warn": 1}, "active": [{"case": 1, "type": "warn", "timestamp": NOW}]}
+
+        summary = apply_update(summary, summary_add_update(make_case(2, 1, "ban"), CUTOFF))
+        summary = apply_update(summary, summary_add_update(make_case(3, 1, "note"), CUTOFF))
+
+        self.assertEqual(summary["counts"], {"warn": 1, "ban": 1, "note": 1})
+        # Notes aren't active
+        self.assertEqual([case["case"] for case in summary["active"]], [1, 2])
+
+    def test_add_drops_expired(self):
+        summary = {"_id": 1, "counts": {"warn": 1}, "active": [{"case": 1, "type": "warn", "timestamp": CUTOFF}]}
+
+        summary = apply_update(summary, summary_add_update(make_case(2, 1), CUTOFF))
+
+        self.assertEqual(summary["counts"], {"warn": 2})
+        self.assertEqual([case["case"] for case in summary["active"]], [2])
+
+    def test_add_to_new_summary(self):
+        summary = apply_update({"_id": 1}, summary_add_update(make_case(1, 1), CUTOFF))
+
+        self.assertEqual(summary["counts"], {"warn": 1})
+        self.assertEqual(summary["pending"], 0)
+
+    def test_remove(self):
+        summary = {"_id": 1, "counts": {"warn": 2}, "active": [{"case": 1, "type": "warn", "timestamp": NOW},
+                                                               {"case": 2, "type": "warn", "timestamp": NOW}]}
+
+        summary = apply_update(summary, summary_remove_update(make_case(1, 1), CUTOFF))
+
+        self.assertEqual(summary["counts"], {"warn": 1})
+        self.assertEqual([case["case"] for case in summary["active"]], [2])
+
+        # Never goes below 0, even if the summary was already missing the case
+        summary = apply_update(summary, summary_remove_update(make_case(3, 1, "ban"), CUTOFF))
+        self.assertEqual(summary["counts"], {"warn": 1, "ban": 0})
+
+    def test_pending(self):
+        summary = apply_update({"_id": 1}, {"$inc": {"pending": 1}})
+        summary = apply_update(summary, {"$inc": {"pending": 1}})
+
+        summary = apply_update(summary, summary_add_update(make_case(1, 1), CUTOFF))
+        self.assertEqual(summary["pending"], 1)
+        summary = apply_update(summary, summary_remove_update(make_case(1, 1), CUTOFF))
+        self.assertEqual(summary["pending"], 0)
+        summary = apply_update(summary, summary_remove_update(make_case(1, 1), CUTOFF))
+        self.assertEqual(summary["pending"], 0)
+
+
+class SummaryPipelineTest(unittest.TestCase):
+    def setUp(self):
+        self.db = Database()
+        self.db.mod_logs.docs = [
+            {**make_case(3, 1), "_id": 3},
+            {**make_case(4, 1, "note"), "_id": 4},
+            {**make_case(5, "2", "ban"), "_id": 5},
+        ]
+        # Archived cases still count, but are too old to be active
+        self.db.mod_logs_archive.docs = [
+            {**make_case(1, 1, days_ago=400), "_id": 1},
+            {**make_case(2, "1", days_ago=300), "_id": 2},
+        ]
+
+    def test_all_users(self):
+        rebuilt = bson.ObjectId()
+        self.db.mod_log_summaries.docs = [{"_id": 2, "counts": {"warn": 5}, "active": []}]
+
+        self.db.mod_logs.aggregate(summary_pipeline(CUTOFF, rebuilt=rebuilt))
+
+        summaries = {summary["_id"]: summary for summary in self.db.mod_log_summaries.docs}
+        # String IDs are summarised with the int ones
+        self.assertEqual(set(summaries), {1, 2})
+        self.assertEqual(summaries[1]["counts"], {"warn": 3, "note": 1})
+        self.assertEqual([case["case"] for case in summaries[1]["active"]], [3])
+        # Existing summaries are replaced
+        self.assertEqual(summaries[2]["counts"], {"ban": 1})
+        self.assertTrue(all(summary["rebuilt"] == rebuilt for summary in summaries.values()))
+
+    def test_match(self):
+        self.db.mod_logs.aggregate(summary_pipeline(CUTOFF, {"user": {"$in": [1, "1"]}}))
+
+        self.assertEqual([summary["_id"] for summary in self.db.mod_log_summaries.docs], [1])
+        self.assertEqual(self.db.mod_log_summaries.docs[0]["counts"], {"warn": 3, "note": 1})
+
+
+class SummarySelfHealTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.db = Database()
+        self.storage = MongoStorage(self.db)
+
+    async def test_up_to_date(self):
+        for case in (make_case(1, 1), make_case(2, 1, "ban")):
+            await self.storage.insert_case(case)
+            await self.storage.add_to_summary(case, CUTOFF)
+
+        case = await self.storage.find_case(1)
+        await self.storage.delete_case(1)
+        await self.storage.remove_from_summary(case, CUTOFF)
+
+        summary = await self.storage.get_summary(1, CUTOFF)
+        self.assertEqual(summary["counts"], {"warn": 0, "ban": 1})
+        # Read straight from the summary
+        self.assertEqual(self.db.mod_logs.aggregations, 0)
+
+    async def test_missed_add(self):
+        await self.storage.insert_case(make_case(1, 1))
+        await self.storage.add_to_summary(make_case(1, 1), CUTOFF)
+        # The summary update never happened
+        await self.storage.insert_case(make_case(2, 1, "ban"))
+
+        summary = await self.storage.get_summary(1, CUTOFF)
+        self.assertEqual(summary["counts"], {"warn": 1, "ban": 1})
+        self.assertEqual([case["case"] for case in summary["active"]], [1, 2])
+
+        # The remade summary is used after that
+        await self.storage.get_summary(1, CUTOFF)
+        self.assertEqual(self.db.mod_logs.aggregations, 1)
+
+    async def test_missed_remove(self):
+        await self.storage.insert_case(make_case(1, 1))
+        await self.storage.add_to_summary(make_case(1, 1), CUTOFF)
+        await self.storage.delete_case(1)
+
+        self.assertEqual(await self.storage.get_summary(1, CUTOFF), {"counts": {}, "active": []})
+        self.assertEqual(self.db.mod_log_summaries.docs, [])
+
+    async def test_string_id_summary(self):
+        self.db.mod_logs.docs = [{**make_case(1, "1"), "_id": 1}, {**make_case(2, 1), "_id": 2}]
+        self.db.mod_log_summaries.docs = [{"_id": "1", "counts": {"warn": 1}, "active": []},
+                                          {"_id": 1, "counts": {"warn": 1}, "active": []}]
+
+        summary = await self.storage.get_summary(1, CUTOFF)
+
+        self.assertEqual(summary["counts"], {"warn": 2})
+        self.assertEqual([summary["_id"] for summary in self.db.mod_log_summaries.docs], [1])
+
+
+if __name__ == "__main__":
+    unittest.main()